@@ -215,6 +215,7 @@ def initialise_bgp_sessions(network):
     http://www.ferg.org/projects/python_gotchas.html#contents_item_6
     """
     LOG.debug("Initialising iBGP sessions")
+    ank.clear_compiled_bgp_policy(network)
     for (u,v) in network.g_session.edges():
         network.g_session[u][v]['ingress'] = []
         network.g_session[u][v]['egress'] = []
@@ -223,6 +224,7 @@ def initialise_bgp_sessions(network):
 
 def initialise_bgp_attributes(network):
     LOG.debug("Initialising BGP attributes")
+    ank.clear_compiled_bgp_policy(network)
     for node in network.g_session:
         network.g_session.node[node]['tags'] = {}
         network.g_session.node[node]['prefixes'] = {}
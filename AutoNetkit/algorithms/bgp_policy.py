@@ -42,10 +42,14 @@ import operator
 import pprint
 import itertools
 import re
-from collections import namedtuple
+import netaddr
+from AutoNetkit.internal import cache
+from collections import namedtuple, defaultdict
 
 LOG = logging.getLogger("ANK")
 
+# Increment when the grammar or parsed representation changes, to invalidate cached policy
+POLICY_PARSER_VERSION = 1
 
 def tag_to_pl(tag):
     """Adds prefix list prefix to tag
@@ -90,6 +94,40 @@ class route_map_tuple (namedtuple('route_map', "name, match_tuples")):
     def __repr__(self):
         return "%s %s" % (self.name, self.match_tuples)
 
+class prefix_list_entry (namedtuple('prefix_list_entry', 'prefix, ge, le')):
+    """Prefix list entry. For aggregates ge and le are set to the shortest and
+    longest prefix length covered, so the entry matches the covered prefixes
+    but not the aggregate itself or longer prefixes such as loopbacks.
+
+    >>> prefix_list_entry.covering(netaddr.IPNetwork("10.1.0.0/16"), [30, 30])
+    10.1.0.0/16 ge 30 le 30
+    >>> prefix_list_entry.covering(netaddr.IPNetwork("10.1.0.0/29"), [29, 30])
+    10.1.0.0/29 le 30
+    >>> prefix_list_entry.covering(netaddr.IPNetwork("10.1.0.0/30"), [30])
+    10.1.0.0/30
+    """
+    __slots__ = ()
+    @classmethod
+    def covering(cls, prefix, prefixlens):
+        """Entry for prefix, matching the covered prefix lengths prefixlens"""
+        ge = min(prefixlens)
+        le = max(prefixlens)
+        if le == prefix.prefixlen:
+# not aggregated
+            return cls(prefix, None, None)
+        if ge == prefix.prefixlen:
+# ge must be longer than the prefix, le alone also matches the prefix
+            ge = None
+        return cls(prefix, ge, le)
+
+    def __repr__(self):
+        retval = str(self.prefix)
+        if self.ge:
+            retval += " ge %s" % self.ge
+        if self.le:
+            retval += " le %s" % self.le
+        return retval
+
 class match_clause (namedtuple('match_clause', 'type, comparison, value')):
     __slots__ = ()
     def __repr__(self):
@@ -100,6 +138,169 @@ class action_clause (namedtuple('action_clause', 'action, value')):
     def __repr__(self):
         return "%s %s" % (self.action, self.value)
 
+class parsed_policy (namedtuple('parsed_policy', 'type, data')):
+    """A parsed policy line, independent of the network it is applied to:
+    a set definition, library call, or policy to apply to sessions"""
+    __slots__ = ()
+    def __repr__(self):
+        if self.type == "apply":
+            (query_a, edge_type, query_b, clauses) = self.data
+            return "apply %s %s %s: %s" % (query_a, edge_type, query_b, clauses)
+        return "%s %s: %s" % (self.type, self.data[0], self.data[1])
+
+def route_map_body(match_tuples):
+    """Hashable form of the body of a route map, independent of its name.
+    Route maps with the same body are interchangeable, and can be shared.
+
+    >>> body = [match_tuple_with_seq_no(1, [match_clause('tag', '=', 'abc')],
+    ...     [action_clause('setLP', 100)], False)]
+    >>> route_map_body(body)
+    ((1, (tag = abc,), (setLP 100,), False),)
+    """
+    return tuple( (m.seq_no, tuple(m.match_clauses), tuple(m.action_clauses), m.reject)
+            for m in match_tuples)
+
+def route_map_group(route_maps, name, route_map_groups, group_names):
+    """Flattens route_maps into a single route map group, for platforms that
+    apply one route map per neighbor direction (Quagga, IOS).
+    Groups with identical bodies are only stored once in route_map_groups,
+    group_names maps each body to the name it was stored under.
+    Returns the name of the group to reference, or None if no route maps.
+
+    >>> route_map_groups, group_names = {}, {}
+    >>> rm = route_map_tuple("rm_ingress_a_1", [match_tuple_with_seq_no(1, [],
+    ...     [action_clause('setLP', 100)], False)])
+    >>> route_map_group([rm], "rm_a_in", route_map_groups, group_names)
+    'rm_a_in'
+    >>> route_map_group([rm], "rm_b_in", route_map_groups, group_names)
+    'rm_a_in'
+    >>> route_map_groups.keys()
+    ['rm_a_in']
+    >>> route_map_group([], "rm_c_in", route_map_groups, group_names) is None
+    True
+    """
+    if not len(route_maps):
+        return None
+    match_tuples = [match_tuple for route_map in route_maps
+            for match_tuple in route_map.match_tuples]
+    body = route_map_body(match_tuples)
+    if body not in group_names:
+        group_names[body] = name
+        route_map_groups[name] = match_tuples
+    return group_names[body]
+
+class peer_policy (namedtuple('peer_policy',
+    'ingress, egress, route_map_group_in, route_map_group_out')):
+    """Route maps a router applies to a peer, both as the individual route
+    maps, and as the name of the flattened route map group"""
+    __slots__ = ()
+    def __repr__(self):
+        return "in %s out %s" % (self.route_map_group_in, self.route_map_group_out)
+
+class router_policy (namedtuple('router_policy',
+    'community_lists, prefix_lists, prefix_subnets, route_maps, route_map_groups, peers')):
+    """Compiled BGP policy for a router, shared by all compiler targets.
+    Prefix subnets are the prefix lists before aggregation, for targets
+    without prefix length ranges."""
+    __slots__ = ()
+    def __repr__(self):
+        return "route maps %s groups %s" % ([r.name for r in self.route_maps],
+                sorted(self.route_map_groups.keys()))
+
+def compile_bgp_policy(network):
+    """Compiles the policy applied on each router in the session graph into a
+    router_policy, stored in the session graph. This is done once, and the
+    result used read-only by each compiler target.
+
+    >>> inet = ank.internet.Internet("2routers")
+    >>> inet.compile()
+    >>> node_a = inet.network.find("a.AS1")
+    >>> node_b = inet.network.find("b.AS2")
+    >>> pol_parser = ank.BgpPolicyParser(inet.network)
+    >>> pol_parser.apply_bgp_policy("(asn=1) ->ingress (asn=2): (setLP 200)")
+    >>> pol_parser.cl_and_pl_per_node()
+    >>> policy = compile_bgp_policy(inet.network)[node_b]
+    >>> policy
+    route maps ['rm_ingress_a_AS1_1'] groups ['rm_a_AS1_in']
+    >>> policy.peers[node_a]
+    in rm_a_AS1_in out None
+    >>> policy.route_map_groups['rm_a_AS1_in']
+    [seq 1 if [] then [setLP 200] reject: False]
+    """
+    LOG.debug("Compiling BGP policy per router")
+    g_session = network.g_session
+    prefix_subnets = g_session.graph.get('prefix_subnets') or {}
+    compiled = {}
+    for router in g_session:
+        route_maps = {}
+        route_map_groups = {}
+        route_map_group_names = {}
+        peers = {}
+# Visit peers in a fixed order, so shared group names are deterministic
+        for peer in sorted(set(g_session.predecessors(router)) | set(g_session.successors(router)),
+                key = network.fqdn):
+            ingress = []
+            if g_session.has_edge(peer, router):
+                ingress = g_session[peer][router]['ingress']
+            egress = []
+            if g_session.has_edge(router, peer):
+                egress = g_session[router][peer]['egress']
+            for route_map in itertools.chain(ingress, egress):
+                route_maps[route_map.name] = route_map
+            peers[peer] = peer_policy(ingress, egress,
+                    route_map_group(ingress, "rm_%s_in" % peer.folder_name,
+                        route_map_groups, route_map_group_names),
+                    route_map_group(egress, "rm_%s_out" % peer.folder_name,
+                        route_map_groups, route_map_group_names),
+                    )
+
+        node_bgp_data = g_session.node[router]
+        prefix_lists = node_bgp_data.get('prefixes') or {}
+        compiled[router] = router_policy(
+                node_bgp_data.get('tags') or {},
+                prefix_lists,
+                dict( (name, prefix_subnets.get(name, [])) for name in prefix_lists),
+                [route_maps[name] for name in sorted(route_maps)],
+                route_map_groups,
+                peers)
+
+    g_session.graph['compiled_policy'] = compiled
+    return compiled
+
+def clear_compiled_bgp_policy(network):
+    """Discards the compiled BGP policy, called when sessions or their policy
+    change so the policy is recompiled on next use"""
+    network.g_session.graph.pop('compiled_policy', None)
+
+def router_bgp_policy(network, router):
+    """Returns the compiled BGP policy for router, compiling the policy for
+    the network if this has not been done yet
+
+    >>> inet = ank.internet.Internet("2routers")
+    >>> inet.compile()
+    >>> node_b = inet.network.find("b.AS2")
+    >>> pol_parser = ank.BgpPolicyParser(inet.network)
+    >>> pol_parser.apply_bgp_policy("(asn=1) ->ingress (asn=2): (setLP 200)")
+    >>> pol_parser.cl_and_pl_per_node()
+    >>> router_bgp_policy(inet.network, node_b).route_map_groups['rm_a_AS1_in']
+    [seq 1 if [] then [setLP 200] reject: False]
+
+    Changing the policy discards the compiled policy:
+
+    >>> pol_parser.clear_policies()
+    >>> pol_parser.apply_bgp_policy("(asn=1) ->ingress (asn=2): (setMED 50)")
+    >>> pol_parser.cl_and_pl_per_node()
+    >>> router_bgp_policy(inet.network, node_b).route_map_groups['rm_a_AS1_in']
+    [seq 1 if [] then [setMED 50] reject: False]
+    """
+    compiled = network.g_session.graph.get('compiled_policy')
+    if compiled is None:
+        compiled = compile_bgp_policy(network)
+    try:
+        return compiled[router]
+    except KeyError:
+        return router_policy({}, {}, {}, [], {}, {})
+
 
 class BgpPolicyParser:
     """Parser class"""
@@ -109,6 +310,13 @@ class BgpPolicyParser:
         self.user_defined_sets = {}
         self.user_library_calls = []
         self.user_defined_functions = {}
+        # Memoised node_select_query results, keyed on normalised query,
+        # with the network version they were selected at
+        self._node_select_cache = {}
+        # Parsed policy lines, independent of the network so can be cached on disk
+        self._parsed_lines = {}
+        self._parsed_session_queries = {}
+        self._local_tag_re = re.compile(r"(tag = |addTag |tags contain )([\w.]+)")
 
         # Grammars
 #TODO: tidy this up
@@ -126,6 +334,8 @@ class BgpPolicyParser:
         self.wildcard = wildcard
 
         self.prefix_lists = {}
+        # Link subnets of each prefix list, before aggregation
+        self.prefix_subnets = {}
         self.tags_to_allocate = set()
         self.allocated_tags = {}
 
@@ -169,6 +379,10 @@ class BgpPolicyParser:
         boolean_or = Literal("|").setResultsName("|")
         boolean = (boolean_and | boolean_or).setResultsName("boolean")
         self._boolean = boolean # need to use in checking
+        self._booleans = set(["&", "|"])
+        self.wildcard_token = "*"
+#TODO: base this on the keywords used in the parser itself for continuity
+        self.origin_transit_keywords = set(["Origin", "Transit"])
 
 #TODO fix this matching 2a.ab when that should match a string
         numericQuery = Group(attribute + comparison + float_string).setResultsName( "numericQuery")
@@ -305,6 +519,7 @@ class BgpPolicyParser:
         #TODO: allow shorthand of (1) -> (2) for (asn=1) -> (asn=2)
 
     def clear_policies(self):
+        clear_compiled_bgp_policy(self.network)
         for src, dst in self.network.g_session.edges():
             self.network.g_session[src][dst]['ingress'] = []
             self.network.g_session[src][dst]['egress'] = []
@@ -395,12 +610,29 @@ class BgpPolicyParser:
         >>> pol_parser.apply_bgp_policy("(node = a_b ) ->ingress (Network = AS2): (if Transit(asn=2) then addTag a100 ) ")
         """
         LOG.debug("Applying BGP policy %s" % qstring)
+        self.apply_parsed_policy(self.parse_policy_line(qstring))
+
+    def parse_policy_line(self, qstring):
+        """Parses a policy line into a parsed_policy, independent of the network,
+        so it can be cached. Results are memoised per line.
+
+        >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
+        >>> pol_parser.parse_policy_line("(asn=1) ->ingress (asn=2): (if Origin(asn=2) then setLP 200)")
+        apply (('asn', '=', 1.0),) ->ingress (('asn', '=', 2.0),): [if [Origin ( (('asn', '=', 2.0),)] then [setLP 200] reject: False]
+        >>> pol_parser.parse_policy_line("customers = {AS1, AS3}")
+        set customers: ['AS1', 'AS3']
+        >>> pol_parser.parse_policy_line("apply transit(customers, {AS2})")
+        call transit: ['customers', ['AS2']]
+        """
+        try:
+            return self._parsed_lines[qstring]
+        except KeyError:
+            pass
+
         result = self.bgpPolicyLine.parseString(qstring)
         if 'set_definition' in result:
-            LOG.debug("Storing set definition %s" % result.set_name)
-            self.user_defined_sets[result.set_name] = set(a for a in result.set_values)
-            return
-        if 'library_call' in result:
+            parsed = parsed_policy("set", (result.set_name, sorted(a for a in result.set_values)))
+        elif 'library_call' in result:
             def_params = []
             for param in result.def_params:
                 if isinstance(param, basestring):
@@ -408,43 +640,41 @@ class BgpPolicyParser:
                 else:
 # is a sequence, extract value
                     def_params.append([p for p in param])
-
-            self.user_library_calls.append( (result.def_name, def_params))
+            parsed = parsed_policy("call", (result.def_name, def_params))
+        else:
+            parsed = parsed_policy("apply", (self.query_key(result.query_a), result.edgeType,
+                self.query_key(result.query_b), self.session_query_clauses(result.bgpSessionQuery)))
+
+        self._parsed_lines[qstring] = parsed
+        return parsed
+
+    def apply_parsed_policy(self, parsed):
+        """Applies a parsed_policy to the network"""
+        clear_compiled_bgp_policy(self.network)
+        if parsed.type == "set":
+            (set_name, set_values) = parsed.data
+            LOG.debug("Storing set definition %s" % set_name)
+            self.user_defined_sets[set_name] = set(set_values)
+            return
+        if parsed.type == "call":
+            (def_name, def_params) = parsed.data
+            self.user_library_calls.append( (def_name, def_params))
             return
 
-        LOG.debug("Query string is %s " % qstring)
-        set_a = self.node_select_query(result.query_a)
+        (query_a, select_type, query_b, session_clauses) = parsed.data
+        set_a = self.node_select_query(query_a)
         LOG.debug("Set a is %s " % set_a)
-        set_b = self.node_select_query(result.query_b)
+        set_b = self.node_select_query(query_b)
         LOG.debug("Set b is %s " % set_b)
-        select_type = result.edgeType
-        per_session_policy = self.process_if_then_else(result.bgpSessionQuery)
-
-# use nbunch feature of networkx to limit edges to look at
-        node_set = set_a | set_b
-
-        edges = self.network.g_session.edges(node_set)
-        #LOG.debug("Edges are %s " % edges)
-# 1 ->, 2 <-, 3 <->
-
-        def select_fn_u_to_v( (u, v), src_set, dst_set):
-            """ u -> v"""
-            return (u in src_set and v in dst_set)
-
-        def select_fn_u_from_v( (u, v), src_set, dst_set):
-            """ u <- v"""
-            return (u in dst_set and v in src_set)
-
-        def select_fn_v_to_from_u( (u, v), src_set, dst_set):
-            """ u <-> v"""
-            return (u in src_set and v in dst_set) or (u in dst_set and v in src_set)
+        per_session_policy = self.resolve_session_clauses(session_clauses)
 
+# 1 ->, 2 <-
         if select_type in [self.u_egress, self.v_ingress]:
 # u -> v
-            select_function = select_fn_u_to_v
+            src_set, dst_set = set_a, set_b
         if select_type in [self.u_ingress, self.v_egress]:
 # u <- v
-            select_function = select_fn_u_from_v
+            src_set, dst_set = set_b, set_a
 
         # Determine which direction to apply policy to
         ingress_or_egress = None
@@ -454,13 +684,38 @@ class BgpPolicyParser:
             ingress_or_egress = 'egress'
 
         # apply policy to edges
-        selected_edges = list( e for e in edges if select_function(e, set_a, set_b))
+        selected_edges = self.select_sessions(src_set, dst_set)
         LOG.debug("Selected edges are %s" % selected_edges)
         for u,v in selected_edges:
             LOG.debug("Applying policy %s to %s of %s->%s" % ( per_session_policy, ingress_or_egress, 
                 self.network.fqdn(u), self.network.fqdn(v)))
             self.network.g_session[u][v][ingress_or_egress].append(per_session_policy)
 
+    def select_sessions(self, src_set, dst_set):
+        """Returns sessions u -> v for u in src_set and v in dst_set.
+        Walks the adjacency of the smaller set, so cost scales with the
+        number of matching sessions rather than the total session count.
+
+        >>> inet = ank.internet.Internet("2routers") 
+        >>> inet.compile()
+        >>> node_a = inet.network.find("a.AS1")
+        >>> node_b = inet.network.find("b.AS2")
+        >>> pol_parser = ank.BgpPolicyParser(inet.network)
+        >>> pol_parser.select_sessions(set([node_a]), set([node_a, node_b]))
+        [(a.AS1, b.AS2)]
+        >>> pol_parser.select_sessions(set([node_a, node_b]), set([node_a]))
+        [(b.AS2, a.AS1)]
+        >>> pol_parser.select_sessions(set(["n0"]), set([node_a]))
+        []
+        """
+        g_session = self.network.g_session
+        if len(src_set) <= len(dst_set):
+            return [(u, v) for u in src_set if u in g_session
+                    for v in g_session.succ[u] if v in dst_set]
+        else:
+            return [(u, v) for v in dst_set if v in g_session
+                    for u in g_session.pred[v] if u in src_set]
+
     def evaluate_node_stack(self, stack):
         """Evaluates a stack of nodes with join queries"""
         LOG.debug("Evaluating node stack %s" % stack)
@@ -471,6 +726,31 @@ class BgpPolicyParser:
             op = stack.pop()
             return self._opn[op](a, self.evaluate_node_stack(stack))
 
+    def query_key(self, query):
+        """Normalised, hashable form of a parsed node select query.
+        Whitespace differences in the policy file map to the same key.
+
+        >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
+        >>> pol_parser.query_key(pol_parser.nodeQuery.parseString("asn=1 & Network = AS2"))
+        (('asn', '=', 1.0), '&', ('Network', '=', 'AS2'))
+        >>> pol_parser.query_key(pol_parser.nodeQuery.parseString("*"))
+        ('*',)
+        """
+        return tuple(token if isinstance(token, basestring) else tuple(token)
+                for token in query)
+
+    def clear_node_select_cache(self):
+        """Discards memoised node selections
+        
+        >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
+        >>> pol_parser.node_select_query("asn = 1")
+        set(['n0', 'n1', 'n3'])
+        >>> pol_parser.clear_node_select_cache()
+        >>> pol_parser.node_select_query("asn = 1")
+        set(['n0', 'n1', 'n3'])
+        """
+        self._node_select_cache = {}
+
     def node_select_query(self, qstring):
         """
         >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
@@ -480,13 +760,38 @@ class BgpPolicyParser:
         set([])
         >>> pol_parser.node_select_query("name = a_b")
         set([])
+
+        Results are memoised per parser, and reselected once the network
+        records a change:
+
+        >>> pol_parser.network.graph.node['n0']['asn'] = 2
+        >>> pol_parser.network.changed()
+        >>> pol_parser.node_select_query("asn=1")
+        set(['n1', 'n3'])
+        >>> pol_parser.network.graph.remove_node('n1')
+        >>> pol_parser.network.changed()
+        >>> pol_parser.node_select_query("asn=1")
+        set(['n3'])
         """
-        LOG.debug("Processing node select query %s" % qstring)
+        LOG.debug("Processing node select query %s" % (qstring,))
         if isinstance(qstring, str):
-            result = self.nodeQuery.parseString(qstring)
+            query_key = self.query_key(self.nodeQuery.parseString(qstring))
+        elif isinstance(qstring, tuple):
+# already normalised, eg from a parsed policy line
+            query_key = qstring
         else:
 # don't parse as likely came from edge parser
-            result = qstring
+            query_key = self.query_key(qstring)
+
+        version = self.network.version
+        try:
+            (cached_version, cached_set) = self._node_select_cache[query_key]
+            if cached_version == version:
+# copy so callers can't modify the memoised set
+                return set(cached_set)
+            LOG.debug("Network changed, reselecting %s" % (query_key,))
+        except KeyError:
+            pass
 
 #TODO: rearrange so remove stack and iterate over nodes only once
 # so execute the boolean as function, rather than using stack on node sets
@@ -494,41 +799,45 @@ class BgpPolicyParser:
 # and use data(=True) so get the dictionary reference once -> faster
 # especially if using short circuits so when False stop executing
 
-        def comp_fn_string(token, n):
+        def comp_fn_string(comparison, attribute, value, n):
             #TODO: allow partial string matches - beginswith, endswith, etc - map to python functions
-            return self._opn[token.comparison](self.network.graph.node[n].get(token.attribute), token.value)
+            return self._opn[comparison](self.network.graph.node[n].get(attribute), value)
 
-        def comp_fn_numeric(token, n):
-            return self._opn[token.comparison](float(self.network.graph.node[n].get(token.attribute)), token.value)
+        def comp_fn_numeric(comparison, attribute, value, n):
+            return self._opn[comparison](float(self.network.graph.node[n].get(attribute)), value)
 
         stack = []
 
-        for token in result:
-            if token in self._boolean:
+        for token in query_key:
+            if token in self._booleans:
                 stack.append(token)
                 continue
 
 # different function depending on value type: numeric or string
-            if token == self.wildcard:
+            if token == self.wildcard_token:
                 result_set = set(n for n in self.network.routers() )
                 stack.append(result_set)
                 continue
-            elif token.attribute == "node":
-                result_set = set([token.value])
+
+            (attribute, comparison, value) = token
+            if attribute == "node":
+                result_set = set([value])
                 stack.append(result_set)
                 continue
-            elif isinstance(token.value, str):
+            elif isinstance(value, str):
                 comp_fn = comp_fn_string
-            elif isinstance(token.value, float):
+            elif isinstance(value, float):
                 comp_fn = comp_fn_numeric
         
             if comp_fn:
                 #TODO: change to generator expressions and evaluate as sets in the evaluate function
                 result_set = set(n for n in self.network.graph 
-                        if token.attribute in self.network.graph.node[n] and comp_fn(token, n) )
+                        if attribute in self.network.graph.node[n] 
+                        and comp_fn(comparison, attribute, value, n) )
                 stack.append(result_set)
 
         final_set = self.evaluate_node_stack(stack)
+        self._node_select_cache[query_key] = (version, frozenset(final_set))
         return final_set
 
     def allocate_tags(self):
@@ -541,7 +850,22 @@ class BgpPolicyParser:
 
 
     def get_prefixes(self, nodes):
-        """Return prefixes for given node set"""
+        """Return prefixes for given node set, aggregated into a minimal covering set
+
+        >>> inet = ank.internet.Internet("multias") 
+        >>> inet.compile()
+        >>> pol_parser = ank.BgpPolicyParser(inet.network)
+        >>> pol_parser.get_prefixes(pol_parser.node_select_query("asn = 2"))
+        [10.0.0.28/30, 10.1.0.0/16 ge 30 le 30]
+        >>> pol_parser.get_prefixes(pol_parser.node_select_query("asn = 1"))
+        [10.0.0.0/16 ge 30 le 30]
+        >>> pol_parser.get_prefixes([inet.network.find("1b.AS1")])
+        [10.0.0.8/29 ge 30 le 30, 10.0.0.20/30]
+        """
+        return self.aggregate_prefixes(self.link_subnets(nodes))
+
+    def link_subnets(self, nodes):
+        """Return the set of link subnets for given node set"""
         LOG.debug("Returning prefixes for nodes %s" % nodes)
         prefixes = set()
         for node in nodes:
@@ -549,9 +873,70 @@ class BgpPolicyParser:
             prefixes.update([data.get("sn")
                 for u, v, data in self.network.graph.out_edges(node, data=True) 
                 if data.get("sn")])
-
         return prefixes
 
+    def subnet_blocks(self):
+        """Maps each link subnet to the AS block (from ip_as_allocs) it was allocated from,
+        and each AS block to the link subnets allocated from it"""
+        ip_as_allocs = self.network.ip_as_allocs or {}
+        subnet_block = {}
+        block_subnets = defaultdict(set)
+        for src, dst, data in self.network.graph.edges_iter(data=True):
+            subnet = data.get("sn")
+            if not subnet:
+                continue
+# eBGP link subnets are allocated from the AS block of one end only
+            if data.get("remote_as_sn_block"):
+                block = ip_as_allocs.get(self.network.asn(dst))
+            else:
+                block = ip_as_allocs.get(self.network.asn(src))
+            if block and subnet in block:
+                subnet_block[subnet] = block
+                block_subnets[block].add(subnet)
+
+        return subnet_block, block_subnets
+
+    def aggregate_prefixes(self, prefixes):
+        """Aggregates prefixes into a sorted list of prefix list entries.
+        If the prefixes contain every link subnet of an AS block, the AS block is used,
+        otherwise adjacent prefixes of the same length are merged.
+        Aggregates have ge and le set so they only match the prefixes they cover.
+
+        >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
+        >>> pol_parser.aggregate_prefixes([netaddr.IPNetwork("10.0.0.0/30"),
+        ...     netaddr.IPNetwork("10.0.0.4/30"), netaddr.IPNetwork("10.0.0.8/29")])
+        [10.0.0.0/29 ge 30 le 30, 10.0.0.8/29]
+        """
+        subnet_block, block_subnets = self.subnet_blocks()
+        retval = []
+
+        prefixes_by_block = defaultdict(set)
+        remaining = set()
+        for prefix in prefixes:
+            block = subnet_block.get(prefix)
+            if block:
+                prefixes_by_block[block].add(prefix)
+            else:
+                remaining.add(prefix)
+
+        for block, block_prefixes in prefixes_by_block.items():
+            if block_prefixes == block_subnets[block]:
+                retval.append(prefix_list_entry.covering(block,
+                    [prefix.prefixlen for prefix in block_prefixes]))
+            else:
+                remaining.update(block_prefixes)
+
+# Merging different lengths would also match the unlisted prefixes of each
+# length within the merged prefix, eg /30s within a listed /29
+        by_length = defaultdict(list)
+        for prefix in remaining:
+            by_length[prefix.prefixlen].append(prefix)
+        for prefixlen, length_prefixes in by_length.items():
+            for prefix in netaddr.cidr_merge(length_prefixes):
+                retval.append(prefix_list_entry.covering(prefix, [prefixlen]))
+
+        return sorted(retval)
+
     def query_to_tag(self, query):
         """ flattens a node select query into a tag
         """
@@ -589,8 +974,9 @@ class BgpPolicyParser:
             if tag_pl in self.prefix_lists:
                 LOG.debug( "already executed prefix lookup for %s" % tag_pl)
             else:
-                prefixes = self.get_prefixes(nodes)
-                self.prefix_lists[tag_pl] = prefixes
+                subnets = self.link_subnets(nodes)
+                self.prefix_subnets[tag_pl] = sorted(subnets)
+                self.prefix_lists[tag_pl] = self.aggregate_prefixes(subnets)
 # and mark prefixes
                 policy = "(if prefix_list = %s then addTag %s)" % (tag_pl, tag_cl)
                 LOG.debug("Origin policy: %s" % policy)
@@ -600,8 +986,7 @@ class BgpPolicyParser:
 
         if policy:
             # Parse the string into policy tuples
-            parsed = self.bgpSessionQuery.parseString(policy)
-            per_session_policy = self.process_if_then_else(parsed.bgpSessionQuery)
+            per_session_policy = self.resolve_session_clauses(self.parse_session_query(policy))
 
             for node in nodes:
                 for u, v in self.network.g_session.out_edges(node):
@@ -609,9 +994,25 @@ class BgpPolicyParser:
                     self.network.g_session[u][v]['egress'].append(per_session_policy)
         return match_clause("tag", "=", tag_cl)
 
+    def parse_session_query(self, policy):
+        """Parses a session query into match tuples, memoised per query"""
+        try:
+            return self._parsed_session_queries[policy]
+        except KeyError:
+            parsed = self.bgpSessionQuery.parseString(policy)
+            clauses = self.session_query_clauses(parsed.bgpSessionQuery)
+            self._parsed_session_queries[policy] = clauses
+            return clauses
+
     def process_if_then_else(self, parsed_query):
         """Processes if-then-else query"""
         LOG.debug("Processing if-then-else query %s" % parsed_query)
+        return self.resolve_session_clauses(self.session_query_clauses(parsed_query))
+
+    def session_query_clauses(self, parsed_query):
+        """Converts a parsed if-then-else query into match tuples.
+        Origin and Transit matches are left unresolved, with their node query
+        normalised, as resolving them depends on the network"""
         retval = []
 
         for token in parsed_query:
@@ -633,11 +1034,10 @@ class BgpPolicyParser:
             else:
                 #TODO: check is in ifthen
                 (if_clause, then_clause) = token
-#TODO: base this on the keywords used in the parser itself for continuity
-                origin_transit_keywords = set(["Origin", "Transit"])
 # Check for reject
                 if_tuples = [
-                        self.proc_ot_match(attribute, value) if attribute in origin_transit_keywords
+                        match_clause(attribute, comparison, self.query_key(value))
+                        if attribute in self.origin_transit_keywords
                         else match_clause(attribute, comparison, value)
                         for (attribute, comparison, value) in if_clause]
                 reject = any(True for (action, value) in then_clause if action == self.reject)
@@ -647,13 +1047,27 @@ class BgpPolicyParser:
                 retval.append(match_tuple(if_tuples, then_tuples, reject))
         return retval
 
+    def resolve_session_clauses(self, session_clauses):
+        """Resolves Origin and Transit matches in parsed match tuples against the network"""
+        retval = []
+        for session_clause in session_clauses:
+            if any(m.type in self.origin_transit_keywords for m in session_clause.match_clauses):
+                session_clause = session_clause._replace(match_clauses = [
+                    self.proc_ot_match(m.type, m.value) if m.type in self.origin_transit_keywords
+                    else m
+                    for m in session_clause.match_clauses])
+            retval.append(session_clause)
+        return retval
+
     def cl_and_pl_per_node(self):
         """extract tags and prefixes used from sessions
         Also applies sequence numbers to match clauses"""
         LOG.debug("Extracting community lists and prefix lists per node, adding sequence numbers")
+        clear_compiled_bgp_policy(self.network)
 # Store in g_session for future use
         self.network.g_session.graph['tags'] = self.allocated_tags
         self.network.g_session.graph['prefixes'] = self.prefix_lists
+        self.network.g_session.graph['prefix_subnets'] = self.prefix_subnets
         for node in self.network.g_session:
             prefixes = set()
             tags = set()
@@ -714,9 +1128,45 @@ class BgpPolicyParser:
 # and update the global list of tags with any new tags found
             self.tags_to_allocate.update(tags)
 
+    def share_route_maps(self):
+        """Route maps with identical bodies applied by a router to several
+        sessions are given a common name, so they are only emitted once.
+        Route maps used on a single session keep their name."""
+        LOG.debug("Sharing identical route maps per node")
+        clear_compiled_bgp_policy(self.network)
+        g_session = self.network.g_session
+        fqdn = self.network.fqdn
+        for node in g_session:
+# Route maps are applied by the receiving router on ingress, and the sending router on egress
+            sessions = sorted(
+                    [(fqdn(peer), 'ingress', peer, node) for peer in g_session.predecessors(node)] +
+                    [(fqdn(peer), 'egress', node, peer) for peer in g_session.successors(node)])
+            route_map_users = defaultdict(list)
+            first_use = []
+            for (_, direction, src, dst) in sessions:
+                for index, route_map in enumerate(g_session[src][dst][direction]):
+                    key = (direction, route_map_body(route_map.match_tuples))
+                    if key not in route_map_users:
+                        first_use.append(key)
+                    route_map_users[key].append((src, dst, index))
+
+            shared_id = defaultdict(lambda: itertools.count(1))
+            for key in first_use:
+                users = route_map_users[key]
+                if len(users) == 1:
+                    continue
+                direction = key[0]
+                shared_name = "rm_%s_shared_%s" % (direction, shared_id[direction].next())
+                LOG.debug("Sharing %s route map %s on %s across %s sessions" % (direction,
+                    shared_name, fqdn(node), len(users)))
+                for (src, dst, index) in users:
+                    route_map = g_session[src][dst][direction][index]
+                    g_session[src][dst][direction][index] = route_map._replace(name = shared_name)
+
     def store_tags_per_router(self):
         """Stores the list of tags/community value mappings in the router in session graph"""
         LOG.debug("Storing allocated tags to routers")
+        clear_compiled_bgp_policy(self.network)
         for node, data in self.network.g_session.nodes(data=True):
             tags = dict( (tag, self.allocated_tags[tag]) for tag in data['tags'])
             self.network.g_session.node[node]['tags'] = tags
@@ -726,40 +1176,43 @@ class BgpPolicyParser:
             self.network.g_session.node[node]['prefixes'] = prefixes
 
     def rewrite_bgp_query_local_tags(self, query, function_name):
-# rewrites any tags not defined  as globals
-#TODO: make cleaner - ie not regex - pass parameter to parser/query and do rewrite as user defined function??
-        query_processed = query
+        """Rewrites any tags not defined as globals to be local to the function
 
+        >>> pol_parser = ank.BgpPolicyParser(ank.network.Network(ank.load_example("multias")))
+        >>> pol_parser.user_defined_functions['fn'] = {'global_tags': ['glob']}
+        >>> pol_parser.rewrite_bgp_query_local_tags("(if tag = abc then addTag glob & addTag def)", "fn")
+        '(if tag = fn_fn_abc then addTag glob & addTag fn_fn_def)'
+        """
+#TODO: make cleaner - ie not regex - pass parameter to parser/query and do rewrite as user defined function??
 # default to empty set if no globals defined
         function_globals = self.user_defined_functions[function_name].get('global_tags') or set()
-        captures = ["(tag = (\w+\.*\_*)*)", "(addTag (\w+\.*\_*)*)", "(tags contain (\w+\.*\_*)*)"]
-        for capture in captures:
-            results = re.findall(capture, query)
-            for result in results:
-                search_string = result[0]
-                tag = result[1]
-                if tag not in function_globals:
-                    new_tag = "fn_%s_%s" % (function_name, tag)
-                    replace_string = search_string.replace(tag, new_tag)
-                    LOG.debug("Replacing non-global tag %s with %s in %s" % (tag, new_tag, function_name))
-# Now replace in query  
-                    query_processed = query_processed.replace(search_string, replace_string)
-                else:
-                    LOG.debug("Keeping global tag %s in %s" % (tag, function_name))
+        def rewrite_tag(match):
+            (keyword, tag) = match.groups()
+            if tag in function_globals:
+                LOG.debug("Keeping global tag %s in %s" % (tag, function_name))
+                return match.group(0)
+            new_tag = "fn_%s_%s" % (function_name, tag)
+            LOG.debug("Replacing non-global tag %s with %s in %s" % (tag, new_tag, function_name))
+            return keyword + new_tag
 
-        return query_processed 
+        return self._local_tag_re.sub(rewrite_tag, query)
 
     def parse_user_def_functions(self, library_file):
-        """Note you need a blank newline after a function definition"""
+        """Note you need a blank newline after a function definition.
+        Lines that fail to parse are skipped, and the rest of the file parsed."""
         try:
-            with open( library_file, 'r') as f_lib:
-                library_data = f_lib.read()
+            f_lib = open( library_file, 'r')
+        except IOError:
+            LOG.warn("Unable to open library file: %s" % library_file)
+            return
 
+        with f_lib:
 #TODO: use named tuple for functions, and for library entries
             """TODO: make the function definition single grammar, use
             http://pyparsing.wikispaces.com/file/view/indentedGrammarExample.py"""
             current_function_def = None
-            for line in library_data.splitlines():
+            for line_number, line in enumerate(f_lib, 1):
+                line = line.rstrip("\r\n")
                 if line.startswith("#"):
                     LOG.debug("Skipping commented line %s", line)
                     continue
@@ -773,48 +1226,49 @@ class BgpPolicyParser:
 # function has been started, and indented so try as a library entry
                         try:
                             results = self.library_entry.parseString(line)
-                            if results.global_tags:
-                                global_tags = [tag for tag in results.global_tags.tags]
-                                self.user_defined_functions[current_function_def]['global_tags'] = global_tags
-                                continue
-                            else:
-#TODO: for efficiency, could save the already parsed query here
+                        except pyparsing.ParseBaseException:
+                            LOG.warn("Unable to parse %s line %s: %s" % (library_file,
+                                line_number, line.strip()))
+                            continue
+                        if results.global_tags:
+                            global_tags = [str(tag) for tag in results.global_tags.tags]
+                            self.user_defined_functions[current_function_def]['global_tags'] = global_tags
+                        else:
 #TODO: remove this dodgy hack! - as want to be overlay, so don't parse here???
-                                bgp_query = line.split(":")[1]
-                                bgp_query = self.rewrite_bgp_query_local_tags(bgp_query, current_function_def)
-                                library_entry = {
-                                        'query_a': results.query_a, 
-                                        'edge_type': results.edgeType,
-                                        'query_b': results.query_b,
-                                        'bgp_query': bgp_query,
-                                }
-                                self.user_defined_functions[current_function_def]['entries'].append(library_entry)
+                            bgp_query = line.split(":")[1]
+                            bgp_query = self.rewrite_bgp_query_local_tags(bgp_query, current_function_def)
+                            library_entry = {
+                                    'query_a': str(results.query_a), 
+                                    'edge_type': str(results.edgeType),
+                                    'query_b': str(results.query_b),
+                                    'bgp_query': bgp_query,
+                            }
+                            self.user_defined_functions[current_function_def]['entries'].append(library_entry)
 # finished with this line
-                            continue
-                        except pyparsing.ParseFatalException:
-                            print "unable to parse indented line:", line
-                            current_function_def = None
-                else:
-                    try:
-                        results = self.library_def.parseString(line)
-                        current_function_def = results.def_name
-                        self.user_defined_functions[current_function_def] = {
-                                'params': [a for a in results.def_params],
-                                'entries': [],
-                                }
                         continue
-                    except pyparsing.ParseFatalException:
-                        pass
+                    LOG.debug("Skipping unindented %s line %s in %s: %s" % (library_file,
+                        line_number, current_function_def, line))
+                    continue
 
-            for function_name, function_data in self.user_defined_functions.items():
-                params = function_data['params']
+                try:
+                    results = self.library_def.parseString(line)
+                except pyparsing.ParseBaseException:
+                    if line.strip():
+                        LOG.debug("Skipping %s line %s: %s" % (library_file, line_number, line))
+                    continue
+                current_function_def = str(results.def_name)
+                self.user_defined_functions[current_function_def] = {
+                        'params': [p if isinstance(p, basestring) else [str(e) for e in p]
+                            for p in results.def_params],
+                        'entries': [],
+                        }
+
+        for function_name, function_data in self.user_defined_functions.items():
+            params = function_data['params']
 # Store indices so can lookup when applying functions
-                param_indices = dict( (p, params.index(p)) for p in params)
-                self.user_defined_functions[function_name]['param_indices'] = param_indices
-            # and remap tags
-
-        except IOError:
-            LOG.warn("Unable to open library file: %s" % library_file)
+            param_indices = dict( (p, params.index(p)) for p in params
+                    if isinstance(p, basestring))
+            self.user_defined_functions[function_name]['param_indices'] = param_indices
 
     def apply_user_library_calls(self):
             f_library_debug = open( os.path.join(config.log_dir, "library_dump.txt"), "w")
@@ -885,62 +1339,126 @@ class BgpPolicyParser:
                         policy_line = "(%s = %s) %s (%s = %s): %s" % (attribute_a, val_a, edge_type, attribute_b, val_b, bgp_query)
                         LOG.debug("Policy: %s" % policy_line)
                         f_library_debug.write(policy_line + "\n")
-                        self.apply_bgp_policy(policy_line)
+                        try:
+                            self.apply_bgp_policy(policy_line)
+                        except pyparsing.ParseBaseException:
+                            LOG.warn("Unable to parse policy %s from function %s" % (policy_line, name))
             f_library_debug.close()
 
+    def policy_file_lines(self, policy_file):
+        """Yields (filename, line number, line) for each policy line in policy_file,
+        skipping blank and commented lines"""
+        with open( policy_file, 'r') as f_pol:
+            for line_number, line in enumerate(f_pol, 1):
+                line = line.strip()
+                if line.startswith("#"):
+                    LOG.debug("Skipping commented line %s", line)
+                    continue
+                if line == "":
+                    continue
+                yield (policy_file, line_number, line)
+
     def load_include_file(self, include_file):
-        retval = []
+        """Yields policy lines from include_file, as for policy_file_lines"""
         try:
-            with open( include_file, 'r') as f_include:
-                for line in f_include.readlines():
-                    retval.append(line.strip())
+            for policy_line in self.policy_file_lines(include_file):
+                yield policy_line
         except IOError:
             LOG.warn("Unable to load include file: %s" % include_file)
-        return retval
 
-    def apply_policy_file(self, policy_in_file):
-        """Applies a BGP policy file to the network"""
+    def policy_cache_file(self, source_files):
+        """Returns the cache file for parsed policy from source_files, a list of
+        (role, filename) tuples. Keyed on file contents and parser version, so
+        stale entries are never used. None if caching is unavailable."""
+        if not cache.cache_dir():
+            return None
+        roles = [role for (role, source_file) in source_files]
+        key = cache.content_key([source_file for (role, source_file) in source_files],
+                POLICY_PARSER_VERSION, pyparsing.__version__, roles)
+        return cache.cache_file("policy", key)
+
+    def load_policy_cache(self, cache_file):
+        """Loads parsed library functions and policy lines from cache_file.
+        Returns True if the cache was used."""
+        cached = cache.load(cache_file)
+        if cached is None:
+            return False
+        LOG.debug("Loaded parsed policy from cache %s" % cache_file)
+        self.user_defined_functions.update(cached['functions'])
+        self._parsed_lines.update(cached['lines'])
+        self._parsed_session_queries.update(cached['session_queries'])
+        return True
+
+    def save_policy_cache(self, cache_file):
+        """Writes parsed library functions and policy lines to cache_file."""
+        cache.save(cache_file, {
+                'functions': self.user_defined_functions,
+                'lines': self._parsed_lines,
+                'session_queries': self._parsed_session_queries,
+                })
+
+    def apply_policy_file(self, policy_in_file, use_cache = True):
+        """Applies a BGP policy file to the network.
+        Parsed policy is cached on disk, keyed on the contents of the policy file
+        and any libraries and include files it uses.
+        Lines that fail to parse are logged and skipped."""
         LOG.debug("Applying policy file %s" % policy_in_file)
-        policy_lines = []
+        library_files = []
+        source_files = [("policy", policy_in_file)]
         import_library = "importLibrary"
         include = "includePolicy"
         pol_path = os.path.split(policy_in_file)[0]
-        with open( policy_in_file, 'r') as f_pol:
-            for line in f_pol.readlines():
-                line = line.strip()
-                if line.startswith("#"):
-                    LOG.debug("Skipping commented line %s", line)
-                    continue
-                if line == "":
-                    continue
-                if line.startswith(import_library):
-                    library_file = line.replace(import_library, "").strip()
-                    library_file = os.path.join(pol_path, library_file) # relative import
-                    self.parse_user_def_functions(library_file)
-                elif line.startswith(include):
-                    include_file = line.replace(include, "").strip()
-                    include_file = os.path.join(pol_path, include_file) # relative import
-                    file_contents = self.load_include_file(include_file)
-                    policy_lines += file_contents
-                else:
-                    policy_lines.append(line)
-
-#Now parse the combined files
-
-        for line in policy_lines:
-            line = line.strip()
-            if line.startswith("#"):
-                LOG.debug("Skipping commented line %s", line)
-                continue
-            if line == "":
+        def referenced_file(line, keyword):
+            return os.path.join(pol_path, line.replace(keyword, "").strip()) # relative import
+
+# First pass finds the libraries and include files, to key the cache
+        policy_lines = list(self.policy_file_lines(policy_in_file))
+        for (source_file, line_number, line) in policy_lines:
+            if line.startswith(import_library):
+                library_file = referenced_file(line, import_library)
+                library_files.append(library_file)
+                source_files.append(("library", library_file))
+            elif line.startswith(include):
+                source_files.append(("include", referenced_file(line, include)))
+
+# Check libraries before the cache, so a missing library is reported on cache hits too
+        for library_file in library_files:
+            if not os.path.isfile(library_file):
+                LOG.warn("Unable to open library file: %s" % library_file)
+        library_files = [library_file for library_file in library_files
+                if os.path.isfile(library_file)]
+
+        cache_file = None
+        cache_hit = False
+        if use_cache:
+            cache_file = self.policy_cache_file(source_files)
+            if cache_file:
+                cache_hit = self.load_policy_cache(cache_file)
+        if not cache_hit:
+            for library_file in library_files:
+                self.parse_user_def_functions(library_file)
+
+# Now apply the policy lines, expanding include files in place
+        for (source_file, line_number, line) in policy_lines:
+            if line.startswith(import_library):
                 continue
-            try:
-                self.apply_bgp_policy(line)
-            except pyparsing.ParseFatalException as e:
-                LOG.warn("Unable to parse query line %s" % line)
+            if line.startswith(include):
+                expanded_lines = self.load_include_file(referenced_file(line, include))
+            else:
+                expanded_lines = [(source_file, line_number, line)]
+            for (source_file, line_number, line) in expanded_lines:
+                try:
+                    self.apply_bgp_policy(line)
+                except pyparsing.ParseBaseException:
+                    LOG.warn("Unable to parse query line %s line %s: %s" % (source_file,
+                        line_number, line))
 
         self.apply_user_library_calls()
+        if cache_file and not cache_hit:
+            self.save_policy_cache(cache_file)
+
         self.cl_and_pl_per_node()
+        self.share_route_maps()
         self.allocate_tags()
         self.store_tags_per_router()
-
+        compile_bgp_policy(self.network)
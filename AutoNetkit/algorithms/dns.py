@@ -58,6 +58,8 @@ __all__ = ['allocate_dns_servers', 'get_dns_graph',
         'dns_clients', 'dns_auth_children',
         'dns_cache_servers',
         'dns_hiearchy_children', 'dns_hiearchy_parents',
+        'build_dns_role_index', 'is_dns_server',
+        'set_dns_level',
         'reverse_subnet', 'rev_dns_identifier']
 
 import AutoNetkit as ank
@@ -65,12 +67,89 @@ import networkx as nx
 from netaddr import IPAddress, IPNetwork
 import pprint
 import itertools
+from collections import defaultdict, namedtuple
 import AutoNetkit.config as config
 
 
 import logging
 LOG = logging.getLogger("ANK")
 
+# Number of BFS per graph used to estimate eccentricities for approximate placement
+APPROXIMATE_PLACEMENT_BFS = 10
+
+def graph_eccentricities(graph, max_bfs = None):
+    """Eccentricity of each node, for ranking DNS server attach points.
+
+    Uses the bounding method of Takes and Kosters: a BFS from a node gives
+    its exact eccentricity, and lower and upper bounds on the eccentricity of
+    every other node. Nodes whose bounds meet are resolved without their own
+    BFS, so typically only a few BFS are needed rather than one per node.
+    If max_bfs is set, stops after that many BFS, and unresolved nodes are
+    estimated by their lower bound.
+    Directed graphs that are not symmetric fall back to nx.eccentricity.
+
+    >>> graph = nx.path_graph(5)
+    >>> graph_eccentricities(graph) == nx.eccentricity(graph)
+    True
+    >>> graph = ank.load_example("multias")
+    >>> graph_eccentricities(graph) == nx.eccentricity(graph)
+    True
+    >>> sorted(graph_eccentricities(nx.path_graph(5), max_bfs = 1).items())
+    [(0, 4), (1, 3), (2, 2), (3, 2), (4, 3)]
+    """
+    if graph.is_directed() and not all(graph.has_edge(dst, src)
+            for (src, dst) in graph.edges_iter()):
+        return nx.eccentricity(graph)
+
+    order = len(graph)
+    degree = dict( (n, len(graph[n])) for n in graph)
+# fixed order for tie-breaks, so choice of BFS source is deterministic
+    node_rank = dict( (n, index) for index, n in enumerate(sorted(graph, key = str)))
+    lower = dict( (n, 0) for n in graph)
+    upper = dict( (n, order) for n in graph)
+    eccentricities = {}
+    unresolved = set(graph)
+# a leaf is one hop further than its neighbor from every other node
+    leaves = {}
+    if order > 2:
+        leaves = dict( (n, graph[n].keys()[0]) for n in graph if degree[n] == 1)
+        unresolved -= set(leaves)
+    bfs_count = 0
+    use_upper = True
+    while unresolved:
+        if max_bfs is not None and bfs_count >= max_bfs:
+            break
+# alternate between largest upper bound and smallest lower bound, preferring high degree
+        if use_upper:
+            source = max(unresolved, key = lambda n: (upper[n], degree[n], -node_rank[n]))
+        else:
+            source = min(unresolved, key = lambda n: (lower[n], -degree[n], node_rank[n]))
+        use_upper = not use_upper
+
+        lengths = nx.single_source_shortest_path_length(graph, source)
+        bfs_count += 1
+        if len(lengths) != order:
+            raise nx.NetworkXError("Graph not connected: infinite path length")
+        source_eccentricity = max(lengths.values())
+
+        resolved = [source]
+        lower[source] = upper[source] = source_eccentricity
+        for node in unresolved:
+            distance = lengths[node]
+            lower[node] = max(lower[node], source_eccentricity - distance, distance)
+            upper[node] = min(upper[node], source_eccentricity + distance)
+            if lower[node] == upper[node]:
+                resolved.append(node)
+        for node in resolved:
+            eccentricities[node] = lower[node]
+            unresolved.discard(node)
+
+    for node in unresolved:
+        eccentricities[node] = lower[node]
+    for leaf, neighbor in leaves.items():
+        eccentricities[leaf] = eccentricities[neighbor] + 1
+    return eccentricities
+
 def allocate_dns_servers(network):
     """Allocates DNS according to rules defined above
     
@@ -96,12 +175,17 @@ def allocate_dns_servers(network):
         return
 
 
+# Approximate placement bounds the number of BFS per graph, exact resolves all eccentricities
+    max_bfs = None
+    if config.settings['DNS']['placement'] == 'approximate':
+        max_bfs = APPROXIMATE_PLACEMENT_BFS
+
     def nodes_by_eccentricity(graph):
         if len(graph) == 1:
             return graph.nodes()
 # need to crop the global shortest paths otherwise get 
 #NetworkXError: Graph not connected: infinite path length
-        eccentricities = nx.eccentricity(graph)
+        eccentricities = graph_eccentricities(graph, max_bfs)
 # sort nodes by name, stability sort ensures that lexical order is used as tie-breaker for equal eccen.
         nodes_sorted = sorted(graph.nodes(), key = lambda x: x.fqdn)
         return sorted(nodes_sorted, key = lambda n: eccentricities[n])
@@ -183,25 +267,37 @@ def allocate_dns_servers(network):
         
     # now connect
 #TODO: scale to handle multiple levels same as ibgp (see doco at start for details)
+# bucket devices by level and cluster, so only pairs that are connected are visited
+    l2_cluster_buckets = defaultdict(list)
+    l3_cluster_buckets = defaultdict(list)
+    level_buckets = defaultdict(list)
+    for node in dns_graph:
+        node_level = level(node)
+        level_buckets[node_level].append(node)
+        l3_cluster = get_l3_cluster(node)
+        if l3_cluster is None:
+            continue
+        l3_cluster_buckets[(node_level, l3_cluster)].append(node)
+        l2_cluster = get_l2_cluster(node)
+        if l2_cluster is not None:
+            l2_cluster_buckets[(node_level, l3_cluster, l2_cluster)].append(node)
+
     edges_to_add = []
-    all_edges = [ (s,t) for s in dns_graph for t in dns_graph if s != t]
-    same_l3_cluster_edges = [ (s,t) for (s,t) in all_edges if 
-                    get_l3_cluster(s) == get_l3_cluster(t) != None]
-    same_l2_cluster_edges = [ (s,t) for (s,t) in same_l3_cluster_edges if 
-                    get_l2_cluster(s) == get_l2_cluster(t) != None]
-    
 # l1 -> l2 same l2 cluster
-    edges_to_add += [(s,t, 'up') for (s,t) in same_l2_cluster_edges
-            if level(s) == 1 and level(t) == 2]
+    for (node_level, l3_cluster, l2_cluster), clients in l2_cluster_buckets.items():
+        if node_level == 1:
+            servers = l2_cluster_buckets.get((2, l3_cluster, l2_cluster), [])
+            edges_to_add += [(s,t, 'up') for s in clients for t in servers]
     # l2 -> l2 ???
 
 # l2 -> l3
-    edges_to_add += [(s,t, 'up') for (s,t) in same_l3_cluster_edges
-            if level(s) == 2 and level(t) == 3]
+    for (node_level, l3_cluster), clients in l3_cluster_buckets.items():
+        if node_level == 2:
+            servers = l3_cluster_buckets.get((3, l3_cluster), [])
+            edges_to_add += [(s,t, 'up') for s in clients for t in servers]
 
 # l3 -> l4
-    edges_to_add += [(s,t, 'up') for (s,t) in all_edges
-            if level(s) == 3 and level(t) == 4]
+    edges_to_add += [(s,t, 'up') for s in level_buckets[3] for t in level_buckets[4]]
     
     # format into networkx format
     edges_to_add = ( (s,t, {'dns_dir': dns_dir}) for (s, t, dns_dir) in edges_to_add)
@@ -275,6 +371,62 @@ def allocate_dns_servers(network):
 
     network.g_dns = dns_graph
     network.g_dns_auth = dns_advertise_graph
+    build_dns_role_index(network)
+
+class dns_role_index (namedtuple('dns_role_index',
+    'levels, servers, server_set, clients, auth_children, auth_servers, advertise_links')):
+    """DNS roles of devices, precomputed from the DNS and DNS auth graphs"""
+    __slots__ = ()
+    def __repr__(self):
+        return "levels %s auth servers %s" % (sorted( (level, len(nodes))
+            for level, nodes in self.levels.items()), self.auth_servers)
+
+def build_dns_role_index(network):
+    """Builds the DNS role index, stored on the DNS graph with the network
+    version it was built at, so it is rebuilt once the network changes.
+    Servers and clients are in DNS graph order.
+
+    >>> network = ank.example_multi_as()
+    >>> build_dns_role_index(network)
+    levels [] auth servers []
+    """
+    g_dns = network.g_dns
+    g_dns_auth = network.g_dns_auth
+    levels = defaultdict(list)
+    for node, data in g_dns.nodes_iter(data=True):
+        levels[data.get("level")].append(node)
+    servers = [n for n in g_dns.nodes_iter() if g_dns.node[n].get("level") > 1]
+
+    auth_children = dict( (n, g_dns_auth.predecessors(n)) for n in g_dns_auth)
+    auth_servers = [n for n in servers if len(auth_children.get(n, []))]
+    advertise_links = {}
+    for server in auth_servers:
+        auth_subgraph = network.graph.subgraph(auth_children[server])
+        advertise_links[server] = [ank.network.link_namedtuple(network, src, dst)
+                for (src, dst) in auth_subgraph.edges()]
+
+    index = dns_role_index(dict(levels), servers, frozenset(servers), levels.get(1, []),
+            auth_children, auth_servers, advertise_links)
+    g_dns.graph['role_index'] = (network.version, index)
+    return index
+
+def get_dns_role_index(network):
+    """Returns the DNS role index, rebuilding it if the network has changed
+
+    >>> network = ank.example_multi_as()
+    >>> router = network.find("1a.AS1")
+    >>> network.g_dns.add_node(router, level=2)
+    >>> network.changed()
+    >>> get_dns_role_index(network)
+    levels [(2, 1)] auth servers []
+    """
+    try:
+        (version, index) = network.g_dns.graph['role_index']
+        if version == network.version:
+            return index
+    except KeyError:
+        pass
+    return build_dns_role_index(network)
 
 def dns_advertise_link(src, dst):
 # find servers responsible for src
@@ -289,6 +441,7 @@ def dns_hiearchy_parents(node):
 
 def add_dns_auth_child(parent, child):
     parent.network.g_dns_auth.add_edge(child, parent)
+    parent.network.changed()
   
 def dns_auth_parents(node):
     """Handles case of no parents having been allocated"""
@@ -298,15 +451,24 @@ def dns_auth_parents(node):
         return []
 
 def dns_auth_children(node):
-    return node.network.g_dns_auth.predecessors(node)
+    try:
+        return get_dns_role_index(node.network).auth_children[node]
+    except KeyError:
+        return node.network.g_dns_auth.predecessors(node)
 
 def root_dns_servers(network):
-    return (n for n in network.servers() if dns_level(n) == 4)
+    return (n for n in get_dns_role_index(network).levels.get(4, [])
+            if network.device_type(n) == 'server')
 
 def dns_cache_servers(network):
-    return (n for n in network.servers() if dns_level(n) == 2)
+    return (n for n in get_dns_role_index(network).levels.get(2, [])
+            if network.device_type(n) == 'server')
 
 def advertise_links(node):
+    try:
+        return get_dns_role_index(node.network).advertise_links[node]
+    except KeyError:
+        pass
     auth_children = dns_auth_children(node)
     auth_subgraph = node.network.graph.subgraph(auth_children)
     edges = auth_subgraph.edges()
@@ -315,11 +477,6 @@ def advertise_links(node):
     else:
         return []
 
-def is_dns_server(network, node):
-# if has children is server
-# note could also be child to own parent
-    pass
-
 def is_dns_client(network, node):
 # if has parent is client 
     # note could also be server to own children
@@ -328,17 +485,35 @@ def is_dns_client(network, node):
 def dns_level(node):
     return node.network.g_dns.node[node].get("level")
 
+def set_dns_level(node, level):
+    """Sets the DNS level of node
+
+    >>> network = ank.example_multi_as()
+    >>> router = network.find("1a.AS1")
+    >>> list(dns_servers(network))
+    []
+    >>> set_dns_level(router, 2)
+    >>> list(dns_servers(network))
+    [1a.AS1]
+    """
+    node.network.g_dns.add_node(node, level=level)
+    node.network.changed()
+
 def dns_servers(network):
-    """Servers that have DNS level > 1"""
-    return (n for n in network.g_dns.nodes_iter() if dns_level(n) > 1)
+    """Servers that have DNS level > 1, in DNS graph order"""
+    return iter(get_dns_role_index(network).servers)
+
+def is_dns_server(network, node):
+    """Constant time check if node is a DNS server"""
+    return node in get_dns_role_index(network).server_set
 
 def dns_clients(network):
     """Devices that have DNS level == 1"""
-    return (n for n in network.g_dns.nodes_iter() if dns_level(n) == 1)
+    return iter(get_dns_role_index(network).clients)
 
 def dns_auth_servers(network):
     """Servers that have auth children"""
-    return (n for n in dns_servers(network) if len(dns_auth_children(n)))
+    return iter(get_dns_role_index(network).auth_servers)
 
 def get_dns_graph(network):
     return network.g_dns
@@ -236,11 +236,18 @@ import itertools
 import os
 import pprint
 import math
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from AutoNetkit.internal import cache
 
 LOG = logging.getLogger("ANK")
 
-__all__ = ['graph_product']
+# Version of prepared H graphs, increment to invalidate cached H graphs
+H_GRAPH_CACHE_VERSION = 1
+
+# H graphs keyed on hash of file contents
+_H_graph_cache = {}
+
+__all__ = ['graph_product', 'write_graph_product']
 
 def remove_yed_edge_id(G):
     for s, t, data in G.edges(data=True):
@@ -258,83 +265,266 @@ def remove_gml_node_id(G):
             continue
     return G
 
-def graph_product(G_file):
-    
-    #TODO: take in a graph (eg when called from graphml) rather than re-reading the graph again
-    LOG.info("Applying graph product to %s" % G_file)
+def load_product_graphs(G_in, H_path = None):
+    """Returns (G, H_graphs) for G_in, either a filename or an already loaded graph,
+    or None if unable to load.
+    H graphs are loaded from H_path, which defaults to the directory of G_in
+    if a filename, or the current directory if a graph."""
     H_graphs = {}
-    try:
-        G = nx.read_graphml(G_file).to_undirected()
-    except IOError:
-        G = nx.read_gml(G_file).to_undirected()
-        return
+    if isinstance(G_in, basestring):
+        G_file = G_in
+        LOG.info("Applying graph product to %s" % G_file)
+        try:
+            G = read_graphml(G_file).to_undirected()
+        except IOError:
+            G = nx.read_gml(G_file).to_undirected()
+            return
+        if H_path is None:
+            H_path = os.path.split(G_file)[0]
+    else:
+        LOG.info("Applying graph product to %s" % G_in.name)
+        G = G_in.to_undirected()
     G = remove_yed_edge_id(G)
     G = remove_gml_node_id(G)
 #Note: copy=True causes problems if relabelling with same node name -> loses node data
     G = nx.relabel_nodes(G, dict((n, data.get('label', n)) for n, data in G.nodes(data=True)))
-    G_path = os.path.split(G_file)[0]
     H_labels  = defaultdict(list)
     for n, data in G.nodes(data=True):
         H_labels[data.get("H")].append(n)
 
     for label in H_labels.keys():
-        try:
-            H_file = os.path.join(G_path, "%s.graphml" % label)
-            H = nx.read_graphml(H_file).to_undirected()
-        except IOError:
-            try:
-                H_file = os.path.join(G_path, "%s.gml" % label)
-                H = nx.read_gml(H_file).to_undirected()
-            except IOError:
-                LOG.warn("Unable to read H_graph %s, used on nodes %s" % (H_file, ", ".join(H_labels[label])))
-                return
-        root_nodes = [n for n in H if H.node[n].get("root")]
-        if len(root_nodes):
-# some nodes have root set
-            non_root_nodes = set(H.nodes()) - set(root_nodes)
-            H.add_nodes_from( (n, dict(root=False)) for n in non_root_nodes)
-        H = remove_yed_edge_id(H)
-        H = remove_gml_node_id(H)
-        nx.relabel_nodes(H, dict((n, data.get('label', n)) for n, data in H.nodes(data=True)), copy=False)
-        H_graphs[label] = H
-
+        H_file = H_graph_file(H_path or "", label)
+        if not H_file:
+            LOG.warn("Unable to read H_graph %s, used on nodes %s" % (
+                os.path.join(H_path or "", label), ", ".join(H_labels[label])))
+            return
+        H_graphs[label] = load_H_graph(H_file)
+
+    return (G, H_graphs)
+
+def graph_product(G_in, H_path = None):
+    """Applies the graph product to G_in, see load_product_graphs"""
+    graphs = load_product_graphs(G_in, H_path)
+    if not graphs:
+        return
+    (G, H_graphs) = graphs
+# Nodes and edges are streamed into the output graph, with their attributes
     G_out = nx.Graph()
-    G_out.add_nodes_from(node_list(G, H_graphs))
-    G_out.add_nodes_from(propagate_node_attributes(G, H_graphs, G_out.nodes()))
-    G_out.add_edges_from(intra_pop_links(G, H_graphs))
-    G_out.add_edges_from(inter_pop_links(G, H_graphs))
-    G_out.add_edges_from(propagate_edge_attributes(G, H_graphs, G_out.edges()))
+    G_out.add_nodes_from(product_nodes(G, H_graphs))
+    G_out.add_edges_from(product_edges(G, H_graphs))
 #TODO: need to set default ASN, etc?
     return G_out
 
+def product_nodes(G, H_graphs):
+    """Yields (node, data) for each node in the product of G and H_graphs"""
+    return iter_node_attributes(G, H_graphs, iter_node_list(G, H_graphs))
+
+def product_edges(G, H_graphs):
+    """Yields (src, dst, data) for each edge in the product of G and H_graphs"""
+    edges = itertools.chain(iter_intra_pop_links(G, H_graphs),
+            iter_inter_pop_links(G, H_graphs))
+    return iter_edge_attributes(G, H_graphs, edges)
+
+def graphml_type(value):
+    """GraphML attribute type for value
+
+    >>> [graphml_type(x) for x in [True, 1, 1.5, "a"]]
+    ['boolean', 'int', 'double', 'string']
+    """
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, long):
+        return "long"
+    if isinstance(value, float):
+        return "double"
+    return "string"
+
+def write_graph_product(G_in, out_file, H_path = None):
+    """Writes the graph product of G_in to GraphML out_file, streaming nodes and edges
+    so memory use does not grow with the size of the product.
+    Nodes are written as u_v, as used by load_graphml.
+    Products are generated twice: first to find attribute keys, then to write.
+
+    >>> import tempfile, shutil
+    >>> G = nx.Graph()
+    >>> G.add_nodes_from([ ('a', dict(H='h')), ('b', dict(H='h'))])
+    >>> G.add_edge('a', 'b', operator = 'cartesian')
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> open(os.path.join(tmp_dir, "h.gml"), "w").write('graph [ node [ id 0 label "0" ] node [ id 1 label "1" ] edge [ source 0 target 1 ] ]')
+    >>> out_file = os.path.join(tmp_dir, "product.graphml")
+    >>> write_graph_product(G, out_file, tmp_dir)
+    >>> G_out = nx.read_graphml(out_file)
+    >>> sorted(G_out.nodes())
+    ['a_0', 'a_1', 'b_0', 'b_1']
+    >>> sorted(sorted(edge) for edge in G_out.edges())
+    [['a_0', 'a_1'], ['a_0', 'b_0'], ['a_1', 'b_1'], ['b_0', 'b_1']]
+    >>> str(G_out.node['a_1']['label'])
+    'a1'
+    >>> shutil.rmtree(tmp_dir)
+    """
+    from xml.sax.saxutils import quoteattr, escape
+    graphs = load_product_graphs(G_in, H_path)
+    if not graphs:
+        return
+    (G, H_graphs) = graphs
+    node_id = lambda (u, v): quoteattr("%s_%s" % (u, v))
+
+# First pass for attribute names and types
+    keys = {'node': {}, 'edge': {}}
+    for node, data in product_nodes(G, H_graphs):
+        for key, val in data.items():
+            keys['node'].setdefault(key, graphml_type(val))
+    for src, dst, data in product_edges(G, H_graphs):
+        for key, val in data.items():
+            keys['edge'].setdefault(key, graphml_type(val))
+    key_ids = {}
+    for element in ['node', 'edge']:
+        for key in sorted(keys[element]):
+            key_ids[(element, key)] = "d%s" % len(key_ids)
+
+    def data_elements(element, data):
+        return "".join('<data key="%s">%s</data>' % (key_ids[(element, key)],
+            escape(unicode(val).encode("utf-8"))) for key, val in sorted(data.items()))
+
+    with open(out_file, "wb") as f_out:
+        f_out.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for (element, key), key_id in sorted(key_ids.items(), key = lambda x: x[1]):
+            f_out.write('  <key attr.name=%s attr.type="%s" for="%s" id="%s" />\n' % (
+                quoteattr(key), keys[element][key], element, key_id))
+        f_out.write('  <graph edgedefault="undirected">\n')
+        for node, data in product_nodes(G, H_graphs):
+            f_out.write('    <node id=%s>%s</node>\n' % (node_id(node),
+                data_elements('node', data)))
+        for src, dst, data in product_edges(G, H_graphs):
+            f_out.write('    <edge source=%s target=%s>%s</edge>\n' % (node_id(src),
+                node_id(dst), data_elements('edge', data)))
+        f_out.write('  </graph>\n</graphml>\n')
+
+def H_graph_file(H_path, label):
+    """Returns the GraphML or GML file for H graph label, or None if neither exists"""
+    for extension in ["graphml", "gml"]:
+        H_file = os.path.join(H_path, "%s.%s" % (label, extension))
+        if os.path.isfile(H_file):
+            return H_file
+
+def read_graphml(filename):
+    """Reads a graph from GraphML as for nx.read_graphml, streaming the file"""
+# imported here as readwrite uses the package configuration, loaded after algorithms
+    from AutoNetkit.readwrite.graphml import GraphMLStreamReader
+    return GraphMLStreamReader().read(filename)
+
+def read_H_graph(H_file):
+    """Reads and prepares H graph from H_file"""
+    if H_file.endswith(".gml"):
+        H = nx.read_gml(H_file).to_undirected()
+    else:
+        H = read_graphml(H_file).to_undirected()
+    root_nodes = [n for n in H if H.node[n].get("root")]
+    if len(root_nodes):
+# some nodes have root set
+        non_root_nodes = set(H.nodes()) - set(root_nodes)
+        H.add_nodes_from( (n, dict(root=False)) for n in non_root_nodes)
+    H = remove_yed_edge_id(H)
+    H = remove_gml_node_id(H)
+    nx.relabel_nodes(H, dict((n, data.get('label', n)) for n, data in H.nodes(data=True)), copy=False)
+    return H
+
+def load_H_graph(H_file):
+    """Loads H graph from H_file, cached in memory and on disk keyed on file contents.
+    Cached graphs are shared between graph products, so must not be modified.
+
+    >>> from pkg_resources import resource_filename
+    >>> H_file = resource_filename("AutoNetkit", "lib/examples/topologies/H_graphs/H1.gml")
+    >>> load_H_graph(H_file) is load_H_graph(H_file)
+    True
+    """
+    key = cache.content_key([H_file], H_GRAPH_CACHE_VERSION, nx.__version__,
+        os.path.splitext(H_file)[1])
+    try:
+        return _H_graph_cache[key]
+    except KeyError:
+        pass
+
+    cache_file = cache.cache_file("H_graph", key)
+    H = None
+    if cache_file:
+        H = cache.load(cache_file)
+    if H is None:
+        H = read_H_graph(H_file)
+        if cache_file:
+            cache.save(cache_file, H)
+    else:
+        LOG.debug("Loaded H graph %s from cache %s" % (H_file, cache_file))
+
+    _H_graph_cache[key] = H
+    return H
+
+def iter_node_list(G, H_graphs):
+    return ( (u,v) for u in G for v in H_graphs[G.node[u]['H']] )
+
 def node_list(G, H_graphs):
     # TODO: work out how to retain node attributes
-    return [ (u,v) for u in G for v in H_graphs[G.node[u]['H']] ]
+    return list(iter_node_list(G, H_graphs))
+
+def iter_intra_pop_links(G, H_graphs):
+    return ( ((u,v1), (u,v2)) for u in G for (v1, v2) in H_graphs[G.node[u]['H']].edges_iter() )
 
 def intra_pop_links(G, H_graphs):
-    return [ ((u,v1), (u,v2)) for u in G for (v1, v2) in H_graphs[G.node[u]['H']].edges() ]
+    return list(iter_intra_pop_links(G, H_graphs))
+
+class H_index (namedtuple('H_index', "nodes, position, adjacency")):
+    """Product nodes of an H graph (root nodes if root set), their position
+    in that list, and neighbor sets of every node in the H graph"""
+    __slots__ = ()
+    def __repr__(self):
+        return "H nodes %s" % self.nodes
+
+def build_H_index(H):
+    """
+    >>> H = nx.Graph( [(0,1), (1,2)])
+    >>> build_H_index(H)
+    H nodes [0, 1, 2]
+    >>> H.add_nodes_from( [(0, dict(root=True)), (1, dict(root=False)), (2, dict(root=False))])
+    >>> build_H_index(H)
+    H nodes [0]
+    """
+# Node lists - if 'root' set then only use root nodes
+    try:
+        nodes = [n for n in H if H.node[n]['root']]
+    except KeyError:
+        nodes = [n for n in H]
+    position = dict( (n, index) for index, n in enumerate(nodes))
+    adjacency = dict( (n, set(H.neighbors(n))) for n in H)
+    return H_index(nodes, position, adjacency)
 
 def inter_pop_links(G, H_graphs, default_operator='cartesian'):
+    return list(iter_inter_pop_links(G, H_graphs, default_operator))
+
+def iter_inter_pop_links(G, H_graphs, default_operator='cartesian'):
+    """Yields inter-pop links, one G edge at a time"""
     #TODO:: list any edges without operator marked on them
-    edges = []
     cartesian_operators = set(["cartesian", "strong"])
     tensor_operators = set(["tensor", "strong"])
+    H_indexes = {}
     for (u1, u2) in G.edges():
         try:
             operator = G[u1][u2]['operator']
         except KeyError:
             operator =  default_operator
-        H1 = H_graphs[G.node[u1]['H']]
-        H2 = H_graphs[G.node[u2]['H']]
-# Node lists - if 'root' set then only use root nodes
-        try:
-            N1 = [n for n in H1 if H1.node[n]['root']]
-        except KeyError:
-            N1 = [n for n in H1]
-        try:
-            N2 = [n for n in H2 if H2.node[n]['root']]
-        except KeyError:
-            N2 = [n for n in H2]
+        H1_label = G.node[u1]['H']
+        H2_label = G.node[u2]['H']
+        H1 = H_graphs[H1_label]
+        H2 = H_graphs[H2_label]
+        for label, H in [(H1_label, H1), (H2_label, H2)]:
+            if label not in H_indexes:
+                H_indexes[label] = build_H_index(H)
+        H1_index = H_indexes[H1_label]
+        H2_index = H_indexes[H2_label]
+        N1 = H1_index.nodes
+        N2 = H2_index.nodes
         
         LOG.debug("Adding edges for (%s,%s) with operator %s" % (u1, u2, operator))
 
@@ -343,34 +533,85 @@ def inter_pop_links(G, H_graphs, default_operator='cartesian'):
 # 'root' not set
 #TODO: fold rooted back into special case of cartesian - just do the same for now
         if operator == 'rooted':
-            product_edges = [((u1, v1), (u2, v2)) for v1 in N1 for v2 in N2
-                    if H1.node[v1].get("root") == H2.node[v2].get("root") == True ]
+            roots_2 = [v2 for v2 in N2 if H2.node[v2].get("root") == True]
+            product_edges = [((u1, v1), (u2, v2)) for v1 in N1
+                    if H1.node[v1].get("root") == True for v2 in roots_2]
             LOG.debug("Rooted product edges for (%s,%s): %s" % (u1, u2, product_edges))
-            edges += product_edges
+            for edge in product_edges:
+                yield edge
 
         if operator == 'lexical':
             product_edges = [((u1, v1), (u2, v2)) for v1 in N1 for v2 in N2]
             LOG.debug("Lexical product edges for (%s,%s): %s" % (u1, u2, product_edges))
-            edges += product_edges
+            for edge in product_edges:
+                yield edge
 
         if operator in cartesian_operators:
-            product_edges = [((u1, v1), (u2, v2)) for v1 in N1 for v2 in N2 if v1 == v2]
+            product_edges = [((u1, v1), (u2, v1)) for v1 in N1 if v1 in H2_index.position]
             LOG.debug("Cartesian product edges for (%s,%s): %s" % (u1, u2, product_edges))
-            edges += product_edges
+            for edge in product_edges:
+                yield edge
         if operator in tensor_operators:
-            product_edges = [((u1, v1), (u2, v2)) for v1 in N1 for v2 in N2
-                    if  H1.has_edge(v1, v2) or H2.has_edge(v1,v2)]
+# v1 and v2 adjacent in either H graph, in order of v1 then v2
+            product_edges = []
+            for v1 in N1:
+                adjacent = H1_index.adjacency.get(v1, set()) | H2_index.adjacency.get(v1, set())
+                adjacent = sorted( (H2_index.position[v2], v2) for v2 in adjacent
+                        if v2 in H2_index.position)
+                product_edges += [((u1, v1), (u2, v2)) for (index, v2) in adjacent]
             LOG.debug("Tensor product edges for (%s,%s): %s" % (u1, u2, product_edges))
-            edges += product_edges
-
-    return edges
-
+            for edge in product_edges:
+                yield edge
+
+
+
+def grid_positions(nodes, by_column=False):
+    """Maps each node to (x, y) on a square grid, in sorted node order.
+    Grid is filled by row, or by column if by_column set.
+
+    >>> sorted(grid_positions(['a', 'b', 'c']).items())
+    [('a', (0, 0)), ('b', (1, 0)), ('c', (0, 1))]
+    >>> sorted(grid_positions(['a', 'b', 'c'], by_column=True).items())
+    [('a', (0, 0)), ('b', (0, 1)), ('c', (1, 0))]
+    """
+    nodes = sorted(nodes)
+    grid_size = int(math.ceil(math.sqrt(len(nodes))))
+    positions = {}
+    for index, node in enumerate(nodes):
+        (y, x) = divmod(index, grid_size)
+        if by_column:
+            (x, y) = (y, x)
+        positions[node] = (x, y)
+    return positions
+
+def G_positions(G):
+    """Position of each node in G, from x_pos and y_pos if set, otherwise on a grid"""
+    scaling = 3
+    grid = None
+    positions = {}
+    for u, data in G.nodes_iter(data=True):
+        try:
+            positions[u] = (float(data['x_pos']) * scaling, float(data['y_pos']) * scaling)
+        except KeyError:
+# Manually configure positions
+            if grid is None:
+                grid = grid_positions(G.nodes(), by_column=True)
+            (x, y) = grid[u]
+            positions[u] = (x*scaling, y*scaling)
+    return positions
 
 def propagate_node_attributes(G, H_graphs, node_list):
-    retval = []
+    return list(iter_node_attributes(G, H_graphs, node_list))
+
+def iter_node_attributes(G, H_graphs, node_list):
+    u_positions = G_positions(G)
+# Grid positions for each H graph, computed on first use
+    v_positions = {}
+    scaling = 100
     for (u,v) in node_list:
         u_v_data = dict(G.node[u])
-        v_data = dict(H_graphs[u_v_data['H']].node[v])
+        H_label = u_v_data['H']
+        v_data = dict(H_graphs[H_label].node[v])
         u_v_data.update(v_data)
         try:
 # append to current label to ensure unique
@@ -383,25 +624,14 @@ def propagate_node_attributes(G, H_graphs, node_list):
 
 # set pop to be u, used in ibgp, dns, etc as the layer 2 group
         u_v_data['pop'] = u
-        try:
-            u_x = float(G.node[u]['x_pos']) * 3
-            u_y = float(G.node[u]['y_pos']) * 3
-        except KeyError:
-# Manually configure positions
-            G_nodes = sorted(G.nodes())
-            grid_size = int(math.ceil(math.sqrt(len(G_nodes))))
-            scaling = 3
-            co_ords = [ (x*scaling, y*scaling) for x in range(grid_size) for y in range(grid_size)]
-            G_index = G_nodes.index(u)
-            (u_x, u_y) = co_ords[G_index]
+        (u_x, u_y) = u_positions[u]
 
 # Now need to map index of v in H to a grid
-        H_nodes = sorted(H_graphs[u_v_data['H']].nodes())
-        grid_size = int(math.ceil(math.sqrt(len(H_nodes))))
-        co_ords = [ (x,y) for y in range(grid_size) for x in range(grid_size)]
-        H_index = H_nodes.index(v)
-        scaling = 100
-        (v_x, v_y) = co_ords[H_index]
+        try:
+            (v_x, v_y) = v_positions[H_label][v]
+        except KeyError:
+            v_positions[H_label] = grid_positions(H_graphs[H_label].nodes())
+            (v_x, v_y) = v_positions[H_label][v]
         u_v_data['x_pos'] = u_x + v_x * scaling
         u_v_data['y_pos'] = u_y + v_y * scaling
 
@@ -412,11 +642,12 @@ def propagate_node_attributes(G, H_graphs, node_list):
             del u_v_data['root']
         except KeyError:
             pass
-        retval.append( ((u, v), u_v_data))
-    return retval
+        yield ((u, v), u_v_data)
 
 def propagate_edge_attributes(G, H_graphs, edge_list):
-    retval = []
+    return list(iter_edge_attributes(G, H_graphs, edge_list))
+
+def iter_edge_attributes(G, H_graphs, edge_list):
     for s, t in edge_list:
         (u1, v1) = s
         (u2, v2) = t
@@ -424,16 +655,14 @@ def propagate_edge_attributes(G, H_graphs, edge_list):
 # intra-pop
             edge_data = H_graphs[G.node[u2]['H']].get_edge_data(v1, v2)
         else:
-# inter-pop
-#TODO: why do we need {}?
-            edge_data = G.get_edge_data(u1, u2)
+# inter-pop, copy so operator is kept in G for later edges
+            edge_data = dict(G.get_edge_data(u1, u2))
             try:
                 del edge_data['operator']
             except KeyError:
                 pass
 
-        retval.append( (s, t, edge_data))
-    return retval
+        yield (s, t, edge_data)
 
 
 def plot(G, label="plot"):
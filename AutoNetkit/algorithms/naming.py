@@ -93,11 +93,11 @@ def dump_graph(input_graph, filename):
         for key, item in graph.graph.items():
             graph.graph[key] = str(item)
 
-            for n in graph:
-                if 'label' not in graph.node[n]:
-                    graph.node[n]['label'] = n.fqdn
-                for key, item in graph.node[n].items():
-                    graph.node[n][key] = str(item)
+        for n in graph:
+            if 'label' not in graph.node[n]:
+                graph.node[n]['label'] = n.fqdn
+            for key, item in graph.node[n].items():
+                graph.node[n][key] = str(item)
 
         for s,t in graph.edges():
             for key, item in graph[s][t].items():
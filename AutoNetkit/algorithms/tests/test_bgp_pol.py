@@ -24,3 +24,48 @@ def test_bgp_pol():
             master_file.splitlines(True)))
         LOG.warn(message)
         raise AssertionError
+
+def test_prefix_lists():
+    master_dir = (resource_filename(__name__, "comparisons"))
+    pol_file = os.path.join(master_dir, "policy.txt")
+    inet = AutoNetkit.internet.Internet("multias", netkit=True, junosphere=True,
+            policy_file=pol_file) 
+    inet.compile()
+
+# Aggregates only match the link subnets they cover, not loopbacks
+# The eBGP link subnet from AS1 depends on allocation order, so isn't compared
+    f_bgpd = os.path.join(config.lab_dir, "2a_AS2", "etc", "zebra", "bgpd.conf")
+    prefix_lists = [line.strip() for line in open(f_bgpd, "Ur")
+            if line.startswith("ip prefix-list origin_pl_asn_eq_2")]
+    assert(len(prefix_lists) == 2)
+    assert(prefix_lists[0].endswith("/30"))
+    assert(prefix_lists[1] == 
+        "ip prefix-list origin_pl_asn_eq_2 seq 10 permit 10.1.0.0/16 ge 30 le 30")
+
+    f_junos = os.path.join(config.junos_dir, "configset", "2a_AS2.conf")
+    junos_conf = open(f_junos, "Ur").read()
+    route_filters = [line.strip() for line in junos_conf.splitlines()
+            if line.strip().startswith("route-filter")]
+    assert(len(route_filters) == 2)
+    assert(route_filters[0].endswith("/30 exact;"))
+    assert(route_filters[1] == 
+        "route-filter 10.1.0.0/16 prefix-length-range /30-/30;")
+    assert("orlonger" not in junos_conf)
+
+def test_cbgp_prefix_lists():
+    master_dir = (resource_filename(__name__, "comparisons"))
+    pol_file = os.path.join(master_dir, "policy.txt")
+    inet = AutoNetkit.internet.Internet("multias", cbgp=True, policy_file=pol_file) 
+    inet.compile()
+
+# cBGP has no prefix length ranges, so each link subnet is matched exactly
+    f_cbgp = os.path.join(config.cbgp_dir, "cbgp.cli")
+    matches = set(line.strip() for line in open(f_cbgp, "Ur")
+            if line.strip().startswith('match "prefix'))
+    assert(len(matches) == 1)
+    prefixes = matches.pop()[len('match "'):-1].split(" | ")
+    assert(len(prefixes) > 1)
+    assert(all(prefix.startswith("prefix is ") and prefix.endswith("/30")
+        for prefix in prefixes))
+    assert(any(prefix.startswith("prefix is 10.1.") for prefix in prefixes))
+    assert(" ge " not in open(f_cbgp, "Ur").read())
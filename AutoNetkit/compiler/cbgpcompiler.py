@@ -142,29 +142,21 @@ class CbgpCompiler:
 
             #TODO: see if can just do for node in ebgp_graph ie without the .nodes() on end
 
-        # bgp policy
+        # bgp policy, with the router's compiled policy for its tags and prefixes
         bgp_policy = {}
         for router in self.network.routers():
-            for peer in self.network.g_session.neighbors(router):
-                pol_egress = self.network.g_session[router][peer]['egress']
-                pol_ingress = self.network.g_session[peer][router]['ingress']
+            policy = ank.router_bgp_policy(self.network, router)
+            peers = {}
+            for peer, peer_policy in policy.peers.items():
+                pol_egress = peer_policy.egress
+                pol_ingress = peer_policy.ingress
                 if len(pol_ingress) or len(pol_egress):
-                    try:
-                        bgp_policy[router][peer] = {
-                                'ingress': pol_ingress,
-                                'egress': pol_egress,
-                                }
-                    except KeyError:
-                        bgp_policy[router] = {}
-                        bgp_policy[router][peer] = {
-                                'ingress': pol_ingress,
-                                'egress': pol_egress,
-                                }
-
-
-        # tags dict for mapping from tag to community value, and for prefixes
-        tags = self.network.g_session.graph['tags']
-        prefixes = self.network.g_session.graph['prefixes']
+                    peers[peer] = {
+                            'ingress': pol_ingress,
+                            'egress': pol_egress,
+                            }
+            if peers:
+                bgp_policy[router] = (policy, peers)
 
         with open( cbgp_file(), 'wb') as f_cbgp:
                 f_cbgp.write( template.render(
@@ -176,6 +168,4 @@ class CbgpCompiler:
                    ebgp_prefixes = ebgp_prefixes,
                    bgp_routers = bgp_routers,
                    bgp_policy = bgp_policy,
-                   tags = tags,
-                   prefixes = prefixes,
                    ))
@@ -51,11 +51,12 @@ import shutil
 import glob
 import time
 import itertools
-import tarfile
 
 import AutoNetkit as ank
 #from ank.config import config
 from AutoNetkit import config
+from AutoNetkit.compiler.render import (render_job, render_jobs, render_manifest,
+        remove_manifest, lab_output)
 settings = config.settings          
 
 import pprint   
@@ -109,8 +110,21 @@ def router_conf_path(network, router):
 class dynagenCompiler:  
     """Compiler main"""
 
-    def __init__(self, network, igp, services, image, hypervisor_server, hypervisor_port):
+    def __init__(self, network, igp, services, image, hypervisor_server, hypervisor_port,
+            jobs=None, incremental=None, write_lab_dir=None):
         self.network = network
+        # Worker processes for rendering, None uses the [Lab] jobs setting
+        self.jobs = jobs
+        # Keep unchanged files from last compile, None uses [Lab] incremental
+        if incremental is None:
+            incremental = config.settings['Lab']['incremental']
+        self.incremental = incremental
+        # Set by configure if incremental, records which files are rendered
+        self.manifest = None
+        # If False, files only go into the lab archive
+        if write_lab_dir is None:
+            write_lab_dir = config.settings['Lab']['write lab dir']
+        self.write_lab_dir = write_lab_dir
         self.services = services
         self.image = image
         self.hypervisor_server = hypervisor_server
@@ -127,14 +141,15 @@ class dynagenCompiler:
         """Creates lab folder structure"""
         if not os.path.isdir(lab_dir()):
             os.mkdir(lab_dir())
-        else:
+        elif not self.incremental:
+            # If incremental, configs of removed routers are removed by manifest
             for item in glob.iglob(os.path.join(lab_dir(), "*")):
                 if os.path.isdir(item):
                     shutil.rmtree(item)           
                 else:
                     os.unlink(item)
 
-        if not os.path.isdir(router_conf_dir()):
+        if self.write_lab_dir and not os.path.isdir(router_conf_dir()):
             os.mkdir(router_conf_dir()) 
 
         return
@@ -240,25 +255,13 @@ class dynagenCompiler:
         route_maps = []
         ibgp_neighbor_list = []
         ibgp_rr_client_list = []
-        route_map_groups = {}
+        policy = ank.router_bgp_policy(self.network, router)
 
         if router in ibgp_graph:
-            for src, neigh, data in ibgp_graph.edges(router, data=True):
-                route_maps_in = self.network.g_session[neigh][router]['ingress']
-                rm_group_name_in = None
-                if len(route_maps_in):
-                    rm_group_name_in = "rm_%s_in" % neigh.folder_name
-                    route_map_groups[rm_group_name_in] = [match_tuple 
-                            for route_map in route_maps_in
-                            for match_tuple in route_map.match_tuples]
-
-                route_maps_out = self.network.g_session[router][neigh]['egress']
-                rm_group_name_out = None
-                if len(route_maps_out):
-                    rm_group_name_in = "rm_%s_out" % neigh.folder_name
-                    route_map_groups[rm_group_name_out] = [match_tuple 
-                            for route_map in route_maps_out
-                            for match_tuple in route_map.match_tuples]
+            for src, neigh, data in sorted(ibgp_graph.edges(router, data=True),
+                    key = lambda (src, neigh, data): self.network.fqdn(neigh)):
+                rm_group_name_in = policy.peers[neigh].route_map_group_in
+                rm_group_name_out = policy.peers[neigh].route_map_group_out
 
                 description = data.get("rr_dir") + " to " + ank.fqdn(self.network, neigh)
                 if data.get('rr_dir') == 'down':
@@ -292,24 +295,9 @@ class dynagenCompiler:
 
         if router in ebgp_graph:
             external_peers = []
-            for peer in ebgp_graph.neighbors(router):
-                route_maps_in = self.network.g_session[peer][router]['ingress']
-                rm_group_name_in = None
-                if len(route_maps_in):
-                    rm_group_name_in = "rm_%s_in" % peer.folder_name
-                    route_map_groups[rm_group_name_in] = [match_tuple 
-                            for route_map in route_maps_in
-                            for match_tuple in route_map.match_tuples]
-
-# Now need to update the sequence numbers for the flattened route maps
-
-                route_maps_out = self.network.g_session[router][peer]['egress']
-                rm_group_name_out = None
-                if len(route_maps_out):
-                    rm_group_name_out = "rm_%s_out" % peer.folder_name
-                    route_map_groups[rm_group_name_out] = [match_tuple 
-                            for route_map in route_maps_out
-                            for match_tuple in route_map.match_tuples]
+            for peer in sorted(ebgp_graph.neighbors(router), key = self.network.fqdn):
+                rm_group_name_in = policy.peers[peer].route_map_group_in
+                rm_group_name_out = policy.peers[peer].route_map_group_out
 
                 peer_ip = physical_graph[peer][router]['ip'] 
 
@@ -322,26 +310,20 @@ class dynagenCompiler:
                     'type': 'external', 
                     'neighbors': external_peers}
 
-# Ensure only one copy of each route map, can't use set due to list inside tuples (which won't hash)
-# Use dict indexed by name, and then extract the dict items, dict hashing ensures only one route map per name
-        community_lists = {}
-        prefix_lists = {}
-        node_bgp_data = self.network.g_session.node.get(router)
-        if node_bgp_data:
-            community_lists = node_bgp_data.get('tags')
-            prefix_lists = node_bgp_data.get('prefixes')
+# Route map groups are already named once per router, with identical route maps shared, by compile_bgp_policy
+        community_lists = policy.community_lists
+        prefix_lists = policy.prefix_lists
         policy_options = {
                 'community_lists': community_lists,
                 'prefix_lists': prefix_lists,
-                'route_maps': route_map_groups,
+                'route_maps': policy.route_map_groups,
                 }
 
         return (bgp_groups, policy_options)
 
-    def configure_ios(self):
-        """ Configures IOS"""
+    def configure_ios(self, output):
+        """ Configures IOS, rendering configs to output"""
         LOG.info("Configuring IOS")
-        ios_template = lookup.get_template("cisco/ios.mako")
         ank_version = pkg_resources.get_distribution("AutoNetkit").version
         date = time.strftime("%Y-%m-%d %H:%M", time.localtime())
 
@@ -350,6 +332,8 @@ class dynagenCompiler:
         ibgp_graph = ank.get_ibgp_graph(self.network)
         ebgp_graph = ank.get_ebgp_graph(self.network)
 
+        # Contexts built here, rendered by render_jobs once all routers done
+        jobs = []
         for router in self.network.routers():
             #check interfaces feasible
 #TODO: make in_degree a property eg link_count
@@ -367,8 +351,7 @@ class dynagenCompiler:
                 network_list.append(adv_subnet)
 
             juniper_filename = router_conf_path(self.network, router)
-            with open( juniper_filename, 'wb') as f_jun:
-                f_jun.write( ios_template.render(
+            jobs.append(render_job("cisco/ios.mako", juniper_filename, dict(
                     hostname = router.rtr_folder_name,
                     username = 'autonetkit',
                     interfaces=interfaces,
@@ -385,7 +368,8 @@ class dynagenCompiler:
                     policy_options = policy_options,
                     ank_version = ank_version,
                     date = date,
-                    ))
+                    ), router.rtr_folder_name))
+        render_jobs(lookup, jobs, self.jobs, self.manifest, output)
 
     
     def int_id(self, interface_id):
@@ -411,8 +395,8 @@ class dynagenCompiler:
             LOG.warn("No Dynagen lab.net interface mapping defined for interface type %s" % interface_name)
         return retval
 
-    def configure_dynagen(self):  
-        """Generates dynagen specific configuration files."""
+    def configure_dynagen(self, output):  
+        """Generates dynagen specific configuration files, written to output."""
         LOG.info("Configuring Dynagen")
 
         # Location of IOS binary
@@ -484,8 +468,7 @@ class dynagenCompiler:
 
         #pprint.pprint(all_router_info)
         lab_file = os.path.join(lab_dir(), "lab.net")
-        with open( lab_file, 'wb') as f_lab:
-            f_lab.write( lab_template.render(
+        output.write(lab_file, lab_template.render(
                 image = self.image,
                 hypervisor_port = self.hypervisor_port,
                 hypervisor_server = self.hypervisor_server,
@@ -501,13 +484,25 @@ class dynagenCompiler:
 
 
     def configure(self):
-        self.configure_dynagen()
-        self.configure_ios()
-# create .tgz
+# create .tgz, files added as they are rendered
         tar_filename = "dynagen_%s.tar.gz" % time.strftime("%Y%m%d_%H%M",
                 time.localtime())
-        tar = tarfile.open(os.path.join(config.ank_main_dir,
-            tar_filename), "w:gz")
-        tar.add(lab_dir())
+        self.manifest = None
+        if self.incremental:
+            self.manifest = render_manifest(lab_dir(), self.write_lab_dir)
+        else:
+            remove_manifest(lab_dir())
+        output = lab_output(lab_dir(),
+                os.path.join(config.ank_main_dir, tar_filename),
+                write_files = self.write_lab_dir, manifest = self.manifest)
+        try:
+            self.configure_dynagen(output)
+            self.configure_ios(output)
+            if self.manifest is not None:
+                self.manifest.save()
+        except:
+            output.discard()
+            raise
+        finally:
+            output.close()
         self.network.compiled_labs['dynagen'] = tar_filename
-        tar.close()
@@ -22,10 +22,11 @@ from collections import namedtuple
 
 import AutoNetkit as ank
 from AutoNetkit import config
+from AutoNetkit.compiler.render import (render_job, render_jobs, render_manifest,
+        remove_manifest, lab_output)
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
-import tarfile
 import time
 
 # Check can write to template cache directory
@@ -61,8 +62,21 @@ def router_conf_path(network, router):
 class JunosCompiler:
     """Compiler main"""
 
-    def __init__(self, network, services, igp="ospf", target=None, olive_qemu_patched=False):
+    def __init__(self, network, services, igp="ospf", target=None, olive_qemu_patched=False,
+            jobs=None, incremental=None, write_lab_dir=None):
         self.network = network
+        # Worker processes for rendering, None uses the [Lab] jobs setting
+        self.jobs = jobs
+        # Keep unchanged files from last compile, None uses [Lab] incremental
+        if incremental is None:
+            incremental = config.settings['Lab']['incremental']
+        self.incremental = incremental
+        # Set by configure if incremental, records which files are rendered
+        self.manifest = None
+        # If False, files only go into the lab archive
+        if write_lab_dir is None:
+            write_lab_dir = config.settings['Lab']['write lab dir']
+        self.write_lab_dir = write_lab_dir
         self.services = services
         self.igp = igp
         self.target = target
@@ -100,7 +114,8 @@ class JunosCompiler:
         """Creates lab folder structure"""
         if not os.path.isdir(lab_dir()):
             os.mkdir(lab_dir())
-        else:
+        elif not self.incremental:
+            # If incremental, configs of removed routers are removed by manifest
             for item in glob.iglob(os.path.join(lab_dir(), "*")):
                 if os.path.isdir(item):
                     shutil.rmtree(item)
@@ -108,12 +123,12 @@ class JunosCompiler:
                     os.unlink(item)
 
         # Directory to put config files into
-        if not os.path.isdir(router_conf_dir()):
+        if self.write_lab_dir and not os.path.isdir(router_conf_dir()):
             os.mkdir(router_conf_dir())
         return
 
-    def configure_junosphere(self):
-        """Configure Junosphere topology structure"""
+    def configure_junosphere(self, output):
+        """Configure Junosphere topology structure, written to output"""
         LOG.debug("Configuring Junosphere") 
         vmm_template = lookup.get_template("junos/topology_vmm.mako")
         topology_data = {}
@@ -178,8 +193,7 @@ class JunosCompiler:
                     })
             
         vmm_file = os.path.join(lab_dir(), "topology.vmm")
-        with open( vmm_file, 'wb') as f_vmm:
-            f_vmm.write( vmm_template.render(
+        output.write(vmm_file, vmm_template.render(
                 topology_data = topology_data,
                 private_bridges = private_bridges,
                 image = image,
@@ -264,16 +278,12 @@ class JunosCompiler:
 #TODO: put comments in for junos bgp peerings
         # route maps
         bgp_groups = {}
-        route_maps = []
+        policy = ank.router_bgp_policy(self.network, router)
         if router in ibgp_graph:
             internal_peers = []
-            for peer in ibgp_graph.neighbors(router):
-                route_maps_in = [route_map for route_map in 
-                        self.network.g_session[peer][router]['ingress']]
-                route_maps_out = [route_map for route_map in 
-                        self.network.g_session[router][peer]['egress']]
-                route_maps += route_maps_in
-                route_maps += route_maps_out   
+            for peer in sorted(ibgp_graph.neighbors(router), key = self.network.fqdn):
+                route_maps_in = policy.peers[peer].ingress
+                route_maps_out = policy.peers[peer].egress
                 internal_peers.append({
                     'id': self.network.lo_ip(peer).ip,
                     'route_maps_in': [r.name for r in route_maps_in],
@@ -287,13 +297,10 @@ class JunosCompiler:
         ibgp_neighbor_list = []
         ibgp_rr_client_list = []
         if router in ibgp_graph:
-            for src, neigh, data in ibgp_graph.edges(router, data=True):
-                route_maps_in = [route_map for route_map in 
-                        self.network.g_session[neigh][router]['ingress']]
-                route_maps_out = [route_map for route_map in 
-                        self.network.g_session[router][neigh]['egress']]
-                route_maps += route_maps_in
-                route_maps += route_maps_out     
+            for src, neigh, data in sorted(ibgp_graph.edges(router, data=True),
+                    key = lambda (src, neigh, data): self.network.fqdn(neigh)):
+                route_maps_in = policy.peers[neigh].ingress
+                route_maps_out = policy.peers[neigh].egress
                 description = data.get("rr_dir") + " to " + ank.fqdn(self.network, neigh)
                 if data.get('rr_dir') == 'down':
                     ibgp_rr_client_list.append(
@@ -326,13 +333,9 @@ class JunosCompiler:
 
         if router in ebgp_graph:
             external_peers = []
-            for peer in ebgp_graph.neighbors(router):
-                route_maps_in = [route_map for route_map in 
-                        self.network.g_session[peer][router]['ingress']]
-                route_maps_out = [route_map for route_map in 
-                        self.network.g_session[router][peer]['egress']]
-                route_maps += route_maps_in
-                route_maps += route_maps_out   
+            for peer in sorted(ebgp_graph.neighbors(router), key = self.network.fqdn):
+                route_maps_in = policy.peers[peer].ingress
+                route_maps_out = policy.peers[peer].egress
                 peer_ip = physical_graph[peer][router]['ip']
                 external_peers.append({
                     'id': peer_ip, 
@@ -343,28 +346,17 @@ class JunosCompiler:
                     'type': 'external', 
                     'neighbors': external_peers}
 
-# Ensure only one copy of each route map, can't use set due to list inside tuples (which won't hash)
-# Use dict indexed by name, and then extract the dict items, dict hashing ensures only one route map per name
-        route_maps = dict( (route_map.name, route_map) for route_map in route_maps).values()
-
-        community_lists = {}
-        prefix_lists = {}
-        node_bgp_data = self.network.g_session.node.get(router)
-        if node_bgp_data:
-            community_lists = node_bgp_data.get('tags')
-            prefix_lists = node_bgp_data.get('prefixes')
         policy_options = {
-                'community_lists': community_lists,
-                'prefix_lists': prefix_lists,
-                'route_maps': route_maps,
+                'community_lists': policy.community_lists,
+                'prefix_lists': policy.prefix_lists,
+                'route_maps': policy.route_maps,
                 }
 
         return (bgp_groups, policy_options)
 
-    def configure_junos(self):
-        """ Configures Junos"""
+    def configure_junos(self, output):
+        """ Configures Junos, rendering configs to output"""
         LOG.info("Configuring Junos: %s" % self.target)
-        junos_template = lookup.get_template("junos/junos.mako")
         ank_version = pkg_resources.get_distribution("AutoNetkit").version
         date = time.strftime("%Y-%m-%d %H:%M", time.localtime())
 
@@ -373,6 +365,8 @@ class JunosCompiler:
         ibgp_graph = ank.get_ibgp_graph(self.network)
         ebgp_graph = ank.get_ebgp_graph(self.network)
 
+        # Contexts built here, rendered by render_jobs once all routers done
+        jobs = []
         #TODO: correct this router type selector
         for router in self.network.routers():
             #check interfaces feasible
@@ -393,8 +387,7 @@ class JunosCompiler:
                 network_list.append(adv_subnet)
 
             juniper_filename = router_conf_path(self.network, router)
-            with open( juniper_filename, 'wb') as f_jun:
-                f_jun.write( junos_template.render(
+            jobs.append(render_job("junos/junos.mako", juniper_filename, dict(
                     hostname = router.rtr_folder_name,
                     username = 'autonetkit',
                     interfaces=interfaces,
@@ -408,22 +401,36 @@ class JunosCompiler:
                     policy_options = policy_options,
                     ank_version = ank_version,
                     date = date,
-                    ))
+                    ), router.rtr_folder_name))
+        render_jobs(lookup, jobs, self.jobs, self.manifest, output)
 
     def configure(self):
-        if self.junosphere:
-            self.configure_junosphere()
-        self.configure_junos()
-# create .tgz
+# create .tgz, files added as they are rendered
         tar_filename = "junos_%s.tar.gz" % time.strftime("%Y%m%d_%H%M",
                 time.localtime())
-        tar = tarfile.open(os.path.join(config.ank_main_dir,
-            tar_filename), "w:gz")
+        arcname = None
         if self.junosphere:
 # Junosphere needs to have no arcname to flatten file structure
 # (need to extract into same directory as the tar.gz)
-            tar.add(lab_dir(), arcname="")
+            arcname = ""
+        self.manifest = None
+        if self.incremental:
+            self.manifest = render_manifest(lab_dir(), self.write_lab_dir)
         else:
-            tar.add(lab_dir())
+            remove_manifest(lab_dir())
+        output = lab_output(lab_dir(),
+                os.path.join(config.ank_main_dir, tar_filename),
+                arcname = arcname, write_files = self.write_lab_dir,
+                manifest = self.manifest)
+        try:
+            if self.junosphere:
+                self.configure_junosphere(output)
+            self.configure_junos(output)
+            if self.manifest is not None:
+                self.manifest.save()
+        except:
+            output.discard()
+            raise
+        finally:
+            output.close()
         self.network.compiled_labs['junos'] = tar_filename
-        tar.close()
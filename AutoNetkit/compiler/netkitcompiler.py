@@ -17,10 +17,12 @@ LOG = logging.getLogger("ANK")
 import shutil
 import glob
 import time
-import tarfile
+import stat
 
 import AutoNetkit as ank
 from AutoNetkit import config
+from AutoNetkit.compiler.render import (render_job, render_jobs, render_manifest,
+        remove_manifest, lab_output)
 settings = config.settings
 
 import pprint
@@ -105,10 +107,23 @@ def lo_interface(int_id=0):
 class NetkitCompiler:
     """Compiler main"""
 
-    def __init__(self, network, services, zebra_password="1234"):
+    def __init__(self, network, services, zebra_password="1234", jobs=None,
+            incremental=None, write_lab_dir=None):
         self.network = network
         self.services = services
         self.zebra_password = zebra_password
+        # Worker processes for rendering, None uses the [Lab] jobs setting
+        self.jobs = jobs
+        # Keep unchanged files from last compile, None uses [Lab] incremental
+        if incremental is None:
+            incremental = config.settings['Lab']['incremental']
+        self.incremental = incremental
+        # Set by configure if incremental, records which files are rendered
+        self.manifest = None
+        # If False, files only go into the lab archive
+        if write_lab_dir is None:
+            write_lab_dir = config.settings['Lab']['write lab dir']
+        self.write_lab_dir = write_lab_dir
         self.interface_id = ank.interface_id('netkit')
         self.tap_interface_id = ank.tap_interface_id
         self.lo_interface = lo_interface
@@ -125,6 +140,15 @@ class NetkitCompiler:
         #TODO: make this go into one dir for each netkithost
         if not os.path.isdir(lab_dir()):
             os.mkdir(lab_dir())
+        elif self.incremental:
+            # Only remove devices no longer in the network, files for current
+            # devices are replaced or removed as needed by the manifest
+            current = set(ank.rtr_folder_name(self.network, device)
+                    for device in self.network.devices())
+            current.add(os.path.basename(shared_dir()))
+            for item in glob.iglob(os.path.join(lab_dir(), "*")):
+                if os.path.isdir(item) and os.path.basename(item) not in current:
+                    shutil.rmtree(item)
         else:
             # network dir exists, clean out all (based on glob of ASxry)
             #TODO: see if need * wildcard for standard glob
@@ -134,6 +158,10 @@ class NetkitCompiler:
                 else:
                     os.unlink(item)
 
+        if not self.write_lab_dir:
+            # Files only written to the archive
+            return
+
         # Create folder for netkit hosts
         #TODO: reinstate for multi-machine ANK
         if not os.path.isdir(shared_dir()):
@@ -162,8 +190,10 @@ class NetkitCompiler:
                         os.mkdir(b_dir)
         return
 
-    def configure_netkit(self):
-        """Generates Netkit and Zebra/Quagga specific configuration files."""
+    def configure_netkit(self, output):
+        """Generates Netkit and Zebra/Quagga specific configuration files.
+        Files which aren't templated are written to output.
+        Returns render jobs for the files, rendered by configure."""
 
         # Sets up netkit related files
         tap_host = ank.get_tap_host(self.network)
@@ -171,18 +201,16 @@ class NetkitCompiler:
         ank_version = pkg_resources.get_distribution("AutoNetkit").version
         date = time.strftime("%Y-%m-%d %H:%M", time.localtime())
 
-        lab_template = lookup.get_template("netkit/lab.mako")
-        startup_template = lookup.get_template("netkit/startup.mako")
-        zebra_daemons_template = lookup.get_template(
-            "quagga/zebra_daemons.mako")
-        zebra_template = lookup.get_template("quagga/zebra.mako")
-        sshd_template = lookup.get_template("linux/sshd.mako")
-        motd_template = lookup.get_template("quagga/motd.mako")
+        # Templates are rendered once all contexts are built
+        jobs = []
 
         # Shared (common) configuration
         startup_daemon_list = []
         #Setup ssh
-        shutil.copy(resource_filename("AutoNetkit","lib/shadow"), shared_etc_dir())
+        shadow = resource_filename("AutoNetkit","lib/shadow")
+        with open(shadow, 'rb') as f_shadow:
+            output.write(os.path.join(shared_etc_dir(), "shadow"),
+                    f_shadow.read(), mode = stat.S_IMODE(os.stat(shadow).st_mode))
         startup_daemon_list.append("ssh")
         # Need to chown root dir for ssh keys
 # refer http://list.dia.uniroma3.it/pipermail/netkit.users/2010-February/000552.html
@@ -191,23 +219,19 @@ class NetkitCompiler:
             #chown root:root /root
             use_ssh_key = True
 
-        f_startup = open( os.path.join(lab_dir(), "shared.startup"), 'wb')
-        f_startup.write(startup_template.render(
+        jobs.append(render_job("netkit/startup.mako",
+            os.path.join(lab_dir(), "shared.startup"), dict(
             interfaces=[],
             add_localhost=True,
             #don't send out the tap interface
             del_default_route=True,
             daemons=startup_daemon_list,
             use_ssh_key = use_ssh_key,
-            ))
-        f_startup.close()
+            )))
 
 
 # Files for indvidual node configuration
 
-        #TODO: this needs to be created for each netkit host machine
-        f_lab = open(os.path.join(lab_dir(), "lab.conf"), 'wb')
-
         lab_conf = {}
         tap_list_strings = {}
 
@@ -224,9 +248,8 @@ class NetkitCompiler:
             rtr_folder_name = ank.rtr_folder_name(self.network, node)
 
             # sshd options
-            f_sshd = open( os.path.join(sshd_dir(self.network, node), "sshd_config"), 'wb')
-            f_sshd.write(sshd_template.render())
-            f_sshd.close()
+            jobs.append(render_job("linux/sshd.mako",
+                os.path.join(sshd_dir(self.network, node), "sshd_config"), {}, rtr_folder_name))
 
             lab_conf[rtr_folder_name] = []
             startup_daemon_list = ["zebra"]
@@ -247,14 +270,11 @@ class NetkitCompiler:
                 lab_conf[rtr_folder_name].append( ('mem', dns_memory))
 
             if config.settings['Netkit']['ssh key']:
-                f_auth_keys = open(os.path.join(dot_ssh_dir(self.network, node), "authorized_keys"), "wb")
-                f_auth_keys.write(config.settings['Netkit']['ssh key'])
-                f_auth_keys.close()
+                output.write(os.path.join(dot_ssh_dir(self.network, node), "authorized_keys"),
+                        config.settings['Netkit']['ssh key'], rtr_folder_name)
 
             # Zebra Daemons
             zebra_daemon_list = []
-            f_zdaemons = open( os.path.join(zebra_dir(self.network, node),
-                                            "daemons"), 'wb')
 # Always start Zebra
             zebra_daemon_list.append("zebra")
 
@@ -263,31 +283,27 @@ class NetkitCompiler:
             if (node in ibgp_routers) or (node in ebgp_routers):
                 zebra_daemon_list.append("bgpd")
 
-            f_zdaemons.write(zebra_daemons_template.render(
+            jobs.append(render_job("quagga/zebra_daemons.mako",
+                os.path.join(zebra_dir(self.network, node), "daemons"), dict(
                 entryList = zebra_daemon_list,
-            ))
-            f_zdaemons.close()
+            ), rtr_folder_name))
 # MOTD
-            f_zmotd = open( os.path.join(zebra_dir(self.network, node),
-                                            "motd.txt"), 'wb')
-
-            f_zmotd.write(motd_template.render(
+            jobs.append(render_job("quagga/motd.mako",
+                os.path.join(zebra_dir(self.network, node), "motd.txt"), dict(
                 date = date,
                 version = ank_version,
                 password = self.zebra_password,
-            ))
+            ), rtr_folder_name))
 
             # Main Zebra config
-            f_z = open( os.path.join(zebra_dir(self.network, node),
-                                     "zebra.conf"), 'wb')
-            f_z.write( zebra_template.render(
+            jobs.append(render_job("quagga/zebra.mako",
+                os.path.join(zebra_dir(self.network, node), "zebra.conf"), dict(
                 hostname = node.device_hostname,
                 password = self.zebra_password,
                 enable_password = self.zebra_password,
                 use_snmp = True,
                 use_debug = True,
-                ))
-            f_z.close()
+                ), rtr_folder_name))
 
             # Loopback interface
             lo_ip = self.network.lo_ip(node)
@@ -320,14 +336,13 @@ class NetkitCompiler:
 # add default_route for server to router
 
             chown_bind = False
-            if node in ank.dns_servers(self.network):
+            if node in dns_servers:
                 chown_bind = True
 
             #Write startup file for this router
-            f_startup = open( os.path.join(netkit_dir(self.network, node),
-                "{0}.startup".format(rtr_folder_name)), 'wb')
-
-            f_startup.write(startup_template.render(
+            jobs.append(render_job("netkit/startup.mako",
+                os.path.join(netkit_dir(self.network, node),
+                "{0}.startup".format(rtr_folder_name)), dict(
                 interfaces=startup_int_list,
                 add_localhost=True,
                 #don't send out the tap interface
@@ -335,11 +350,12 @@ class NetkitCompiler:
                 default_route = default_route,
                 daemons=startup_daemon_list,
                 chown_bind = chown_bind,
-                ))
-            f_startup.close()
+                ), rtr_folder_name))
 
-        # Write lab file for whole lab
-        f_lab.write(lab_template.render(
+        # Write lab file for whole lab, once entries for all routers collected
+        #TODO: this needs to be created for each netkit host machine
+        jobs.append(render_job("netkit/lab.mako",
+            os.path.join(lab_dir(), "lab.conf"), dict(
             conf = lab_conf,
             tapHost = tap_host,
             tapList = tap_list_strings,
@@ -350,13 +366,14 @@ class NetkitCompiler:
             lab_author = "AutoNetkit %s" % ank_version,
             #TODO: get this from config file
             lab_web =  "packages.python.org/AutoNetkit/",
-        ))
+        )))
+        return jobs
 
     def configure_igp(self):
-        """Generates IGP specific configuration files (eg ospfd)"""
+        """Returns render jobs for IGP specific configuration files (eg ospfd)"""
         LOG.debug("Configuring IGP")
-        template = lookup.get_template("quagga/ospf.mako")
         default_weight = 1
+        jobs = []
 
         # configures IGP for each AS
         as_graphs = ank.get_as_graphs(self.network)
@@ -389,7 +406,7 @@ class NetkitCompiler:
                     weight = link.weight or default_weight
                     interface_list.append ({ 'id':  int_id,
                                             'weight': weight,
-                                            'remote_router': link.remote_host, } )
+                                            'remote_router': str(link.remote_host), } )
 
                     # fetch and format the ip details
                     subnet = link.subnet
@@ -400,21 +417,20 @@ class NetkitCompiler:
                                         'remote_ip': remote_ip, 'area': 0, } )
 
                 #TODO: see if need to use router-id for ospfd in quagga
-                f_handle = open( os.path.join(zebra_dir(self.network, router),
-                        "ospfd.conf"), 'wb')
-
-                f_handle.write(template.render
-                               (
+                jobs.append(render_job("quagga/ospf.mako",
+                    os.path.join(zebra_dir(self.network, router), "ospfd.conf"),
+                               dict(
                                    hostname = router.device_hostname,
                                    password = self.zebra_password,
                                    enable_password = self.zebra_password,
                                    interface_list = interface_list,
                                    network_list = network_list,
-                                   routerID = router,
+                                   routerID = str(router),
                                    use_igp = True,
                                    logfile = "/var/log/zebra/ospfd.log",
                                    use_debug = False,
-                               ))
+                               ), router.rtr_folder_name))
+        return jobs
 
     def configure_interfaces(self, device):
         LOG.debug("Configuring interfaces for %s" % self.network.fqdn(device))
@@ -455,12 +471,12 @@ class NetkitCompiler:
         return interfaces
 
     def configure_bgp(self):
-        """Generates BGP specific configuration files"""
+        """Returns render jobs for BGP specific configuration files"""
 
         ip_as_allocs = ank.get_ip_as_allocs(self.network)
 
         LOG.debug("Configuring BGP")
-        template = lookup.get_template("quagga/bgp.mako")
+        jobs = []
 
         route_maps = {}
 
@@ -481,25 +497,13 @@ class NetkitCompiler:
                 route_maps = []
                 ibgp_neighbor_list = []
                 ibgp_rr_client_list = []
-                route_map_groups = {}
+                policy = ank.router_bgp_policy(self.network, router)
 
                 if router in ibgp_graph:
-                        for src, neigh, data in ibgp_graph.edges(router, data=True):
-                            route_maps_in = self.network.g_session[neigh][router]['ingress']
-                            rm_group_name_in = None
-                            if len(route_maps_in):
-                                rm_group_name_in = "rm_%s_in" % neigh.folder_name
-                                route_map_groups[rm_group_name_in] = [match_tuple 
-                                        for route_map in route_maps_in
-                                        for match_tuple in route_map.match_tuples]
-
-                            route_maps_out = self.network.g_session[router][neigh]['egress']
-                            rm_group_name_out = None
-                            if len(route_maps_out):
-                                rm_group_name_in = "rm_%s_out" % neigh.folder_name
-                                route_map_groups[rm_group_name_out] = [match_tuple 
-                                        for route_map in route_maps_out
-                                        for match_tuple in route_map.match_tuples]
+                        for src, neigh, data in sorted(ibgp_graph.edges(router, data=True),
+                                key = lambda (src, neigh, data): self.network.fqdn(neigh)):
+                            rm_group_name_in = policy.peers[neigh].route_map_group_in
+                            rm_group_name_out = policy.peers[neigh].route_map_group_out
 
                             description = data.get("rr_dir") + " to " + ank.fqdn(self.network, neigh)
                             if data.get('rr_dir') == 'down':
@@ -533,24 +537,9 @@ class NetkitCompiler:
 
                 if router in ebgp_graph:
                     external_peers = []
-                    for peer in ebgp_graph.neighbors(router):
-                        route_maps_in = self.network.g_session[peer][router]['ingress']
-                        rm_group_name_in = None
-                        if len(route_maps_in):
-                            rm_group_name_in = "rm_%s_in" % peer.folder_name
-                            route_map_groups[rm_group_name_in] = [match_tuple 
-                                    for route_map in route_maps_in
-                                    for match_tuple in route_map.match_tuples]
-
-# Now need to update the sequence numbers for the flattened route maps
-
-                        route_maps_out = self.network.g_session[router][peer]['egress']
-                        rm_group_name_out = None
-                        if len(route_maps_out):
-                            rm_group_name_out = "rm_%s_out" % peer.folder_name
-                            route_map_groups[rm_group_name_out] = [match_tuple 
-                                    for route_map in route_maps_out
-                                    for match_tuple in route_map.match_tuples]
+                    for peer in sorted(ebgp_graph.neighbors(router), key = self.network.fqdn):
+                        rm_group_name_in = policy.peers[peer].route_map_group_in
+                        rm_group_name_out = policy.peers[peer].route_map_group_out
 
                         peer_ip = physical_graph[peer][router]['ip'] 
 
@@ -563,25 +552,19 @@ class NetkitCompiler:
                             'type': 'external', 
                             'neighbors': external_peers}
 
-# Ensure only one copy of each route map, can't use set due to list inside tuples (which won't hash)
-# Use dict indexed by name, and then extract the dict items, dict hashing ensures only one route map per name
-                community_lists = {}
-                prefix_lists = {}
-                node_bgp_data = self.network.g_session.node.get(router)
-                if node_bgp_data:
-                    community_lists = node_bgp_data.get('tags')
-                    prefix_lists = node_bgp_data.get('prefixes')
+# Route map groups are already named once per router, with identical route maps shared, by compile_bgp_policy
+                community_lists = policy.community_lists
+                prefix_lists = policy.prefix_lists
                 policy_options = {
                 'community_lists': community_lists,
                 'prefix_lists': prefix_lists,
-                'route_maps': route_map_groups,
+                'route_maps': policy.route_map_groups,
                 }
             
-                f_handle = open(os.path.join(zebra_dir(self.network, router),
-                                                "bgpd.conf"),'wb')
-
                 #TODO: remove community_lists and prefix_lists as they are put into policy_options
-                f_handle.write(template.render(
+                jobs.append(render_job("quagga/bgp.mako",
+                    os.path.join(zebra_dir(self.network, router), "bgpd.conf"),
+                    dict(
                         hostname = router.device_hostname,
                         asn = self.network.asn(router),
                         password = self.zebra_password,
@@ -602,7 +585,8 @@ class NetkitCompiler:
                         dump=False,
                         snmp=False,
                         interfaces = self.configure_interfaces(router)
-                ))
+                ), router.rtr_folder_name))
+        return jobs
 
     def configure_dns(self):
         """Generates BIND configuration files for DNS
@@ -628,21 +612,10 @@ class NetkitCompiler:
         named::
 
             bash-3.2$ named-checkconf ank_lab/netkit_lab/AS3_l3_3_dns_1/etc/bind/named.conf 
-        
+
+        Returns render jobs for the files, rendered by configure.
         """
-        import netaddr
-        ip_localhost = netaddr.IPAddress("127.0.0.1")
         linux_bind_dir = "/etc/bind"
-        resolve_template = lookup.get_template("linux/resolv.mako")
-        forward_template = lookup.get_template("bind/forward.mako")
-
-        named_template = lookup.get_template("bind/named.mako")
-        reverse_template = lookup.get_template("bind/reverse.mako")
-        root_template = lookup.get_template("bind/root.mako")
-
-        root_dns_template = lookup.get_template("bind/root_dns.mako")
-        root_dns_named_template = lookup.get_template("bind/root_dns_named.mako")
-
         ip_as_allocs = ank.get_ip_as_allocs(self.network)
 
         dns_servers = ank.dns_servers(self.network)
@@ -650,9 +623,9 @@ class NetkitCompiler:
         auth_servers = ank.dns.dns_auth_servers(self.network)
         caching_servers = ank.dns.dns_cache_servers(self.network)
         clients = ank.dns.dns_clients(self.network)
-        routers = set(self.network.routers())
 
-#TODO: use with for opening files
+# Contexts are built here, the files are then rendered by configure
+        jobs = []
 
         for server in root_servers:
             children = ank.dns.dns_hiearchy_children(server)
@@ -661,70 +634,62 @@ class NetkitCompiler:
                 advertise_block = ip_as_allocs[child.asn]
                 reverse_identifier = ank.rev_dns_identifier(advertise_block)
                 child_servers.append( (child.domain, reverse_identifier, ank.server_ip(child)))
-            f_root_db = open(os.path.join(bind_dir(self.network, server), "db.root"), 'wb') 
-            f_root_db.write( root_dns_template.render(
-                dns_servers = child_servers,
-                server = server,
-            ))
-
-            f_named = open( os.path.join(bind_dir(self.network, server), "named.conf"), 'wb')
-            f_named.write(root_dns_named_template.render(
-                logging = False,
-            ))
+# Sorted by domain, the order the template lists servers
+            child_servers.sort(key = lambda (domain, reverse, ip): domain)
+            jobs.append(render_job("bind/root_dns.mako",
+                os.path.join(bind_dir(self.network, server), "db.root"), {
+                'dns_servers': child_servers,
+                'server_ip': server.lo_ip.ip,
+                }, server.rtr_folder_name))
+            jobs.append(render_job("bind/root_dns_named.mako",
+                os.path.join(bind_dir(self.network, server), "named.conf"), {
+                'logging': False,
+                }, server.rtr_folder_name))
 
         for server in caching_servers:
             #root_db_hint = ( ("ns.AS%s" % n.asn, ank.server_ip(n)) for n in ank.dns_hiearchy_parents(server))
-            root_db_hint = ( ("ROOT-SERVER", ank.server_ip(n)) for n in root_servers)
-            root_db_hint = list(root_db_hint)
+            root_db_hint = [("ROOT-SERVER", ank.server_ip(n)) for n in root_servers]
 #TODO: make caching use parent rather than global root
-            f_root = open( os.path.join(bind_dir(self.network, server), "db.root"), 'wb')
-            f_root.write( root_template.render( root_servers = root_db_hint))
-            f_named = open( os.path.join(bind_dir(self.network, server), "named.conf"), 'wb')
-            f_named.write(named_template.render(
-                entry_list = [],
-                bind_dir = linux_bind_dir,
-                logging = False,
-            ))
-            f_named.close()
+            jobs.append(render_job("bind/root.mako",
+                os.path.join(bind_dir(self.network, server), "db.root"), {
+                'root_servers': root_db_hint,
+                }, server.rtr_folder_name))
+            jobs.append(render_job("bind/named.mako",
+                os.path.join(bind_dir(self.network, server), "named.conf"), {
+                'entry_list': [],
+                'bind_dir': linux_bind_dir,
+                'logging': False,
+                }, server.rtr_folder_name))
 
         for server in auth_servers:
-            named_list = []
-            advertise_links = list(ank.advertise_links(server))
-            advertise_hosts = list(ank.dns_auth_children(server))
+            advertise_links = ank.advertise_links(server)
+            advertise_hosts = ank.dns_auth_children(server)
             LOG.debug("DNS server %s advertises %s" % (server, advertise_links))
 #TODO: make reverse dns handle domains other than /8 /16 /24
             advertise_block = ip_as_allocs[server.asn]
+            prefixlen = advertise_block.prefixlen
 # remove trailing fullstop
             reverse_identifier = ank.rev_dns_identifier(advertise_block).rstrip(".")
 #TODO: look at using advertise_block.network.reverse_dns - check what Bind needs
-            named_list.append(reverse_identifier)
-
-            f_named = open( os.path.join(bind_dir(self.network, server), "named.conf"), 'wb')
-            f_named.write(named_template.render(
-                domain = server.domain,
-                entry_list = named_list,
-                bind_dir = linux_bind_dir,
-                logging = False,
-            ))
-            f_named.close()
-
-            for_entry_list = list( (self.interface_id(link.id), link.local_host.dns_host_portion_only, link.ip) 
-                    for link in advertise_links)
-# Add loopbacks for routers
-            for_entry_list += ( (self.lo_interface(0), host.dns_host_portion_only, host.lo_ip.ip)
-                    #TODO: make thise check l3 group rather than asn (generalise)
-                    for host in advertise_hosts if host.is_router and host.asn == server.asn)
-            
-            rev_entry_list = list( 
-                    (ank.reverse_subnet(link.ip, advertise_block.prefixlen), self.interface_id(link.id), link.local_host.dns_hostname) 
-                    for link in advertise_links)
-            # Add loopbacks for routers
-            rev_entry_list += ( (ank.reverse_subnet(host.lo_ip.ip, advertise_block.prefixlen), self.lo_interface(0), host.dns_host_portion_only)
-                    #TODO: make thise check l3 group rather than asn (generalise)
-                    for host in advertise_hosts if host.is_router and host.asn == server.asn)
 
-            #TODO: provide better way to get eg eth0.host than string concat inside the template
+            jobs.append(render_job("bind/named.mako",
+                os.path.join(bind_dir(self.network, server), "named.conf"), {
+                'domain': server.domain,
+                'entry_list': [reverse_identifier],
+                'bind_dir': linux_bind_dir,
+                'logging': False,
+                }, server.rtr_folder_name))
+
+# Forward and reverse entries for each advertised ip, in one pass
+            for_entry_list = []
+            rev_entry_list = []
+            for link in advertise_links:
+                int_id = self.interface_id(link.id)
+                for_entry_list.append( (int_id, link.local_host.dns_host_portion_only, link.ip))
+                rev_entry_list.append( (ank.reverse_subnet(link.ip, prefixlen),
+                    int_id, link.local_host.dns_hostname))
 
+            #TODO: provide better way to get eg eth0.host than string concat inside the template
             host_cname_list = []
             for host in advertise_hosts:
                 if host.asn != server.asn:
@@ -733,6 +698,11 @@ class NetkitCompiler:
                     continue
 
                 if host.is_router:
+# Add loopbacks for routers
+                    lo_ip = host.lo_ip.ip
+                    for_entry_list.append( (self.lo_interface(0), host.dns_host_portion_only, lo_ip))
+                    rev_entry_list.append( (ank.reverse_subnet(lo_ip, prefixlen),
+                        self.lo_interface(0), host.dns_host_portion_only))
 # has lo_ip
                     cname = "%s.%s" % (self.lo_interface(), host.dns_host_portion_only)
                 else:
@@ -742,66 +712,86 @@ class NetkitCompiler:
             
                 host_cname_list.append( (host.dns_host_portion_only, cname))
 
-            #Sort to make format nicer
-            host_cname_list = sorted(host_cname_list, key = lambda x: x[1])
-            for_entry_list = sorted(for_entry_list)
-            for_entry_list = sorted(for_entry_list, key = lambda x: x[1])
+# Sort once, in the order the templates list entries: forward by ip then host
+            for_entry_list.sort(key = lambda (int_id, host, ip): (ip, host, int_id))
+            rev_entry_list.sort()
+            host_cname_list.sort()
             
-            f_forward = open ( os.path.join(bind_dir(self.network, server), "db.%s" % server.domain), 'wb')
-            f_forward.write(forward_template.render(
-                        domain = server.domain,
-                        entry_list = for_entry_list,
-                        host_cname_list =  host_cname_list,
-                        dns_server = server.dns_hostname,
-                        dns_server_ip = ank.server_ip(server),
-                ))
-
-            f_reverse = open(os.path.join(bind_dir(self.network, server), "db.%s" % reverse_identifier), 'wb')
-
-            f_reverse.write(reverse_template.render(
-                domain = server.domain,
-                identifier = reverse_identifier,
-                entry_list = rev_entry_list,
-                dns_server= server.dns_hostname,
-                ))
+            jobs.append(render_job("bind/forward.mako",
+                os.path.join(bind_dir(self.network, server), "db.%s" % server.domain), {
+                'domain': server.domain,
+                'entry_list': for_entry_list,
+                'host_cname_list': host_cname_list,
+                'dns_server': server.dns_hostname,
+                'dns_server_ip': ank.server_ip(server),
+                }, server.rtr_folder_name))
+
+            jobs.append(render_job("bind/reverse.mako",
+                os.path.join(bind_dir(self.network, server), "db.%s" % reverse_identifier), {
+                'domain': server.domain,
+                'identifier': reverse_identifier,
+                'entry_list': rev_entry_list,
+                'dns_server': server.dns_hostname,
+                }, server.rtr_folder_name))
 
             #TODO: make l2 use l3 for caching
 #TODO: ROOT-SERVER can't be part of a domain...  - need to correctly handle case of multiple root servers
 # and also need to handle this for case of single root server (ie no hiearchy) probably ok as /etc/resolv.conf points to server itself, not through dns hints
-            root_db_hint = ( ("ROOT-SERVER", ank.server_ip(n)) for n in ank.dns_hiearchy_parents(server))
-            f_root = open( os.path.join(bind_dir(self.network, server), "db.root"), 'wb')
-            f_root.write( root_template.render( root_servers = root_db_hint))
+            root_db_hint = [("ROOT-SERVER", ank.server_ip(n)) for n in ank.dns_hiearchy_parents(server)]
+            jobs.append(render_job("bind/root.mako",
+                os.path.join(bind_dir(self.network, server), "db.root"), {
+                'root_servers': root_db_hint,
+                }, server.rtr_folder_name))
 
         for server in dns_servers:
-            f_resolv = open( os.path.join(etc_dir(self.network, server), "resolv.conf"), 'wb')
-            f_resolv.write ( resolve_template.render(
-                nameservers = [ank.server_ip(server)],
-                domain = server.domain))
+            jobs.append(render_job("linux/resolv.mako",
+                os.path.join(etc_dir(self.network, server), "resolv.conf"), {
+                'nameservers': [ank.server_ip(server)],
+                'domain': server.domain,
+                }, server.rtr_folder_name))
 
 # Configure clients
         for client in clients:
-            server_ips = (ank.server_ip(server) for server in ank.dns_hiearchy_parents(client))
-            f_resolv = open( os.path.join(etc_dir(self.network, client), "resolv.conf"), 'wb')
-            f_resolv.write ( resolve_template.render(
-                nameservers = server_ips,
-                domain = client.domain))
+            server_ips = [ank.server_ip(server) for server in ank.dns_hiearchy_parents(client)]
+            jobs.append(render_job("linux/resolv.mako",
+                os.path.join(etc_dir(self.network, client), "resolv.conf"), {
+                'nameservers': server_ips,
+                'domain': client.domain,
+                }, client.rtr_folder_name))
 
-        return
+        return jobs
 
     def configure(self):
         """Configure Netkit"""
         LOG.info("Configuring Netkit")
-        self.configure_netkit()
-        self.configure_igp()
-        self.configure_bgp()
-        self.configure_dns()
-
-        # create .tgz
+        # create .tgz, files added as they are rendered
         tar_filename = "netkit_%s.tar.gz" % time.strftime("%Y%m%d_%H%M", time.localtime())
-        tar = tarfile.open(os.path.join(config.ank_main_dir, tar_filename), "w:gz")
 # Store using directory structure, eg ank_lab/netkit_lab/
 # Note: this differs to Junos which flattens file structure
-        tar.add(lab_dir())
+        self.manifest = None
+        if self.incremental:
+            self.manifest = render_manifest(lab_dir(), self.write_lab_dir)
+        else:
+            remove_manifest(lab_dir())
+        output = lab_output(lab_dir(),
+                os.path.join(config.ank_main_dir, tar_filename),
+                write_files = self.write_lab_dir, manifest = self.manifest)
+        try:
+# Jobs from each step are rendered together, so a single pool of workers is used
+            jobs = self.configure_netkit(output)
+            jobs += self.configure_igp()
+            jobs += self.configure_bgp()
+            jobs += self.configure_dns()
+            render_jobs(lookup, jobs, self.jobs, self.manifest, output)
+            if self.manifest is not None:
+                self.manifest.save()
+# Netkit needs root/.ssh for key login, even if no key is set
+            for device in self.network.devices():
+                output.add_directory(dot_ssh_dir(self.network, device))
+        except:
+            output.discard()
+            raise
+        finally:
+            output.close()
         self.network.compiled_labs['netkit'] = tar_filename
-        tar.close()
 
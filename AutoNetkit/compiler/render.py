@@ -0,0 +1,449 @@
+"""
+Render templates to files, optionally fanned out over a pool of worker processes
+
+A render_manifest records a hash of each file's template and context, so
+unchanged files need not be rendered again on the next compile.
+A lab_output adds files to the lab archive as they are written,
+rather than the archive being built by walking the lab directory afterwards.
+"""
+import os
+import time
+import hashlib
+import json
+import itertools
+import posixpath
+import tarfile
+import multiprocessing
+import cPickle as pickle
+from cStringIO import StringIO
+from collections import namedtuple
+
+import logging
+LOG = logging.getLogger("ANK")
+
+from AutoNetkit import config
+from AutoNetkit.internal.workers import worker_count
+
+# Lookup used by worker processes, set by the pool initializer
+_worker_lookup = None
+
+# Context entries that only record when a file was generated, so are not
+# enough on their own to render the file again
+TIMESTAMP_KEYS = frozenset(['date', 'lab_version'])
+
+class render_job (namedtuple('render_job', "template, filename, context, device")):
+    """A template to render with the context dict, written to filename.
+    Contexts sent to worker processes must be picklable, so should hold
+    plain values (strings, IP addresses, lists) rather than devices.
+    Device is the name of the device the file configures, if any."""
+    __slots__ = ()
+    def __new__(cls, template, filename, context, device=None):
+        return super(render_job, cls).__new__(cls, template, filename, context,
+                device)
+
+    def __repr__(self):
+        return "%s -> %s" % (self.template, self.filename)
+
+class render_manifest(object):
+    """Hashes of the files rendered into lab_dir, from one compile to the next.
+    Stored alongside lab_dir, so is kept when the lab directory is cleared.
+    If write_files is False, files only go into the lab archive, so the
+    manifest keeps describing the files already in lab_dir.
+
+    >>> import tempfile, shutil
+    >>> from mako.lookup import TemplateLookup
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> lab = os.path.join(tmp_dir, "lab")
+    >>> os.mkdir(lab)
+    >>> open(os.path.join(tmp_dir, "t.mako"), "w").write("hello ${name}")
+    >>> lookup = TemplateLookup(directories=[tmp_dir])
+    >>> def compile(names):
+    ...     manifest = render_manifest(lab)
+    ...     render_jobs(lookup, [render_job("t.mako", os.path.join(lab, name),
+    ...         {'name': name}, name) for name in names], 1, manifest)
+    ...     manifest.save()
+    ...     print ", ".join(sorted(manifest.changed_devices))
+    >>> compile(["a", "b"])
+    a, b
+    >>> compile(["a", "b"])
+    <BLANKLINE>
+    >>> compile(["a", "c"])
+    b, c
+    >>> sorted(os.listdir(lab))
+    ['a', 'c']
+
+    Files written directly are recorded, so are also removed once no longer
+    written, along with directories this leaves empty:
+
+    >>> def write_key(key):
+    ...     manifest = render_manifest(lab)
+    ...     output = lab_output(lab, manifest = manifest)
+    ...     if key:
+    ...         output.write(os.path.join(lab, "d", ".ssh", "key"), key, "d")
+    ...     manifest.save()
+    ...     print ", ".join(sorted(manifest.changed_devices))
+    >>> os.makedirs(os.path.join(lab, "d", ".ssh"))
+    >>> write_key("abc")
+    a, c, d
+    >>> write_key("abc")
+    <BLANKLINE>
+    >>> write_key(None)
+    d
+    >>> sorted(os.listdir(lab))
+    []
+
+    Files not written to lab_dir are not recorded, so are written next time:
+
+    >>> def compile_to(name, write_files):
+    ...     manifest = render_manifest(lab, write_files)
+    ...     output = lab_output(lab, os.path.join(tmp_dir, "lab.tar.gz"),
+    ...             write_files = write_files, manifest = manifest)
+    ...     render_jobs(lookup, [render_job("t.mako", os.path.join(lab, "a"),
+    ...         {'name': name}, "a")], 1, manifest, output)
+    ...     manifest.save()
+    ...     output.close()
+    ...     print open(os.path.join(lab, "a")).read()
+    >>> compile_to("A", True)
+    hello A
+    >>> compile_to("B", False)
+    hello A
+    >>> compile_to("B", True)
+    hello B
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    def __init__(self, lab_dir, write_files=True):
+        self.lab_dir = lab_dir
+        self.write_files = write_files
+        self.manifest_file = manifest_filename(lab_dir)
+        self.previous = {}
+        try:
+            with open(self.manifest_file) as f_manifest:
+                self.previous = json.load(f_manifest)['files']
+        except IOError:
+            pass
+        except (ValueError, KeyError), e:
+            LOG.debug("Unable to read manifest %s: %s" % (self.manifest_file, e))
+        self.current = {}
+        self.changed_files = set()
+        self.changed_devices = set()
+        self._template_hashes = {}
+
+    def template_hash(self, lookup, template):
+        try:
+            return self._template_hashes[template]
+        except KeyError:
+            source = lookup.get_template(template).source
+            if isinstance(source, unicode):
+                source = source.encode("utf-8")
+            digest = hashlib.sha1(source).hexdigest()
+            self._template_hashes[template] = digest
+            return digest
+
+    def job_hash(self, lookup, job):
+        """Hash of the template and context for job, None if can't be hashed"""
+        context = sorted( (key, val) for key, val in job.context.items()
+                if key not in TIMESTAMP_KEYS)
+        try:
+            context = pickle.dumps(context, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return None
+        return hashlib.sha1(self.template_hash(lookup, job.template) +
+                context).hexdigest()
+
+    def select(self, lookup, jobs):
+        """Records jobs, and returns those which need rendering:
+        where the hash has changed, or the file is missing"""
+        to_render = []
+        for job in jobs:
+            name = os.path.relpath(job.filename, self.lab_dir)
+            digest = self.job_hash(lookup, job)
+            previous = self.previous.get(name)
+            self.add_current(name, digest, job.device, previous)
+            if digest is None or previous is None or previous[0] != digest:
+                self.changed_files.add(name)
+                if job.device:
+                    self.changed_devices.add(job.device)
+                to_render.append(job)
+            elif not os.path.isfile(job.filename):
+                to_render.append(job)
+        return to_render
+
+    def record(self, filename, digest, device=None):
+        """Records a file written directly, rather than rendered from a job"""
+        name = os.path.relpath(filename, self.lab_dir)
+        previous = self.previous.get(name)
+        self.add_current(name, digest, device, previous)
+        if previous is None or previous[0] != digest:
+            self.changed_files.add(name)
+            if device:
+                self.changed_devices.add(device)
+
+    def add_current(self, name, digest, device, previous):
+        """Records the digest of name, if written to lab_dir. Otherwise the
+        file in lab_dir is left as it was, so keeps its previous entry."""
+        if self.write_files:
+            self.current[name] = [digest, device]
+        elif previous is not None:
+            self.current[name] = previous
+
+    def remove_empty_dirs(self, name):
+        """Removes directories left empty by removing name, up to lab_dir"""
+        parent = os.path.dirname(name)
+        while parent:
+            try:
+                os.rmdir(os.path.join(self.lab_dir, parent))
+            except OSError:
+# Not empty, or already removed
+                return
+            parent = os.path.dirname(parent)
+
+    def save(self):
+        """Removes files written by the previous compile but not by this one,
+        and any directories this leaves empty, then writes the manifest.
+        If files are not written to lab_dir, they are left in place."""
+        for name in set(self.previous) - set(self.current):
+            (digest, device) = self.previous[name]
+            self.changed_files.add(name)
+            if device:
+                self.changed_devices.add(device)
+            if not self.write_files:
+                self.current[name] = self.previous[name]
+                continue
+            try:
+                os.unlink(os.path.join(self.lab_dir, name))
+            except OSError:
+                pass
+            self.remove_empty_dirs(name)
+        LOG.info("%s of %s files changed, for %s devices" % (len(self.changed_files),
+            len(self.current), len(self.changed_devices)))
+        with open(self.manifest_file, 'wb') as f_manifest:
+            json.dump({
+                'files': self.current,
+                'changed_files': sorted(self.changed_files),
+                'changed_devices': sorted(self.changed_devices),
+                }, f_manifest, indent=1, sort_keys=True)
+
+def manifest_filename(lab_dir):
+    return "%s.manifest" % lab_dir.rstrip(os.sep)
+
+def remove_manifest(lab_dir):
+    """Removes the manifest of lab_dir, for compiles that don't keep one:
+    the files they write leave it out of date"""
+    try:
+        os.unlink(manifest_filename(lab_dir))
+    except OSError:
+        pass
+
+class lab_output(object):
+    """Files of a compiled lab, written to lab_dir and, if archive is set,
+    streamed into the tar.gz archive as they are written. Members are named as
+    tarfile.add(lab_dir, arcname) would name them.
+    If write_files is False, files only go into the archive.
+    If a render_manifest is given, files written are recorded in it.
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> lab = os.path.join(tmp_dir, "lab")
+    >>> archive = os.path.join(tmp_dir, "lab.tar.gz")
+    >>> output = lab_output(lab, archive, arcname = "lab", write_files = False)
+    >>> output.write(os.path.join(lab, "r1", "r1.conf"), "hostname r1")
+    >>> output.write(os.path.join(lab, "r1", "shadow"), "root::", mode = 0600)
+    >>> output.add_directory(os.path.join(lab, "r1", ".ssh"))
+    >>> output.close()
+    >>> os.path.exists(lab)
+    False
+    >>> tar = tarfile.open(archive)
+    >>> [(member.name, oct(member.mode)) for member in tar.getmembers()]
+    [('lab', '0755'), ('lab/r1', '0755'), ('lab/r1/r1.conf', '0644'), ('lab/r1/shadow', '0600'), ('lab/r1/.ssh', '0755')]
+    >>> tar.extractfile('lab/r1/r1.conf').read()
+    'hostname r1'
+    >>> tar.close()
+
+    A lab that fails to compile doesn't leave a partial archive:
+
+    >>> output = lab_output(lab, archive, write_files = False)
+    >>> output.discard()
+    >>> os.path.exists(archive)
+    False
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    def __init__(self, lab_dir, archive=None, arcname=None, write_files=True,
+            manifest=None):
+        self.lab_dir = lab_dir
+        self.manifest = manifest
+        self.archive = archive
+        self.tar = None
+        if archive:
+            self.tar = tarfile.open(archive, "w:gz")
+        # Nowhere else for the files to go
+        self.write_files = write_files or self.tar is None
+        if arcname is None:
+            arcname = lab_dir
+        self.arcname = arcname.replace(os.sep, "/").lstrip("/")
+        self.directories = set()
+        self.mtime = time.time()
+
+    @property
+    def streaming(self):
+        """True if rendered files need to be passed to write"""
+        return self.tar is not None
+
+    def member_name(self, filename):
+        name = os.path.relpath(filename, self.lab_dir).replace(os.sep, "/")
+        if self.arcname:
+            return posixpath.join(self.arcname, name)
+        return name
+
+    def add_directories(self, name):
+        """Adds entries for the directories containing name, from the lab
+        directory down"""
+        parent = posixpath.dirname(name)
+        if (parent in self.directories or parent == posixpath.dirname(self.arcname)):
+            return
+        self.add_directories(parent)
+        self.directories.add(parent)
+        tarinfo = tarfile.TarInfo(parent)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0755
+        tarinfo.mtime = self.mtime
+        self.tar.addfile(tarinfo)
+
+    def add_directory(self, dirname):
+        """Adds dirname, even if no files are written to it"""
+        if self.write_files and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if self.tar is not None:
+            self.add_directories(posixpath.join(self.member_name(dirname), ""))
+
+    def write(self, filename, data, device=None, mode=None):
+        """Writes data to filename, recording it in the manifest.
+        Device is the name of the device the file configures, if any.
+        Mode is the file permissions, None for the default."""
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if self.manifest is not None:
+            self.manifest.record(filename, hashlib.sha1(data).hexdigest(), device)
+        self.add(filename, data, mode)
+
+    def add(self, filename, data, mode=None):
+        """Writes data to filename, without recording it in the manifest.
+        Used for rendered files, already recorded by render_manifest.select"""
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if self.write_files:
+            with open(filename, 'wb') as f_out:
+                f_out.write(data)
+            if mode is not None:
+                os.chmod(filename, mode)
+        if self.tar is not None:
+            name = self.member_name(filename)
+            self.add_directories(name)
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tarinfo.mode = 0644 if mode is None else mode
+            tarinfo.mtime = self.mtime
+            self.tar.addfile(tarinfo, StringIO(data))
+
+    def add_existing(self, filename):
+        """Adds filename, already written to disk, to the archive"""
+        if self.tar is not None:
+            name = self.member_name(filename)
+            self.add_directories(name)
+            self.tar.add(filename, arcname = name, recursive = False)
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def discard(self):
+        """Closes and removes the archive, if the lab was not fully written"""
+        self.close()
+        if self.archive and os.path.isfile(self.archive):
+            os.unlink(self.archive)
+
+def render_text(lookup, job):
+    """Returns the output of a single job"""
+    template = lookup.get_template(job.template)
+    return template.render(**job.context)
+
+def render_file(lookup, job):
+    """Renders a single job"""
+    with open(job.filename, 'wb') as f_out:
+        f_out.write(render_text(lookup, job))
+
+def _init_worker(lookup):
+    global _worker_lookup
+    _worker_lookup = lookup
+
+def _render_in_worker(job):
+    render_file(_worker_lookup, job)
+
+def _render_text_in_worker(job):
+    return render_text(_worker_lookup, job)
+
+def render_jobs(lookup, jobs, workers=None, manifest=None, output=None):
+    """Renders jobs, using a pool of worker processes if more than one worker.
+    Each job writes its own file, so output does not depend on worker order.
+    If a render_manifest is given, only jobs it selects are rendered.
+    If a streaming lab_output is given, rendered files are added to its
+    archive in job order. Workers still write the files if the output writes
+    files, and only pass rendered text back if it doesn't.
+
+    >>> import os, tempfile, shutil
+    >>> from mako.lookup import TemplateLookup
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> open(os.path.join(tmp_dir, "t.mako"), "w").write("hello ${name}")
+    >>> jobs = [render_job("t.mako", os.path.join(tmp_dir, "out_%s" % i), {'name': i})
+    ...         for i in range(4)]
+    >>> render_jobs(TemplateLookup(directories=[tmp_dir]), jobs, workers=2)
+    >>> [open(job.filename).read() for job in jobs]
+    ['hello 0', 'hello 1', 'hello 2', 'hello 3']
+    >>> shutil.rmtree(tmp_dir)
+    """
+    jobs = list(jobs)
+    # A later job for the same file replaces earlier ones, as if written in order
+    latest = dict( (job.filename, index) for index, job in enumerate(jobs))
+    jobs = [job for index, job in enumerate(jobs) if latest[job.filename] == index]
+    streaming = output is not None and output.streaming
+    if manifest is not None:
+        selected = manifest.select(lookup, jobs)
+        if streaming:
+            # Unchanged files are not rendered, but still belong in the archive
+            selected_files = set(job.filename for job in selected)
+            for job in jobs:
+                if job.filename not in selected_files:
+                    output.add_existing(job.filename)
+        jobs = selected
+    workers = min(worker_count(workers), len(jobs))
+    # Load templates before forking so workers inherit them compiled
+    for template in set(job.template for job in jobs):
+        lookup.get_template(template)
+    if workers <= 1:
+        for job in jobs:
+            if streaming:
+                output.add(job.filename, render_text(lookup, job))
+            else:
+                render_file(lookup, job)
+        return
+
+    LOG.debug("Rendering %s files using %s workers" % (len(jobs), workers))
+    pool = multiprocessing.Pool(workers, _init_worker, (lookup,))
+    chunksize = max(1, len(jobs)/(4*workers))
+    try:
+        if streaming and not output.write_files:
+            results = pool.imap(_render_text_in_worker, jobs, chunksize)
+            for job, text in itertools.izip(jobs, results):
+                output.add(job.filename, text)
+        else:
+            pool.map(_render_in_worker, jobs, chunksize)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    if streaming and output.write_files:
+        for job in jobs:
+            output.add_existing(job.filename)
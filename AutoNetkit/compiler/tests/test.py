@@ -1,4 +1,6 @@
 import os
+import stat
+import tarfile
 import AutoNetkit
 import AutoNetkit.config as config
 from pkg_resources import resource_filename
@@ -190,3 +192,79 @@ def test_cbgp():
             master_file.splitlines(True)))
         LOG.warn(message)
         raise AssertionError
+
+def test_netkit_incremental():
+    lab = os.path.join(config.ank_main_dir, "netkit_lab")
+    f_keys = os.path.join(lab, "1c_AS1", "root", ".ssh", "authorized_keys")
+    f_sshd = os.path.join(lab, "1c_AS1", "etc", "ssh", "sshd_config")
+    settings = (config.settings['Lab']['incremental'],
+            config.settings['Netkit']['ssh key'])
+    config.settings['Lab']['incremental'] = True
+    try:
+        config.settings['Netkit']['ssh key'] = "ssh-rsa AAAA test"
+        AutoNetkit.internet.Internet("multias", netkit=True).compile()
+        assert(open(f_keys).read() == "ssh-rsa AAAA test")
+        os.utime(f_sshd, (0, 0))
+
+        # Key cleared: authorized_keys is removed, unchanged files are kept
+        config.settings['Netkit']['ssh key'] = ""
+        AutoNetkit.internet.Internet("multias", netkit=True).compile()
+        assert(not os.path.exists(f_keys))
+        assert(os.stat(f_sshd).st_mtime == 0)
+
+        # Full compiles keep no manifest, and remove any left out of date
+        config.settings['Lab']['incremental'] = False
+        AutoNetkit.internet.Internet("multias", netkit=True).compile()
+        assert(not os.path.exists("%s.manifest" % lab))
+    finally:
+        (config.settings['Lab']['incremental'],
+                config.settings['Netkit']['ssh key']) = settings
+
+def test_netkit_archive():
+    inet = AutoNetkit.internet.Internet("multias", netkit=True)
+    inet.compile()
+    tar = tarfile.open(os.path.join(config.ank_main_dir,
+        inet.network.compiled_labs['netkit']))
+    members = dict( (member.name, member) for member in tar.getmembers())
+    tar.close()
+    # Shadow keeps the mode of the file it is copied from
+    shadow = resource_filename("AutoNetkit", "lib/shadow")
+    member = members["%s/shared/etc/shadow" % config.lab_dir.lstrip("/")]
+    assert(member.mode == stat.S_IMODE(os.stat(shadow).st_mode))
+    # Netkit needs root/.ssh, even if empty
+    member = members["%s/1c_AS1/root/.ssh" % config.lab_dir.lstrip("/")]
+    assert(member.isdir())
+
+def test_netkit_write_modes():
+    lab = os.path.join(config.ank_main_dir, "netkit_lab")
+    f_startup = os.path.join(lab, "shared.startup")
+    settings = (config.settings['Lab']['incremental'],
+            config.settings['Lab']['write lab dir'],
+            config.settings['Netkit']['ssh key'])
+    config.settings['Lab']['incremental'] = True
+    try:
+        # A key is set up by the shared startup file
+        config.settings['Netkit']['ssh key'] = "ssh-rsa AAAA test"
+        AutoNetkit.internet.Internet("multias", netkit=True).compile()
+        assert("chown" in open(f_startup).read())
+
+        # Archive only: the lab directory is left as it was
+        config.settings['Lab']['write lab dir'] = False
+        config.settings['Netkit']['ssh key'] = ""
+        inet = AutoNetkit.internet.Internet("multias", netkit=True)
+        inet.compile()
+        tar = tarfile.open(os.path.join(config.ank_main_dir,
+            inet.network.compiled_labs['netkit']))
+        archived = tar.extractfile("%s/shared.startup" % config.lab_dir.lstrip("/")).read()
+        tar.close()
+        assert("chown" not in archived)
+        assert("chown" in open(f_startup).read())
+
+        # Written again: the file is rendered, as the lab directory wasn't updated
+        config.settings['Lab']['write lab dir'] = True
+        AutoNetkit.internet.Internet("multias", netkit=True).compile()
+        assert(open(f_startup).read() == archived)
+    finally:
+        (config.settings['Lab']['incremental'],
+                config.settings['Lab']['write lab dir'],
+                config.settings['Netkit']['ssh key']) = settings
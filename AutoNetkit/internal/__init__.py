@@ -1,3 +1,5 @@
 from AutoNetkit.internal.decorators import *
 
 import AutoNetkit.internal.decorators
+import AutoNetkit.internal.cache
+import AutoNetkit.internal.workers
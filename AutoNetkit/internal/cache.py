@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed input files, keyed on file contents
+
+Stored in the [Cache] dir setting, or the template cache directory if not set.
+Least recently used entries are removed once the cache exceeds [Cache] size
+megabytes, 0 for no limit.
+"""
+__author__ = "\n".join(['Simon Knight'])
+#    Copyright (C) 2009-2012 by Simon Knight, Hung Nguyen
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import logging
+LOG = logging.getLogger("ANK")
+
+from AutoNetkit import config
+
+def content_key(filenames, *salt):
+    """Returns SHA-1 hex digest of salt followed by the contents of filenames.
+    Salt should include the version of the loader, so changes to the loader
+    invalidate old entries. Missing files are keyed as missing, so creating
+    them changes the key.
+
+    >>> import tempfile
+    >>> (f_handle, filename) = tempfile.mkstemp()
+    >>> os.write(f_handle, "abc")
+    3
+    >>> os.close(f_handle)
+    >>> content_key([filename], 1) == content_key([filename], 1)
+    True
+    >>> content_key([filename], 1) == content_key([filename], 2)
+    False
+    >>> missing_key = content_key([filename + ".missing"], 1)
+    >>> missing_key == content_key([filename], 1)
+    False
+    >>> os.unlink(filename)
+    """
+    key = hashlib.sha1(" ".join(str(x) for x in salt))
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f_source:
+                key.update("\n%s\n" % os.fstat(f_source.fileno()).st_size)
+                for chunk in iter(lambda: f_source.read(65536), ""):
+                    key.update(chunk)
+        except IOError:
+            key.update("\n(missing)\n")
+    return key.hexdigest()
+
+def cache_dir():
+    """Returns cache directory, None if caching is unavailable"""
+    directory = config.settings['Cache']['dir']
+    if not directory:
+        return config.template_cache_dir
+    directory = os.path.expanduser(directory)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            LOG.info("Unable to create cache dir %s, caching disabled: %s" % (directory, e))
+            return None
+    if not os.access(directory, os.W_OK):
+        LOG.info("Unable to write to cache dir %s, caching disabled" % directory)
+        return None
+    return directory
+
+def cache_file(prefix, key):
+    """Returns cache filename for key, None if caching is unavailable"""
+    directory = cache_dir()
+    if not directory:
+        return None
+    return os.path.join(directory, "%s_%s.pickle" % (prefix, key))
+
+def load(cache_file):
+    """Returns object stored in cache_file, or None if missing or unreadable"""
+    try:
+        with open(cache_file, 'rb') as f_cache:
+            obj = pickle.load(f_cache)
+    except IOError:
+        return None
+    except Exception, e:
+        LOG.debug("Unable to load cache %s: %s" % (cache_file, e))
+        return None
+# Mark as recently used
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+    return obj
+
+def prune(directory, max_bytes):
+    """Removes least recently used entries from directory until at most max_bytes.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> for index, name in enumerate(["a", "b", "c"]):
+    ...     cache_file = os.path.join(directory, "test_%s.pickle" % name)
+    ...     open(cache_file, "wb").write("x" * 10)
+    ...     os.utime(cache_file, (index, index))
+    >>> prune(directory, 25)
+    >>> sorted(os.listdir(directory))
+    ['test_b.pickle', 'test_c.pickle']
+    >>> shutil.rmtree(directory)
+    """
+    entries = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".pickle"):
+            continue
+        filename = os.path.join(directory, filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+# removed by another process
+            continue
+        entries.append( (stat.st_mtime, filename, stat.st_size))
+    total = sum(size for (mtime, filename, size) in entries)
+    for (mtime, filename, size) in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(filename)
+            LOG.debug("Removed cache entry %s" % filename)
+        except OSError:
+            pass
+        total -= size
+
+def save(cache_file, obj):
+    """Stores obj in cache_file.
+    Written to a temporary file then renamed, so concurrent readers never see a
+    partial cache."""
+    try:
+        (f_handle, tmp_file) = tempfile.mkstemp(dir = os.path.dirname(cache_file),
+                suffix = ".tmp")
+    except (IOError, OSError), e:
+        LOG.debug("Unable to write cache %s: %s" % (cache_file, e))
+        return
+    try:
+        with os.fdopen(f_handle, 'wb') as f_tmp:
+            pickle.dump(obj, f_tmp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, pickle.PicklingError), e:
+        LOG.debug("Unable to write cache %s: %s" % (cache_file, e))
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        return
+    max_size = config.settings['Cache']['size']
+    if max_size:
+        prune(os.path.dirname(cache_file), max_size * 1024 * 1024)
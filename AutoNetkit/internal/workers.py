@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Worker process counts for pools used when loading and rendering
+
+Set by the [Lab] jobs setting, 0 for one worker per CPU.
+"""
+__author__ = "\n".join(['Simon Knight'])
+#    Copyright (C) 2009-2012 by Simon Knight, Hung Nguyen
+
+import multiprocessing
+
+from AutoNetkit import config
+
+def worker_count(jobs=None):
+    """Number of worker processes to use, 0 means one per CPU
+
+    >>> worker_count(3)
+    3
+    >>> worker_count(0) == multiprocessing.cpu_count()
+    True
+    """
+    if jobs is None:
+        jobs = config.settings['Lab']['jobs']
+    if jobs == 0:
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    return jobs
@@ -9,9 +9,9 @@ $TTL 1D
                 )
                  
 @			IN	NS	ROOT-SERVER.
-ROOT-SERVER.		IN	A	${server.lo_ip.ip}    
+ROOT-SERVER.		IN	A	${server_ip}    
 
-% for (domain, reverse, ip) in sorted(dns_servers, key = lambda x: x[0]):
+% for (domain, reverse, ip) in dns_servers:
 ${domain}.				IN	NS	NS.${domain}.
 ${reverse}		IN	NS	NS.${domain}.
 NS.${domain}.		  	  IN	A 	${ip}
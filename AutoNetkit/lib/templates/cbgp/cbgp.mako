@@ -67,9 +67,9 @@ bgp router ${router}
 	bgp router ${router} add network ${prefix}
 % endfor     
 
-% for router, policy_data in sorted(bgp_policy.items()):    
+% for router, (policy, peers) in sorted(bgp_policy.items()):    
 bgp router ${router.lo_ip.ip} 
-	% for peer, peer_policy in sorted(policy_data.items()):
+	% for peer, peer_policy in sorted(peers.items()):
 	  % if peer.asn == router.asn:
 	peer ${peer.asn} ${peer.lo_ip.ip}
 	  % else:
@@ -88,9 +88,9 @@ bgp router ${router.lo_ip.ip}
 			    %if len(match_tuple.match_clauses):        
 			    %for match_clause in match_tuple.match_clauses:
 			        % if match_clause.type == "prefix_list":
-					match "prefix in prefix-list ${prefixes[match_clause.value]}"
+					match "${" | ".join("prefix is %s" % prefix for prefix in policy.prefix_subnets[match_clause.value])}"
 			        % elif match_clause.type == "tag":   
-					match "community is ${tags[match_clause.value]}"
+					match "community is ${policy.community_lists[match_clause.value]}"
 			        % endif      
 			    %endfor       
 				% else:
@@ -101,7 +101,7 @@ bgp router ${router.lo_ip.ip}
 					actions = []
 					for action_clause in match_tuple.action_clauses:  
 						if action_clause.action == "addTag":
-							actions.append("community add %s" % tags[action_clause.value])
+							actions.append("community add %s" % policy.community_lists[action_clause.value])
 						elif action_clause.action == "setLP":
 							actions.append("local-pref %s" % action_clause.value)
 						elif action_clause.action == "setMED":
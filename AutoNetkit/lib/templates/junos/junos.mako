@@ -159,11 +159,14 @@ policy-options {
 	% endfor         
 	
 	% for name, values in sorted(policy_options['prefix_lists'].items()): 
+	## lists with aggregates are matched with route-filters, as prefix-lists only match exactly
+	% if not any(entry.le for entry in values):
 	prefix-list ${name} {
-	    % for prefix in values: 
-			${prefix};
+	    % for entry in values: 
+			${entry.prefix};
 		% endfor
 	 }
+	% endif
 	% endfor    
 	%for route_map in policy_options['route_maps']:    
 	policy-statement ${route_map.name} { 
@@ -173,7 +176,17 @@ policy-options {
 		    from  {
 		    %for match_clause in match_tuple.match_clauses:
 		        % if match_clause.type == "prefix_list":
+				  % if any(entry.le for entry in policy_options['prefix_lists'].get(match_clause.value, [])):
+				    % for entry in policy_options['prefix_lists'][match_clause.value]:
+				      % if entry.le:
+		        route-filter ${entry.prefix} prefix-length-range /${entry.ge or entry.prefix.prefixlen}-/${entry.le};
+				      % else:
+		        route-filter ${entry.prefix} exact;
+				      % endif
+				    % endfor
+				  % else:
 		        prefix-list ${match_clause.value};
+				  % endif
 		        % elif match_clause.type == "tag":   
 				 	% if isinstance(match_clause.type, str):   
 			community ${match_clause.value};
@@ -185,19 +185,38 @@ class Network(object):
         self._graphs['bgp_session'] = nx.DiGraph()
         self._graphs['bgp_session'].graph['tags'] = {}
         self._graphs['bgp_session'].graph['prefixes'] = {}
+        self._graphs['bgp_session'].graph['prefix_subnets'] = {}
         self._graphs['dns'] = nx.DiGraph()
         self._graphs['dns_authoritative'] = nx.DiGraph()
         self.compiled_labs = {} # Record compiled lab filenames, and configs
+# Incremented by changed, so indexes built from the graphs are rebuilt
+        self.version = 0
 
     def __repr__(self):
         return "AutoNetkit network: %s nodes, %s edges" % (self.graph.number_of_nodes(), self.graph.number_of_edges())
 
+    def changed(self):
+        """Records that the graphs have changed, so indexes built from them,
+        such as the DNS role index and memoised BGP policy node selections,
+        are rebuilt on next use.
+        Called by the methods here that modify the graphs, code modifying the
+        graphs directly should call it once done.
+
+        >>> network = Network()
+        >>> version = network.version
+        >>> node = network.add_device("r1")
+        >>> network.version > version
+        True
+        """
+        self.version += 1
+
     @deprecated
     def update_node_type(self, default_type):
         """ Updates any node in graph that has no type set to be default_type"""
         for node, data in self.graph.nodes(data=True):
             if 'type' not in data: 
                 self.graph.node[node]['type'] = default_type
+        self.changed()
 
     # store network reference in node
 
@@ -206,6 +225,7 @@ class Network(object):
         #mapping = dict( device(n, self) for n in self.graph)
         mapping = dict( (n, device(self, n)) for n in self.graph)
         nx.relabel_nodes(self.graph, mapping, copy=False)
+        self.changed()
 
     def add_device(self, node_id, asn=None, device_type=None, **kwargs):
         """ Adds a device to the physical graph"""
@@ -220,6 +240,7 @@ class Network(object):
             LOG.info("Setting default device_type='router' for added device %s" % node_id)
         node = device(self, node_id)
         self.graph.add_node(node, asn=asn, device_type=device_type, **kwargs)
+        self.changed()
 # Return name for reference
         return node
 
@@ -237,6 +258,7 @@ class Network(object):
     @graph.setter
     def graph(self, value):
         self._graphs['physical'] = value
+        self.changed()
 
     @property
     def g_session(self):
@@ -245,6 +267,7 @@ class Network(object):
     @g_session.setter
     def g_session(self, value):
         self._graphs['bgp_session'] = value
+        self.changed()
 
     @property
     def g_dns(self):
@@ -253,6 +276,7 @@ class Network(object):
     @g_dns.setter
     def g_dns(self, value):
         self._graphs['dns'] = value
+        self.changed()
 
     @property
     def g_dns_auth(self):
@@ -261,6 +285,7 @@ class Network(object):
     @g_dns_auth.setter
     def g_dns_auth(self, value):
         self._graphs['dns_authoritative'] = value
+        self.changed()
 
     @deprecated
     def get_edges(self, node=None):
@@ -320,6 +345,7 @@ class Network(object):
         for node, data in self.graph.nodes(data=True):
             if prop not in data:
                 self.graph.node[node][prop] = value
+        self.changed()
 
     def neighbors(self, node):
         return self.graph.neighbors(node)
@@ -443,6 +469,7 @@ class Network(object):
     def add_link(self, src, dst):
         self.graph.add_edge(src, dst)
         self.graph.add_edge(dst, src)
+        self.changed()
 
     def link_count(self, node):
         # TODO: check in_degree == out_degree if not then WARN - or put into consistency check function
@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 """
 Example Topologies
+
+Examples are indexed once per process. Parsed graphs are held in memory, so
+loading the same example repeatedly does not re-parse the GraphML file.
 """
 __author__ = "\n".join(['Simon Knight'])
 #    Copyright (C) 2009-2012 by Simon Knight, Hung Nguyen
 
-__all__ = ['load_example']
+__all__ = ['load_example', 'example_names', 'example_info']
 import os
 from pkg_resources import resource_filename
 import AutoNetkit as ank
+from AutoNetkit.internal import cache
+from AutoNetkit.readwrite.graphml import file_key
+import networkx as nx
+import cPickle as pickle
+from collections import namedtuple
 
 
 import glob
@@ -16,25 +24,141 @@ import glob
 import logging
 LOG = logging.getLogger("ANK")
 
+# Version of example metadata, increment to invalidate cached metadata
+EXAMPLE_INFO_VERSION = 2
+
+# Example name -> filename, indexed on first use
+_example_files = None
+# Example name -> (files stat, pickled graph)
+_example_graphs = {}
+# Example name -> (files stat, topology_info)
+_example_info = {}
+# Example name -> other files its graph depends on, such as H graphs
+_example_depends = {}
+
+class topology_info (namedtuple('topology_info', "name, filename, nodes, edges, asns")):
+    """Size of an example topology, once loaded and normalised.
+    Edges counts each link once, rather than once per direction."""
+    __slots__ = ()
+    def __repr__(self):
+        return "%s: %s nodes, %s edges, %s ASes" % (self.name, self.nodes,
+                self.edges, self.asns)
+
+def topology_dir():
+    return resource_filename("AutoNetkit",
+                os.path.join("lib", "examples", "topologies"))
+
+def example_files():
+    """Returns dict of example name to filename, indexed on first call"""
+    global _example_files
+    if _example_files is None:
+        _example_files = {}
+        for filename in glob.glob(topology_dir() + os.sep + "*.graphml"):
+# Remove path and extension
+            name = os.path.splitext(os.path.split(filename)[1])[0]
+            _example_files[name] = filename
+    return _example_files
+
+def example_names():
+    """Returns sorted names of the included example topologies
+
+    >>> "multias" in example_names()
+    True
+    """
+    return sorted(example_files())
+
+def file_stat(filename):
+    """Size and modification time of filename, to detect changed examples.
+    None if filename does not exist."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+def example_stat(name, filename):
+    """Stat of an example and of the files its graph depends on, as found
+    when it was last loaded"""
+    return tuple(file_stat(dep_file) for dep_file in
+            [filename] + _example_depends.get(name, []))
 
 def load_example(filename):
     """
     Load example network
+
+    Each call returns a new graph, which can be modified without affecting
+    later loads.
+
+    >>> G = load_example("multias")
+    >>> G.remove_nodes_from(G.nodes())
+    >>> len(load_example("multias"))
+    8
     """
     # No extension, see if filename is an included example Topology
-    topology_dir =  resource_filename("AutoNetkit",
-                os.path.join("lib", "examples", "topologies"))
-    test_filename = os.path.join(topology_dir, "%s.graphml" % filename)
-    if os.path.isfile(test_filename):
-            LOG.info("Loading example topology %s " % filename)
-            return ank.load_graphml(test_filename)
-    else:
-            example_files = glob.glob(topology_dir + os.sep + "*.graphml")
-# Remove path
-            example_files = (os.path.split(filename)[1] for filename in example_files)
-# Remove extension
-            example_files = (os.path.splitext(filename)[0] for filename in example_files)
-            LOG.warn("Unable to find example topology %s" % filename)
-            LOG.info("Valid example topologies are: " + ", ".join(example_files))
-            
+    test_filename = example_files().get(filename)
+    if test_filename is None or not os.path.isfile(test_filename):
+        LOG.warn("Unable to find example topology %s" % filename)
+        LOG.info("Valid example topologies are: " + ", ".join(example_names()))
+        return
+    LOG.info("Loading example topology %s " % filename)
+    try:
+        (cached_stat, graph_pickle) = _example_graphs[filename]
+    except KeyError:
+        cached_stat = None
+    if cached_stat != example_stat(filename, test_filename):
+        depends = []
+        graph = ank.load_graphml(test_filename, depends = depends)
+        if graph is None:
+            return
+        _example_depends[filename] = depends
+# Stored pickled: unpickling a new copy is cheaper than a deepcopy
+        graph_pickle = pickle.dumps(graph, pickle.HIGHEST_PROTOCOL)
+        _example_graphs[filename] = (example_stat(filename, test_filename), graph_pickle)
+        return graph
+    return pickle.loads(graph_pickle)
+
+def example_info(name):
+    """Returns topology_info for example name, None if not an example.
+    Stored in the cache, so only needs the example to be loaded once.
+
+    >>> example_info("multias")
+    multias: 8 nodes, 10 edges, 3 ASes
+    """
+    filename = example_files().get(name)
+    if filename is None or not os.path.isfile(filename):
+        return None
+    try:
+        (cached_stat, info) = _example_info[name]
+        if cached_stat == example_stat(name, filename):
+            return info
+    except KeyError:
+        pass
 
+    key = cache.content_key([filename], EXAMPLE_INFO_VERSION, nx.__version__)
+    cache_file = cache.cache_file("example_info", key)
+    info = None
+    if cache_file:
+        cached = cache.load(cache_file)
+        try:
+            if all(file_key(dep_file) == dep_key for (dep_file, dep_key) in cached['depends']):
+                info = cached['info']
+                _example_depends[name] = [dep_file for (dep_file, dep_key) in cached['depends']]
+        except (KeyError, TypeError):
+            pass
+    if info is None:
+        graph = load_example(name)
+        if graph is None:
+            return None
+        links = set(frozenset(edge) for edge in graph.edges_iter())
+        asns = set(data.get('asn') for node, data in graph.nodes_iter(data=True))
+        info = topology_info(name, filename, graph.number_of_nodes(),
+                len(links), len(asns))
+        if cache_file:
+            cache.save(cache_file, {
+                'info': info,
+                'depends': [(dep_file, file_key(dep_file))
+                    for dep_file in _example_depends.get(name, [])],
+                })
+    info = info._replace(name = name, filename = filename)
+    _example_info[name] = (example_stat(name, filename), info)
+    return info
@@ -12,6 +12,12 @@ import itertools
 import pprint
 import AutoNetkit as ank
 import os
+from AutoNetkit.internal import cache
+from networkx.readwrite.graphml import GraphMLReader
+try:
+    from xml.etree.cElementTree import iterparse, Element
+except ImportError:
+    from xml.etree.ElementTree import iterparse, Element
 
 #TODO: make work with network object not self.ank
 #TODO: split into smaller (not exported) functions
@@ -21,113 +27,314 @@ LOG = logging.getLogger("ANK")
 config = ank.config
 settings = config.settings
 
-def load_graphml(net_file, default_asn = 1):
+# Version of the loaded graph, increment to invalidate cached graphs
+GRAPHML_LOADER_VERSION = 3
+
+def load_graphml(net_file, default_asn = 1, use_cache = True, depends = None):
     """
     Loads a network from Graphml into AutoNetkit.
+    The loaded graph is cached, keyed on the location and contents of net_file,
+    and checked against the contents of any H graphs used by graph products.
+    Other files the loaded graph depends on are appended to depends, if given.
     """
-    default_device_type = 'router'
-    path, filename = os.path.split(net_file)
-    net_name = os.path.splitext(filename)[0]
-    # get full path
-    path =  os.path.abspath(path)
-    pickle_dir = path + os.sep + "cache"
-    if not os.path.isdir(pickle_dir):
-        #os.mkdir(pickle_dir)
-        pass
-    pickle_file = "{0}/{1}.pickle".format(pickle_dir, net_name)
-#TODO: re-enable pickle
-    if (False and os.path.isfile(pickle_file) and
-        os.stat(net_file).st_mtime < os.stat(pickle_file).st_mtime):
-        # Pickle file exists, and source_file is older
-        input_graph = nx.read_gpickle(pickle_file)
-    else:
-        # No pickle file, or is outdated
-        input_graph = nx.read_graphml(net_file)
-        #nx.write_gpickle(input_graph, pickle_file)
+    if depends is None:
+        depends = []
+# H graphs are relative to net_file, so key on its location as well as contents
+    key = cache.content_key([net_file], GRAPHML_LOADER_VERSION, nx.__version__, default_asn,
+            os.path.abspath(net_file))
+    cache_file = None
+    if use_cache:
+        cache_file = cache.cache_file("graphml", key)
+    if cache_file:
+        cached = cache.load(cache_file)
+        try:
+            if all(file_key(dep_file) == dep_key for (dep_file, dep_key) in cached['depends']):
+                LOG.debug("Loaded %s from cache %s" % (net_file, cache_file))
+                depends += [dep_file for (dep_file, dep_key) in cached['depends']]
+                return cached['graph']
+        except (KeyError, TypeError):
+            pass
 
-    nodes_with_H_set = sum(1 for n in input_graph if input_graph.node[n].get('H'))
-    if nodes_with_H_set == len(input_graph):
-#all nodes have H set, apply graph products
-        LOG.info("All nodes in graph %s have H attribute set, applying graph product" % net_name)
-        input_graph = ank.graph_product(net_file)
-        if not input_graph:
-            LOG.warn("Unable to load graph %s" % net_file)
-            return
-# remap ('a', 2) -> 'a2'
-        nx.relabel_nodes(input_graph, 
-                dict( (n, "%s_%s" % (n[0], n[1])) for n in input_graph), copy=False)
-    
+    graph_depends = []
+    input_graph = read_graphml_network(net_file, default_asn, graph_depends)
+    depends += graph_depends
+    if input_graph and cache_file:
+        cache.save(cache_file, {
+            'graph': input_graph,
+            'depends': [(dep_file, file_key(dep_file)) for dep_file in graph_depends],
+            })
+    return input_graph
+
+def file_key(filename):
+    """Content key of filename, None if it does not exist"""
+    if os.path.isfile(filename):
+        return cache.content_key([filename])
+
+class GraphMLStreamReader(GraphMLReader):
+    """Reads the first graph in a GraphML file into the same graph as
+    nx.read_graphml, using its key, node and edge decoding. Elements are
+    decoded as they are parsed, and discarded once added to the graph, so
+    the whole document is never held in memory.
+
+    >>> from pkg_resources import resource_filename
+    >>> net_file = resource_filename("AutoNetkit", "lib/examples/topologies/2routers.graphml")
+    >>> graph = GraphMLStreamReader().read(net_file)
+    >>> graph.graph == nx.read_graphml(net_file).graph
+    True
+    >>> sorted(graph.edges())
+    [('n0', 'n1')]
+    """
+    def read(self, path):
+        ns_graphml = "{%s}" % self.NS_GRAPHML
+        graph = None
+        root = None
+        graph_element = None
+        depth = 0
+        for event, element in iterparse(path, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif (depth == 2 and graph is None
+                        and element.tag == ns_graphml + "graph"):
+# keys precede the graph: make an empty graph with the same type and defaults
+                    graph_element = element
+                    (keys, defaults) = self.find_graphml_keys(root)
+                    graph = self.start_graph(self.make_graph(
+                        Element(element.tag, dict(element.items())), keys, defaults))
+                continue
+
+            depth -= 1
+            if graph_element is None:
+                continue
+            if element is graph_element:
+                graph.graph.update(self.decode_data_elements(keys, element))
+                break
+            if depth != 2:
+# within a node or edge, decoded with it
+                continue
+# nodes and edges are discarded once added, graph data is decoded at the end of the graph
+            if element.tag == ns_graphml + "node":
+                self.add_node(graph, element, keys)
+                graph_element.remove(element)
+            elif element.tag == ns_graphml + "edge":
+                self.add_edge(graph, element, keys)
+                graph_element.remove(element)
+            elif element.tag == ns_graphml + "hyperedge":
+                raise nx.NetworkXError("GraphML reader does not support hyperedges")
+
+        if graph is None:
+            raise nx.NetworkXError("No graph found in GraphML file %s" % path)
+        return self.finish_graph(graph)
+
+    def start_graph(self, empty_graph):
+        """Returns the graph to read into, given an empty graph with the type
+        and defaults of the GraphML graph"""
+        if empty_graph.is_directed():
+            graph = nx.MultiDiGraph()
+        else:
+            graph = nx.MultiGraph()
+        graph.graph.update(empty_graph.graph)
+        return graph
+
+    def finish_graph(self, graph):
+        """Returns the graph once all elements are read"""
+# switch to Graph or DiGraph if no parallel edges were found, as for read_graphml
+        if not self.multigraph:
+            if graph.is_directed():
+                return nx.DiGraph(graph)
+            return nx.Graph(graph)
+        return graph
+
+def network_defaults(graph, default_asn):
+    """Returns (node defaults, edge defaults, default asn) for a graph read
+    from GraphML. Defaults of 'None' are not applied."""
     try:
-        if 'ASN' in input_graph.graph.get("node_default"):
+        if 'ASN' in graph.graph.get("node_default"):
             LOG.warn("Graph has ASN attribute set: did you mean 'asn'?")
     except TypeError:
         pass
 
     try:
-        if input_graph.graph['node_default']['asn'] != "None":
-            default_asn = int(input_graph.graph['node_default']['asn'])
+        if graph.graph['node_default']['asn'] != "None":
+            default_asn = int(graph.graph['node_default']['asn'])
     except KeyError:
         pass    # not set
     except ValueError:
         LOG.warn("Unable to use default asn '%s' specified in graphml file. Using %s instead." % (
-            input_graph.graph['node_default']['asn'], default_asn))
+            graph.graph['node_default']['asn'], default_asn))
 
-# a->z for renaming
-# try intially for a, b, c, d
-    letters = (chr(x) for x in range(97,123)) 
+    node_defaults = dict( (key, val) for key, val in
+            graph.graph.get("node_default", {}).items() if val != 'None')
+    edge_defaults = dict( (key, val) for key, val in
+            graph.graph.get("edge_default", {}).items() if val != 'None')
+    return (node_defaults, edge_defaults, default_asn)
 
-# set any blank labels to be letter for gh-122
-    empty_label_nodes = [n for n, d in input_graph.nodes(data=True) if not d.get("label")]
-    if len(empty_label_nodes) > 26:
+def normalise_node_data(data, node_defaults, default_asn):
+    """Applies node defaults, device type and ASN to the data of a node"""
+    for key, val in node_defaults.items():
+        if key not in data:
+            data[key] = val
+    if 'device_type' not in data:
+        data['device_type'] = 'router'
+    if not 'asn' in data:
+        data['asn'] = default_asn
+    else:
+        data['asn'] = int(data['asn']) # ensure is integer
+
+def label_nodes(graph, unlabelled):
+    """Renames nodes with no label to a, b, c, etc (or aa, ab, etc if more
+    than 26), in graph order, and labels them with their new name, for gh-122.
+    Returns the relabelled graph."""
+    if not unlabelled:
+        return graph
+    letters = (chr(x) for x in range(97,123)) 
+    if len(unlabelled) > 26:
 # use aa, ab, ac, etc
         single_letters = list(letters)
         letters = ("%s%s" % (a, b) for a in single_letters for b in single_letters)
-    mapping = dict( (n, letters.next()) for n in empty_label_nodes)
-    input_graph = nx.relabel_nodes(input_graph, mapping)
+    mapping = dict( (n, letters.next()) for n in graph if n in unlabelled)
+    if set(mapping) & set(mapping.values()):
+# eg node b renamed to a, and node a to b: can't be relabelled in place
+        relabelled = nx.relabel_nodes(graph, mapping)
+        relabelled.graph = graph.graph
+        graph = relabelled
+    else:
+        nx.relabel_nodes(graph, mapping, copy=False)
+    for node in mapping.values():
+        if 'label' not in graph.node[node]:
+            graph.node[node]['label'] = node
+    return graph
 
-    # set node and edge defaults
-    try:
-        for node, data in input_graph.nodes(data=True):
-            for key, val in input_graph.graph["node_default"].items():
-                if key not in data and val != 'None':
-                    data[key] = val
-            input_graph.node[node] = data
-    except KeyError:
-        pass
+class GraphMLNetworkReader(GraphMLStreamReader):
+    """Reads a network from GraphML, normalised as for normalise_network.
+    Nodes and edges are normalised as they are read, and each link is added
+    in both directions to a directed graph, so the graph is not copied.
 
-    try:
-        for s, t, data in input_graph.edges(data=True):
-            for key, val in input_graph.graph["edge_default"].items():
-                if key not in data and val != 'None':
-                    data[key] = val
-            input_graph[s][t] = data
-    except KeyError:
-        pass
+    >>> from pkg_resources import resource_filename
+    >>> net_file = resource_filename("AutoNetkit", "lib/examples/topologies/2routers.graphml")
+    >>> graph = GraphMLNetworkReader(1).read(net_file)
+    >>> graph.is_directed()
+    True
+    >>> sorted(graph.edges())
+    [('n0', 'n1'), ('n1', 'n0')]
+    >>> graph.node['n0']['asn'], graph.node['n0']['device_type']
+    (1, 'router')
+    """
+    def __init__(self, default_asn, node_type=str):
+        GraphMLStreamReader.__init__(self, node_type)
+        self.default_asn = default_asn
+        self.nodes_with_H = 0
+        self.unlabelled = set()
+# nodes added by an edge before (or without) their node element
+        self.undeclared = set()
 
-    # set label if unset
-    for node, data in input_graph.nodes(data=True):
-        if 'label' not in data:
-            input_graph.node[node]['label'] = node
-        if 'device_type' not in data:
-            input_graph.node[node]['device_type'] = default_device_type 
-            LOG.debug("Setting device_type for %s to %s" % ( 
-                input_graph.node[node]['label'], default_device_type) )
+    def start_graph(self, empty_graph):
+        self.directed = empty_graph.is_directed()
+        graph = nx.DiGraph()
+        graph.graph.update(empty_graph.graph)
+        (self.node_defaults, self.edge_defaults, self.default_asn) = network_defaults(
+                graph, self.default_asn)
+        return graph
 
-    # check each node has an ASN allocated
-    for node, data in input_graph.nodes_iter(data=True):
-        if not 'asn' in data:
-            LOG.debug("No asn set for node %s using default of %s" % 
-                     (data['label'],
-                      default_asn))
-            input_graph.node[node]['asn'] = default_asn
+    def add_node(self, graph, node_xml, graphml_keys):
+        node_id = self.node_type(node_xml.get("id"))
+        data = self.decode_data_elements(graphml_keys, node_xml)
+        if data.get('H'):
+            self.nodes_with_H += 1
+        if data.get("label"):
+            self.unlabelled.discard(node_id)
+        elif node_id not in graph or node_id in self.undeclared:
+            self.unlabelled.add(node_id)
+        self.undeclared.discard(node_id)
+        if node_id in graph:
+            graph.node[node_id].update(data)
+            data = graph.node[node_id]
         else:
-            input_graph.node[node]['asn'] = int(data['asn']) # ensure is integer
+            graph.add_node(node_id, data)
+        normalise_node_data(data, self.node_defaults, self.default_asn)
 
-    # Convert to single-edge and then back to directed, to ensure edge in both
-    # directions
-    #TODO: Document this that assume bi-directional
+    def add_edge(self, graph, edge_element, graphml_keys):
+        directed = edge_element.get("directed")
+        if self.directed and directed=='false':
+            raise nx.NetworkXError("directed=false edge found in directed graph.")
+        if not self.directed and directed=='true':
+            raise nx.NetworkXError("directed=true edge found in undirected graph.")
 
-    input_graph = nx.Graph(input_graph)
-    input_graph = input_graph.to_directed()
-    
-    return input_graph
+        source = self.node_type(edge_element.get("source"))
+        target = self.node_type(edge_element.get("target"))
+        data = self.decode_data_elements(graphml_keys, edge_element)
+        edge_id = edge_element.get("id")
+        if edge_id:
+            data["id"] = edge_id
+        else:
+            data.pop('key', None)
+        for key, val in self.edge_defaults.items():
+            if key not in data:
+                data[key] = val
+        for node in (source, target):
+            if node not in graph:
+                graph.add_node(node)
+                self.undeclared.add(node)
+# links are bidirectional: data of parallel and reverse edges is merged, as for nx.Graph
+        graph.add_edge(source, target, data)
+        graph.add_edge(target, source, data)
+
+    def finish_graph(self, graph):
+        for node in self.undeclared:
+            normalise_node_data(graph.node[node], self.node_defaults, self.default_asn)
+        self.unlabelled.update(self.undeclared)
+        return label_nodes(graph, self.unlabelled)
+
+def read_graphml_network(net_file, default_asn, depends):
+    """Reads and normalises network from net_file.
+    Any other files that can change the result (H graphs for graph products,
+    whether or not they exist) are appended to depends."""
+    path, filename = os.path.split(net_file)
+    net_name = os.path.splitext(filename)[0]
+    # get full path
+    path =  os.path.abspath(path)
+    reader = GraphMLNetworkReader(default_asn)
+    input_graph = reader.read(net_file)
+    if not (len(input_graph) and reader.nodes_with_H == len(input_graph)):
+        return input_graph
+
+#all nodes have H set, apply graph products
+# to the graph as read, without normalising: G graphs are small, so are read again
+    LOG.info("All nodes in graph %s have H attribute set, applying graph product" % net_name)
+    H_labels = set(input_graph.node[n]['H'] for n in input_graph)
+    depends += [os.path.join(path, "%s.%s" % (label, extension))
+            for label in H_labels for extension in ["graphml", "gml"]]
+    input_graph = ank.graph_product(net_file, path)
+    if not input_graph:
+        LOG.warn("Unable to load graph %s" % net_file)
+        return
+# remap ('a', 2) -> 'a2'
+    nx.relabel_nodes(input_graph, 
+            dict( (n, "%s_%s" % (n[0], n[1])) for n in input_graph), copy=False)
+
+    return normalise_network(input_graph, default_asn)
+
+def normalise_network(input_graph, default_asn):
+    """Applies node and edge defaults, labels, device types and ASNs to a graph
+    in place, and returns it as a directed graph with each link in both
+    directions"""
+    (node_defaults, edge_defaults, default_asn) = network_defaults(input_graph, default_asn)
+
+# set any blank labels to be letter for gh-122
+    input_graph = label_nodes(input_graph, set(n for n, d in input_graph.nodes_iter(data=True)
+        if not d.get("label")))
+    for node, data in input_graph.nodes_iter(data=True):
+        normalise_node_data(data, node_defaults, default_asn)
+
+    if edge_defaults:
+        for s, t, data in input_graph.edges_iter(data=True):
+            for key, val in edge_defaults.items():
+                if key not in data:
+                    data[key] = val
+
+    # Ensure edge in both directions
+    #TODO: Document this that assume bi-directional
+    if input_graph.is_directed() or input_graph.is_multigraph():
+        input_graph = nx.Graph(input_graph)
+    return input_graph.to_directed()
@@ -10,6 +10,9 @@ __all__ = ['load_zoo']
 import networkx as nx
 import AutoNetkit as ank
 import os
+import multiprocessing
+from AutoNetkit.internal import cache
+from AutoNetkit.internal.workers import worker_count
 
 from collections import defaultdict
 
@@ -21,27 +24,23 @@ LOG = logging.getLogger("ANK")
 config = ank.config
 settings = config.settings
 
+# Version of parsed GML, increment to invalidate cached graphs
+ZOO_LOADER_VERSION = 1
+
 def load_graph(net_file):
-    """ Loads net_file. If present in cache and not out of data,
-    cached copy will be used, otherwise file loaded with a copy stored in cache.
-    Cache is a pickle file, avoids having to run parser across GML file each
-    time"""
-    path, filename = os.path.split(net_file)
-    net_name = os.path.splitext(filename)[0]
-    # get full path
-    path =  os.path.abspath(path)
-    pickle_dir = path + os.sep + "cache"
-    if not os.path.isdir(pickle_dir):
-        os.mkdir(pickle_dir)
-    pickle_file = "{0}/{1}.pickle".format(pickle_dir, net_name)
-    if (os.path.isfile(pickle_file) and
-        os.stat(net_file).st_mtime < os.stat(pickle_file).st_mtime):
-        # Pickle file exists, and source_file is older
-        graph = nx.read_gpickle(pickle_file)
-    else:
-        # No pickle file, or is outdated
+    """ Loads net_file. If present in cache, cached copy will be used,
+    otherwise file loaded with a copy stored in cache.
+    Cache is a pickle file keyed on the contents of net_file, avoids having to
+    run parser across GML file each time"""
+    key = cache.content_key([net_file], ZOO_LOADER_VERSION, nx.__version__)
+    cache_file = cache.cache_file("zoo", key)
+    graph = None
+    if cache_file:
+        graph = cache.load(cache_file)
+    if graph is None:
         graph = nx.read_gml(net_file)
-        nx.write_gpickle(graph, pickle_file)
+        if cache_file:
+            cache.save(cache_file, graph)
     # ANK only understands GML files cleaned by topzootools
     if 'Creator' in graph.graph:
         if graph.graph['Creator'] == "Topology Zoo Toolset":
@@ -67,6 +66,51 @@ def load_graph(net_file):
         return graph
             
 
+def load_graphs(net_files, workers=None):
+    """Loads each of net_files using load_graph, in a pool of worker processes
+    if more than one worker. Graphs are returned in the order of net_files."""
+    workers = min(worker_count(workers), len(net_files))
+    if workers <= 1:
+        return [load_graph(net_file) for net_file in net_files]
+    LOG.debug("Loading %s networks using %s workers" % (len(net_files), workers))
+    pool = multiprocessing.Pool(workers)
+    try:
+        graphs = pool.map(load_graph, net_files)
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return graphs
+
+def merge_graph(graph, new_graph, first_label):
+    """Adds new_graph to graph, with nodes relabelled to integers starting at
+    first_label, as for nx.disjoint_union. Graph is updated in place rather
+    than copied, and only new_graph is relabelled, so merging k networks in
+    turn is linear rather than quadratic. Returns the next unused label.
+    Graph attributes already set on graph take precedence.
+
+    >>> G = nx.DiGraph()
+    >>> next_label = merge_graph(G, nx.DiGraph([("a", "b")], Network="First"), 0)
+    >>> next_label = merge_graph(G, nx.DiGraph([("c", "d")], Network="Second"), next_label)
+    >>> next_label = merge_graph(G, nx.DiGraph([("e", "f")]), next_label)
+    >>> sorted(G.edges())
+    [(0, 1), (2, 3), (4, 5)]
+    >>> next_label
+    6
+    >>> G.graph['Network']
+    'First'
+    """
+    mapping = dict(zip(new_graph.nodes(),
+        range(first_label, first_label + len(new_graph))))
+    graph.add_nodes_from( (mapping[node], data)
+            for node, data in new_graph.nodes_iter(data=True))
+    graph.add_edges_from( (mapping[src], mapping[dst], data)
+            for src, dst, data in new_graph.edges_iter(data=True))
+    for key, val in new_graph.graph.items():
+        graph.graph.setdefault(key, val)
+    return first_label + len(new_graph)
+
 def load_zoo(network, net_file):
     #TODO: remove the network part - make return just a graphs
 #TODO: make a seperate function that merges a new network, allocating ASNs as appropriate 
@@ -111,21 +155,34 @@ def load_zoo(network, net_file):
         # Assume files in same directory as interconnect file
         zoo_dir = os.path.split(net_file)[0]
         # Now look for the files in the zoo dir
+        found_files = []
         for net_load_file in networks_to_load:
             full_path = "{0}/{1}".format(zoo_dir, net_load_file)
             if os.path.exists(full_path):
-                # load the network
-                graph = load_graph(full_path)
-                # Get the name of the network, to use when interconnecting
-                network_graph_names[net_load_file] = graph.graph['Network']
-                network_graphs.append(graph)
+                found_files.append(net_load_file)
             else:
                 LOG.warn("Unable to find {0} in {1}".format(net_load_file,
                                                             zoo_dir))
+        # load the networks
+        graphs = load_graphs(["{0}/{1}".format(zoo_dir, net_load_file)
+                              for net_load_file in found_files])
+        for net_load_file, graph in zip(found_files, graphs):
+            if graph is None:
+                # Not a usable zoo file, already warned when loading
+                continue
+            # Get the name of the network, to use when interconnecting
+            network_graph_names[net_load_file] = graph.graph['Network']
+            network_graphs.append(graph)
+        # Merged networks are labelled with integers, following any existing nodes
+        if len(network.graph):
+            network.graph = nx.relabel_nodes(network.graph,
+                    dict(zip(network.graph.nodes(), range(len(network.graph)))))
+        next_label = len(network.graph)
         for graph in network_graphs:
             #TODO: dont load external graphs for interconnect
             graph = graph_to_ank(network, graph, include_ext_nodes = False)
-            network.graph = nx.disjoint_union(network.graph, graph)
+            # Merged after each network so graph_to_ank sees the ASNs in use
+            next_label = merge_graph(network.graph, graph, next_label)
     else:
         # TODO: clean this up
         if ('Network' in input_graph.graph 
@@ -149,29 +206,34 @@ def load_zoo(network, net_file):
         #TODO: generalise the last section
         # Network specified as a file, get the network name for this node
         filename = data['type']
-        if filename in network_graph_names:
-            network_name = network_graph_names[filename]
-            # and convert to asn
-            asn = None
-            #TODO: look for cleaner way to search dict items
-            for curr_asn, curr_asn_name in network.as_names.items():
-                if curr_asn_name == network_name:
-                    asn = int(curr_asn)
-                    if not asn:
-                        LOG.warn("Unable to find ASN for network "
-                                 "{0}".format(network_name))
-                        return
-                label = data['label']
-                # Now find the node that has this asn and label
-                for node, data in network.graph.nodes(data=True):
-                    if data['label'] == label and data['asn'] == asn:
-                        return node
-            else:
-                # Probably didn't load the network correctly
-                # TODO: throw error
-                pass
+        if filename not in network_graph_names:
+            # Probably didn't load the network correctly
+            # TODO: throw error
+            return
+        network_name = network_graph_names[filename]
+        # and convert to asn
+        asns = asns_by_name.get(network_name)
+        if not asns:
+            LOG.warn("Unable to find ASN for network "
+                     "{0}".format(network_name))
+            return
+        # Now find the node that has this asn and label
+        label = data['label']
+        for asn in asns:
+            node = node_by_asn_label.get( (asn, label))
+            if node is not None:
+                return node
 
     if interconnect_graph:
+        # Index the merged networks once, rather than searching per lookup
+        asns_by_name = defaultdict(list)
+        for curr_asn, curr_asn_name in network.as_names.items():
+            asns_by_name[curr_asn_name].append(int(curr_asn))
+        node_by_asn_label = {}
+        for node, data in network.graph.nodes_iter(data=True):
+            # First node wins if labels are repeated within an AS
+            node_by_asn_label.setdefault( (data.get('asn'), data.get('label')),
+                    node)
         # Connect the networks together
         add_edge_list = []
         for src, dst in interconnect_graph.edges():
@@ -217,13 +279,13 @@ def graph_to_ank(network, graph, asn=None, include_ext_nodes=True):
     # ANK uses directed graphs
     graph = graph.to_directed()
     #TODO: see if ASN set in the graph
-    asn_list = ank.nodes_by_as(network).keys()
+    asns_in_use = set(ank.nodes_by_as(network).keys())
 
-    LOG.debug("current ASN list %s " % asn_list)
+    LOG.debug("current ASN list %s " % sorted(asns_in_use))
 
     # And append any ASNs manually specified
     manual_asn = {}
-    for node, data in graph.nodes(data=True):
+    for node, data in graph.nodes_iter(data=True):
         if ('type' in data and data['type'].startswith("AS") and
             data['type'][2:].isdigit()):
             # This node has a valid manually specified ASN
@@ -231,42 +293,32 @@ def graph_to_ank(network, graph, asn=None, include_ext_nodes=True):
             manual_asn[node] = node_asn
 
     # Unique
-    manual_asn_unique = list(set(manual_asn.keys()))
+    manual_asn_unique = set(manual_asn.values())
     for node_asn in manual_asn_unique:
-        if node_asn in asn_list:
-            LOG.warn("Manually specified ASN %i already in use" % asn)
+        if node_asn in asns_in_use:
+            LOG.warn("Manually specified ASN %i already in use" % node_asn)
     # Record these as in use
-    asn_list += manual_asn_unique
-    LOG.debug("asn list after adding manual uniques %s " % asn_list)
+    asns_in_use.update(manual_asn_unique)
+    LOG.debug("asn list after adding manual uniques %s " % sorted(asns_in_use))
 
     # Allocate asns
-    # Find next free asn
+    # Highest ASN in use, tracked so next_unallocated_asn need not search
+    # Stored in a list so can be updated from within next_unallocated_asn
+    highest_asn = [max(asns_in_use) if asns_in_use else 0]
     def next_unallocated_asn():
-        LOG.debug("nua fn asn list %s " % asn_list)
-        if len(asn_list) > 0:
-            nua = max(asn_list)
-            while nua in asn_list:
-                try:
-                    nua += 1
-                except TypeError as e:
-                    LOG.warn("Unable to set Next Unallocated ASN %i to ASN list"
-                             " %s " % (nua, asn_list))
-
-                asn_list.append(nua)
-                return nua
-        else:
-            # No asn in use
-            nua = 1
-            asn_list.append(nua)
-            return nua
+        nua = highest_asn[0] + 1
+        asns_in_use.add(nua)
+        highest_asn[0] = nua
+        return nua
 
     #TODO: clean up this logic
-    if asn and asn in asn_list:
+    if asn and asn in asns_in_use:
         # User specified asn already in use
         LOG.warn("ASN %s already in use" % asn)
     elif asn:
         # Record as being used
-        asn_list.append(int(asn))
+        asns_in_use.add(int(asn))
+        highest_asn[0] = max(highest_asn[0], int(asn))
         # Record name for DNS
         network.as_names[asn] = graph.graph['Network']
     else:
@@ -282,48 +334,44 @@ def graph_to_ank(network, graph, asn=None, include_ext_nodes=True):
     # eg either merge, keep, make unique, or remove, depending on how
     # external names combined
     #TODO: use include_external_nodes
-    external_nodes = [node for node in graph.nodes()
-                        if ('Internal' in
-                            graph.node[node] and
-                            graph.node[node]['Internal'] == 0)]
-    # Group external nodes by their name
-    ext_node_dict = defaultdict(list)
-    for node in external_nodes:
-        if not include_ext_nodes:
-            graph.remove_node(node)
-        else:
-            label = graph.node[node]['label']
-            ext_node_dict[label].append(node)
-            # Now merge nodes
-            for label, nodes in ext_node_dict.items():
-                if len(nodes) > 1:
-                    # Multiple nodes for this label, merge
-                    # Choose the first (arbitary) node to merge others into
-                    primary_node = nodes.pop()
-                    for node in nodes:
-                        # merge remaining nodes into primary node
-                        # get edges from this node
-                        #TODO: look at using edges_iter here
-                        for src, dst, data in graph.edges(node,
-                                                          data=True):
-                            # add link from primary
-                            graph.add_edge(primary_node, dst, data)
-                            # and reverse link
-                            graph.add_edge(dst, primary_node, data)
-                            graph.remove_node(node)
-
-    for node in graph:
+    external_nodes = [node for node, data in graph.nodes_iter(data=True)
+                        if data.get('Internal') == 0]
+    if not include_ext_nodes:
+        graph.remove_nodes_from(external_nodes)
+    else:
+        # Group external nodes by their name
+        ext_node_dict = defaultdict(list)
+        for node in external_nodes:
+            ext_node_dict[graph.node[node]['label']].append(node)
+        # Now merge nodes
+        for label, nodes in ext_node_dict.items():
+            if len(nodes) > 1:
+                # Multiple nodes for this label, merge
+                # Choose the last (arbitary) node to merge others into
+                primary_node = nodes.pop()
+                for node in nodes:
+                    # merge remaining nodes into primary node
+                    for src, dst, data in graph.edges(node, data=True):
+                        if dst == primary_node:
+                            continue
+                        # add link from primary
+                        graph.add_edge(primary_node, dst, data)
+                        # and reverse link
+                        graph.add_edge(dst, primary_node, data)
+                    graph.remove_node(node)
+
+    for node, data in graph.nodes_iter(data=True):
         if node in manual_asn:
             # Node has ASN manually specified (as previously determined)
-            graph.node[node]['asn'] = manual_asn[node]
-        elif ('Internal' in graph.node[node]):
-            if graph.node[node]['Internal'] == 1:
-                graph.node[node]['asn'] = asn
-            elif graph.node[node]['Internal'] == 0:
-                graph.node[node]['asn'] = next_unallocated_asn()
+            data['asn'] = manual_asn[node]
+        elif ('Internal' in data):
+            if data['Internal'] == 1:
+                data['asn'] = asn
+            elif data['Internal'] == 0:
+                data['asn'] = next_unallocated_asn()
         else:
             # No internal/external set, assume all internal nodes
-            graph.node[node]['asn'] = asn
+            data['asn'] = asn
 
     # Check labels are unique
     # Store nodes by their label, duplicates are labels with more than one node
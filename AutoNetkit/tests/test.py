@@ -40,3 +40,141 @@ def test_dumps():
 def test_config():
     from AutoNetkit import config
     config.add_logging()
+
+def test_graphml_stream():
+    import glob
+    import tempfile
+    import networkx as nx
+    from AutoNetkit.readwrite.graphml import GraphMLStreamReader
+    topology_dir = resource_filename("AutoNetkit", os.path.join("lib", "examples", "topologies"))
+    net_files = glob.glob(os.path.join(topology_dir, "*.graphml"))
+
+# Parallel edges, returned as a multigraph
+    (fd, multi_file) = tempfile.mkstemp(suffix=".graphml")
+    with os.fdopen(fd, "w") as f_multi:
+        f_multi.write("""<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns">
+  <key attr.name="weight" attr.type="int" for="edge" id="d0"><default>1</default></key>
+  <graph edgedefault="undirected">
+    <node id="a"/><node id="b"/>
+    <edge source="a" target="b"><data key="d0">5</data></edge>
+    <edge id="e1" source="b" target="a"/>
+    <data key="d0">3</data>
+  </graph>
+</graphml>
+""")
+    net_files.append(multi_file)
+
+    try:
+        for net_file in net_files:
+            expected = nx.read_graphml(net_file)
+            streamed = GraphMLStreamReader().read(net_file)
+            assert(type(streamed) == type(expected))
+            assert(streamed.graph == expected.graph)
+            assert(streamed.nodes() == expected.nodes())
+            assert(streamed.node == expected.node)
+            assert(streamed.adj == expected.adj)
+    finally:
+        os.unlink(multi_file)
+
+def test_graphml_network():
+    import glob
+    import tempfile
+    import networkx as nx
+    from AutoNetkit.readwrite.graphml import GraphMLNetworkReader, normalise_network
+    topology_dir = resource_filename("AutoNetkit", os.path.join("lib", "examples", "topologies"))
+    net_files = glob.glob(os.path.join(topology_dir, "*.graphml"))
+
+# Unlabelled and undeclared nodes, defaults, and links in both directions
+    (fd, net_file) = tempfile.mkstemp(suffix=".graphml")
+    with os.fdopen(fd, "w") as f_net:
+        f_net.write("""<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns">
+  <key attr.name="label" attr.type="string" for="node" id="d0"/>
+  <key attr.name="asn" attr.type="string" for="node" id="d1"><default>7</default></key>
+  <key attr.name="speed" attr.type="int" for="edge" id="d2"><default>5</default></key>
+  <key attr.name="up" attr.type="boolean" for="edge" id="d3"/>
+  <graph edgedefault="directed">
+    <node id="n0"><data key="d0">r1</data><data key="d1">2</data></node>
+    <node id="n1"><data key="d0"></data></node>
+    <edge source="n0" target="n1"><data key="d2">1</data></edge>
+    <edge source="n1" target="n0"><data key="d2">1</data><data key="d3">true</data></edge>
+    <edge source="n2" target="n3"/>
+    <node id="n2"/>
+  </graph>
+</graphml>
+""")
+    net_files.append(net_file)
+
+    try:
+        for net_file in net_files:
+            expected = normalise_network(nx.read_graphml(net_file), 1)
+            streamed = GraphMLNetworkReader(1).read(net_file)
+            assert(type(streamed) == type(expected))
+            assert(streamed.graph == expected.graph)
+            assert(streamed.node == expected.node)
+            assert(streamed.adj == expected.adj)
+    finally:
+        os.unlink(net_file)
+
+    assert(sorted(streamed) == ['a', 'b', 'c', 'n0'])
+# renamed nodes are labelled with their new name
+    assert(sorted(data['label'] for node, data in streamed.nodes(data=True)) == ['a', 'b', 'c', 'r1'])
+    n1 = streamed['n0'].keys()[0]
+    assert(streamed.node['n0']['asn'] == 2)
+    assert(streamed.node[n1]['asn'] == 7)
+    assert(streamed['n0'][n1] == streamed[n1]['n0'])
+    assert(streamed['n0'][n1]['speed'] == 1 and streamed['n0'][n1]['up'])
+
+def test_example_depends():
+    import shutil
+    import tempfile
+    from AutoNetkit.readwrite import example_topologies
+    topology_dir = resource_filename("AutoNetkit", os.path.join("lib", "examples", "topologies"))
+    temp_dir = tempfile.mkdtemp()
+    shutil.copytree(os.path.join(topology_dir, "H_graphs"), os.path.join(temp_dir, "H_graphs"))
+    net_file = os.path.join(temp_dir, "gptest_depends.graphml")
+    shutil.copy(os.path.join(topology_dir, "gptest.graphml"), net_file)
+    example_topologies.example_files()["gptest_depends"] = net_file
+
+    try:
+        graph = AutoNetkit.load_example("gptest_depends")
+        info = AutoNetkit.example_info("gptest_depends")
+        assert(info.edges * 2 == graph.number_of_edges())
+
+# Editing an H graph changes the product, although the G graph is unchanged
+        shutil.copy(os.path.join(temp_dir, "H_graphs", "H2.gml"),
+                os.path.join(temp_dir, "H_graphs", "H1.gml"))
+        changed = AutoNetkit.load_example("gptest_depends")
+        assert(changed.number_of_edges() > graph.number_of_edges())
+        assert(AutoNetkit.example_info("gptest_depends").edges * 2 == changed.number_of_edges())
+    finally:
+        del example_topologies.example_files()["gptest_depends"]
+        shutil.rmtree(temp_dir)
+
+def test_zoo_interconnect():
+    from AutoNetkit.readwrite.zoo import load_zoo
+    zoo_dir = resource_filename(__name__, "zoo")
+    network = AutoNetkit.network.Network()
+    load_zoo(network, os.path.join(zoo_dir, "interconnect.gml"))
+    graph = network.graph
+
+# Merged networks are labelled with consecutive integers
+    assert(sorted(graph) == range(5))
+# Each network is allocated its own ASN
+    labels_by_asn = {}
+    for node, data in graph.nodes(data=True):
+        labels_by_asn.setdefault(data['asn'], set()).add(data['label'])
+    assert(sorted(labels_by_asn.values()) == [set(["City0", "City1"]),
+        set(["City0", "City1", "City2"])])
+    (asn_b, asn_a) = sorted(labels_by_asn, key = lambda asn: len(labels_by_asn[asn]))
+
+# Internal links are kept, and the interconnect adds City2 (net_a) - City0 (net_b)
+    links = set((graph.node[s]['asn'], graph.node[s]['label'],
+        graph.node[t]['asn'], graph.node[t]['label']) for s, t in graph.edges())
+    assert(links == set([
+        (asn_a, "City0", asn_a, "City1"), (asn_a, "City1", asn_a, "City0"),
+        (asn_a, "City1", asn_a, "City2"), (asn_a, "City2", asn_a, "City1"),
+        (asn_b, "City0", asn_b, "City1"), (asn_b, "City1", asn_b, "City0"),
+        (asn_a, "City2", asn_b, "City0"), (asn_b, "City0", asn_a, "City2"),
+        ]))
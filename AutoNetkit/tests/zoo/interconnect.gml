@@ -0,0 +1,18 @@
+graph [
+  label "interconnect"
+  Creator "Topology Zoo Toolset"
+  node [
+    id 0
+    label "City2"
+    type "net_a.gml"
+  ]
+  node [
+    id 1
+    label "City0"
+    type "net_b.gml"
+  ]
+  edge [
+    source 0
+    target 1
+  ]
+]
@@ -0,0 +1,30 @@
+graph [
+  Network "NetA"
+  Creator "Topology Zoo Toolset"
+  node [
+    id 0
+    label "City0"
+    Internal 1
+    device_type "router"
+  ]
+  node [
+    id 1
+    label "City1"
+    Internal 1
+    device_type "router"
+  ]
+  node [
+    id 2
+    label "City2"
+    Internal 1
+    device_type "router"
+  ]
+  edge [
+    source 0
+    target 1
+  ]
+  edge [
+    source 1
+    target 2
+  ]
+]
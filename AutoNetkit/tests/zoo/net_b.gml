@@ -0,0 +1,20 @@
+graph [
+  Network "NetB"
+  Creator "Topology Zoo Toolset"
+  node [
+    id 0
+    label "City0"
+    Internal 1
+    device_type "router"
+  ]
+  node [
+    id 1
+    label "City1"
+    Internal 1
+    device_type "router"
+  ]
+  edge [
+    source 0
+    target 1
+  ]
+]